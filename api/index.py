@@ -1,9 +1,42 @@
-from flask import Flask, redirect, url_for, render_template, jsonify, request
+from flask import Flask, redirect, url_for, render_template, jsonify, request, send_file, g, has_request_context
 from flask_cors import CORS
 import os
 from supabase import create_client
 from dotenv import load_dotenv
 import uuid
+import json
+import threading
+import time
+import math
+import mmap
+import shutil
+import struct
+import tempfile
+import re
+import csv
+import gzip
+import zlib
+import hashlib
+import subprocess
+import sys
+import click
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from itertools import chain
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock; the cart store lock is skipped there
+    fcntl = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,6 +53,279 @@ CORS(app)
 # In-memory "database" for cart (to keep things simple)
 CARTS = {}
 
+# LRU cache of serialized product listings, keyed by (catalog version, normalized search),
+# bounded by entry count and by the total size of the cached bodies
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "256"))
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get("SEARCH_CACHE_MAX_BYTES", str(32 * 2**20)))
+# Larger bodies aren't cached, so one big listing can't flush every search out of the cache
+SEARCH_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRY_BYTES", str(SEARCH_CACHE_MAX_BYTES // 4)))
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "60"))
+SEARCH_CACHE = OrderedDict()
+SEARCH_CACHE_BYTES = 0
+CACHE_LOCK = threading.Lock()
+
+# Bumped whenever the catalog changes so cached results from an older catalog are never served
+CATALOG_VERSION = 0
+
+# In-process counters exposed at /api/metrics
+METRICS = {
+    "search_requests": 0,
+    "search_cache_hits": 0,
+    "search_backend_calls": 0,
+    "admitted": 0,
+    "shed_rate_limited": 0,
+    "shed_db_busy": 0,
+    "product_index_hits": 0,
+    "product_index_misses": 0,
+    "snapshot_listings": 0,
+    "catalog_changes_applied": 0,
+    "search_index_queries": 0,
+    "thumbnail_cache_hits": 0,
+    "thumbnails_generated": 0,
+    "thumbnails_evicted": 0,
+}
+METRICS_LOCK = threading.Lock()
+
+def incr_metric(name, amount=1):
+    """Increment one of the /api/metrics counters"""
+    with METRICS_LOCK:
+        METRICS[name] = METRICS.get(name, 0) + amount
+
+def normalize_search(query):
+    """Lowercase and collapse whitespace so equivalent searches share a cache entry"""
+    return ' '.join(query.lower().split())
+
+def search_cache_get(key):
+    """Return the cached body for key, or None if missing or expired"""
+    global SEARCH_CACHE_BYTES
+    with CACHE_LOCK:
+        entry = SEARCH_CACHE.get(key)
+        if entry is None:
+            return None
+        stored_at, body = entry
+        if time.monotonic() - stored_at > SEARCH_CACHE_TTL:
+            del SEARCH_CACHE[key]
+            SEARCH_CACHE_BYTES -= len(body)
+            return None
+        SEARCH_CACHE.move_to_end(key)
+        return body
+
+def search_cache_put(key, body):
+    """Store body under key, evicting the least recently used entries"""
+    global SEARCH_CACHE_BYTES
+    if len(body) > SEARCH_CACHE_MAX_ENTRY_BYTES:
+        return
+    with CACHE_LOCK:
+        previous = SEARCH_CACHE.pop(key, None)
+        if previous is not None:
+            SEARCH_CACHE_BYTES -= len(previous[1])
+        SEARCH_CACHE[key] = (time.monotonic(), body)
+        SEARCH_CACHE_BYTES += len(body)
+        while len(SEARCH_CACHE) > SEARCH_CACHE_SIZE or SEARCH_CACHE_BYTES > SEARCH_CACHE_MAX_BYTES:
+            _, (_, evicted) = SEARCH_CACHE.popitem(last=False)
+            SEARCH_CACHE_BYTES -= len(evicted)
+
+def search_cache_clear():
+    """Drop every cached body; callers hold CACHE_LOCK"""
+    global SEARCH_CACHE_BYTES
+    SEARCH_CACHE.clear()
+    SEARCH_CACHE_BYTES = 0
+
+# Compact id -> (title, price, image) projection of the catalog, filled from every product
+# row we fetch, so add_to_cart can build line items without a per-add database query
+PRODUCT_INDEX = {}
+
+# Ids deleted since the snapshot was written, so lookups don't resurrect them from it
+DELETED_PRODUCTS = set()
+
+def index_products(products):
+    """Record the fields a cart line item needs for each product row"""
+    for product in products:
+        PRODUCT_INDEX[product['id']] = (product['title'], product['price'], versioned_image(product['image']))
+
+def bump_catalog_version():
+    """Invalidate every cached listing after a catalog change"""
+    global CATALOG_VERSION
+    with CACHE_LOCK:
+        CATALOG_VERSION += 1
+        search_cache_clear()
+
+# ===== Admission control =====
+# Token buckets (per client and global) plus a cap on outstanding Supabase calls, so a
+# single search-as-you-type client can't flood the database. Rates are tokens per second.
+# A request is charged when it first reaches Supabase, so listings from the snapshot and
+# searches answered by the index or a cache are never limited.
+RATE_LIMIT_CLIENT_RATE = float(os.environ.get("RATE_LIMIT_CLIENT_RATE", "10"))
+RATE_LIMIT_CLIENT_BURST = float(os.environ.get("RATE_LIMIT_CLIENT_BURST", "40"))
+RATE_LIMIT_GLOBAL_RATE = float(os.environ.get("RATE_LIMIT_GLOBAL_RATE", "200"))
+RATE_LIMIT_GLOBAL_BURST = float(os.environ.get("RATE_LIMIT_GLOBAL_BURST", "400"))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", "10000"))
+DB_MAX_CONCURRENCY = int(os.environ.get("DB_MAX_CONCURRENCY", "8"))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get("DB_ACQUIRE_TIMEOUT", "0.5"))
+# Reverse proxies in front of the app whose X-Forwarded-For entries can be trusted. Vercel's
+# edge overwrites the header; anywhere else it is client-controlled unless a proxy rewrites it,
+# so it defaults to 0 and every client behind an unconfigured proxy shares one budget.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "1" if os.environ.get("VERCEL") else "0"))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+class TokenBucket:
+    """Token bucket that refills lazily whenever a token is taken"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def take(self, now):
+        """Take one token; return 0 on success or the seconds until one is available"""
+        # now may predate a bucket created after it was read; never refill backwards
+        self.tokens = min(self.capacity, self.tokens + max(0, now - self.updated) * self.rate)
+        self.updated = max(now, self.updated)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class Overloaded(Exception):
+    """Raised to shed a request with 429 and a Retry-After hint"""
+    def __init__(self, retry_after):
+        super().__init__("Too many requests")
+        self.retry_after = retry_after
+
+# Least recently seen clients are evicted first, keeping the limiter's footprint bounded
+CLIENT_BUCKETS = OrderedDict()
+GLOBAL_BUCKET = TokenBucket(RATE_LIMIT_GLOBAL_RATE, RATE_LIMIT_GLOBAL_BURST)
+LIMITER_LOCK = threading.Lock()
+DB_SEMAPHORE = threading.BoundedSemaphore(DB_MAX_CONCURRENCY)
+
+def client_id():
+    """Identify the caller by peer address (resolved through TRUSTED_PROXY_HOPS proxies)"""
+    return request.remote_addr or 'unknown'
+
+def admit(client):
+    """Take a token from the client's bucket and the global one; return the wait if denied"""
+    with LIMITER_LOCK:
+        now = time.monotonic()
+        bucket = CLIENT_BUCKETS.get(client)
+        if bucket is None:
+            bucket = CLIENT_BUCKETS[client] = TokenBucket(RATE_LIMIT_CLIENT_RATE, RATE_LIMIT_CLIENT_BURST)
+            if len(CLIENT_BUCKETS) > RATE_LIMIT_MAX_CLIENTS:
+                CLIENT_BUCKETS.popitem(last=False)
+        else:
+            CLIENT_BUCKETS.move_to_end(client)
+        
+        wait = bucket.take(now)
+        if wait:
+            return wait
+        
+        wait = GLOBAL_BUCKET.take(now)
+        if wait:
+            # Don't charge the client for a request we are not going to serve
+            bucket.tokens += 1
+        return wait
+
+def admission_control(view):
+    """Shed the view's requests over the per-client or global rate once they need Supabase"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.admission_pending = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def charge_request():
+    """Take the current request's token on its first Supabase call, raising Overloaded if denied"""
+    if not has_request_context() or not g.pop('admission_pending', False):
+        return
+    wait = admit(client_id())
+    if wait:
+        incr_metric('shed_rate_limited')
+        raise Overloaded(wait)
+    incr_metric('admitted')
+
+@contextmanager
+def db_slot():
+    """Hold one of the DB_MAX_CONCURRENCY slots for an outstanding Supabase call"""
+    charge_request()
+    if not DB_SEMAPHORE.acquire(timeout=DB_ACQUIRE_TIMEOUT):
+        incr_metric('shed_db_busy')
+        raise Overloaded(1)
+    try:
+        yield
+    finally:
+        DB_SEMAPHORE.release()
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e):
+    """Tell the client to back off instead of queueing on a saturated database"""
+    response = jsonify({"error": "Too many requests, please retry shortly"})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+def clear_caches():
+    """Reset in-memory caches, counters, rate limiter and cart store state (used by tests)"""
+    global CATALOG_SNAPSHOT, SNAPSHOT_CHECKED_AT, CATALOG_WATERMARK, CATALOG_POLLED_AT
+    global CATALOG_RECONCILED_AT, CATALOG_POLL_FAILING, THUMBNAIL_CACHE_BYTES
+    global RELATED_INDEX, RELATED_TABLE, RELATED_TABLE_CHECKED_AT, SEARCH_INDEX, CART_WAL, CART_WAL_RECORDS, CART_SEQUENCE, CART_RESTORE_STARTED
+    global CART_STORE_LOCK
+    rewrite_thread = SNAPSHOT_REWRITE_THREAD
+    if rewrite_thread is not None:
+        rewrite_thread.join()
+    with CACHE_LOCK:
+        search_cache_clear()
+        PRODUCT_INDEX.clear()
+        DELETED_PRODUCTS.clear()
+        SNAPSHOT_OVERLAY.clear()
+    with METRICS_LOCK:
+        for name in METRICS:
+            METRICS[name] = 0
+    with LIMITER_LOCK:
+        CLIENT_BUCKETS.clear()
+        GLOBAL_BUCKET.tokens = GLOBAL_BUCKET.capacity
+    CATALOG_SNAPSHOT = None
+    SNAPSHOT_CHECKED_AT = float('-inf')
+    THUMBNAIL_CACHE_BYTES = None
+    CATALOG_WATERMARK = None
+    CATALOG_POLLED_AT = float('-inf')
+    CATALOG_RECONCILED_AT = float('-inf')
+    CATALOG_POLL_FAILING = False
+    related_thread = RELATED_BUILD_THREAD
+    if related_thread is not None:
+        related_thread.join()
+    with RELATED_LOCK:
+        RELATED_INDEX = None
+        RELATED_TABLE = None
+        RELATED_TABLE_CHECKED_AT = float('-inf')
+        RELATED_PENDING.clear()
+    search_thread = SEARCH_BUILD_THREAD
+    if search_thread is not None:
+        search_thread.join()
+    with SEARCH_INDEX_LOCK:
+        SEARCH_INDEX = None
+        SEARCH_PENDING.clear()
+    with THUMBNAIL_LOCK:
+        SOURCE_DIGESTS.clear()
+    snapshot_thread = CART_SNAPSHOT_THREAD
+    if snapshot_thread is not None:
+        snapshot_thread.join()
+    with CART_LOCK:
+        if CART_WAL is not None:
+            CART_WAL.close()
+        CART_WAL = None
+        CART_WAL_RECORDS = 0
+        CART_SEQUENCE = 0
+        CART_RESTORE_STARTED = False
+        CART_RESTORED.clear()
+        if CART_STORE_LOCK is not None:
+            CART_STORE_LOCK.close()
+        CART_STORE_LOCK = None
+    with CART_CONDITION:
+        CART_VERSIONS.clear()
+        CART_EVENTS.clear()
+
 @app.route('/')
 @app.route('/index')
 def index():
@@ -36,48 +342,810 @@ def cart():
     """Cart page route"""
     return render_template('cart.html')
 
+# Rows fetched per range() query when streaming the catalog
+CATALOG_PAGE_SIZE = int(os.environ.get("CATALOG_PAGE_SIZE", "1000"))
+
+def transform_product(product):
+    """Reshape a products row into the JSON served by /api/products"""
+    return {
+        'id': product['id'],
+        'title': product['title'],
+        'price': product['price'],
+        'description': product['description'],
+        'category': product['category'],
+        'image': versioned_image(product['image']),
+        'rating': {
+            'rate': product.get('rating.rate', 0),
+            'count': product.get('rating.count', 0)
+        }
+    }
+
+def iter_catalog_pages(page_size=None, columns='*'):
+    """Yield lists of product rows from Supabase, one range() page at a time"""
+    page_size = page_size or CATALOG_PAGE_SIZE
+    start = 0
+    while True:
+        query = supabase.table('products').select(columns)
+        with db_slot():
+            response = query.order('id').range(start, start + page_size - 1).execute()
+        
+        if hasattr(response, 'error') and response.error is not None:
+            raise RuntimeError("Failed to fetch products")
+        
+        rows = response.data
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        start += page_size
+
+def stream_products():
+    """Stream the listing as a JSON array without holding the whole catalog in memory"""
+    pages = iter_catalog_pages()
+    
+    # Fetch the first page before the response starts, so a failing query still gets a 500
+    first_page = next(pages, [])
+    
+    def generate():
+        yield '['
+        separator = ''
+        for page in chain([first_page], pages):
+            index_products(page)
+            yield separator + ','.join(
+                json.dumps(transform_product(product), separators=(',', ':')) for product in page
+            )
+            separator = ','
+        yield ']'
+    
+    return app.response_class(generate(), mimetype='application/json')
+
+# ===== Catalog snapshot =====
+# A read-only, memory-mapped copy of the transformed catalog. It is written once (by the
+# gunicorn master or `flask catalog snapshot`) and mapped by every worker, so all workers
+# share one copy through the page cache. Replacing the file is atomic; workers notice the
+# new inode within CATALOG_SNAPSHOT_CHECK_INTERVAL seconds and remap without a restart.
+# Catalog changes made after the snapshot was written are kept in a small in-memory overlay
+# and merged into every read, until a rewritten snapshot includes them.
+#
+# File layout (arrays in native byte order):
+#   b'SPLCAT01' | uint32 header length | header JSON, padded to a multiple of 8 bytes
+#   ids     int64[count]   product ids, sorted
+#   starts  uint64[count]  offset of each product's JSON within the payload
+#   ends    uint64[count]
+#   payload                JSON array of transformed products
+CATALOG_SNAPSHOT_PATH = os.environ.get("CATALOG_SNAPSHOT_PATH", "")
+CATALOG_SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("CATALOG_SNAPSHOT_CHECK_INTERVAL", "5"))
+SNAPSHOT_MAGIC = b'SPLCAT01'
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+def write_catalog_snapshot(path, products, watermark=None):
+    """Write transformed products to a snapshot file, atomically replacing any existing one.
+    
+    products may be any iterable; only the id and offset arrays are held in memory.
+    Returns the number of products written.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    ids, starts, ends = array('q'), array('Q'), array('Q')
+    payload_fd, payload_path = tempfile.mkstemp(dir=directory, suffix='.payload')
+    snapshot_path = None
+    try:
+        with os.fdopen(payload_fd, 'w+b') as payload:
+            payload.write(b'[')
+            for product in products:
+                if ids:
+                    payload.write(b',')
+                ids.append(product['id'])
+                starts.append(payload.tell())
+                payload.write(json.dumps(product, separators=(',', ':')).encode('utf-8'))
+                ends.append(payload.tell())
+            payload.write(b']')
+            
+            # A repeated id keeps its last occurrence, as an upsert of the same rows would
+            order = sorted(range(len(ids)), key=lambda i: (ids[i], i))
+            keep = [i for position, i in enumerate(order)
+                    if position + 1 == len(order) or ids[order[position + 1]] != ids[i]]
+            if len(keep) < len(ids):
+                ids, starts, ends = compact_snapshot_payload(payload, ids, starts, ends, sorted(keep))
+                order = sorted(range(len(ids)), key=ids.__getitem__)
+            header = json.dumps({'count': len(ids), 'watermark': watermark, 'created': time.time()}).encode('utf-8')
+            header += b' ' * (-(len(SNAPSHOT_MAGIC) + 4 + len(header)) % 8)
+            
+            snapshot_fd, snapshot_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(snapshot_fd, 'wb') as out:
+                out.write(SNAPSHOT_MAGIC)
+                out.write(struct.pack('<I', len(header)))
+                out.write(header)
+                for values in (ids, starts, ends):
+                    array(values.typecode, (values[i] for i in order)).tofile(out)
+                payload.seek(0)
+                shutil.copyfileobj(payload, out, SNAPSHOT_CHUNK_SIZE)
+        
+        os.replace(snapshot_path, path)
+        return len(ids)
+    finally:
+        for leftover in (payload_path, snapshot_path):
+            if leftover and os.path.exists(leftover):
+                os.remove(leftover)
+
+def compact_snapshot_payload(payload, ids, starts, ends, keep):
+    """Rewrite a payload file in place with only the entries at the ascending positions keep.
+    
+    Entries only move towards the start of the file, so each is read before it can be
+    overwritten. Returns the new (ids, starts, ends).
+    """
+    kept_ids, kept_starts, kept_ends = array('q'), array('Q'), array('Q')
+    end = 1
+    for i in keep:
+        payload.seek(starts[i])
+        data = payload.read(ends[i] - starts[i])
+        payload.seek(end)
+        if kept_ids:
+            payload.write(b',')
+        kept_ids.append(ids[i])
+        kept_starts.append(payload.tell())
+        payload.write(data)
+        end = payload.tell()
+        kept_ends.append(end)
+    payload.write(b']')
+    payload.truncate()
+    return kept_ids, kept_starts, kept_ends
+
+class CatalogSnapshot:
+    """Read-only view of a snapshot file; lookups read straight from the mapping"""
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        view = memoryview(self.mapping)
+        if view[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        
+        offset = len(SNAPSHOT_MAGIC)
+        header_length = struct.unpack_from('<I', view, offset)[0]
+        offset += 4
+        self.header = json.loads(view[offset:offset + header_length].tobytes())
+        offset += header_length
+        
+        count = self.header['count']
+        self.ids = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+        self.starts = view[offset:offset + 8 * count].cast('Q')
+        offset += 8 * count
+        self.ends = view[offset:offset + 8 * count].cast('Q')
+        offset += 8 * count
+        self.payload = view[offset:]
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def get(self, product_id):
+        """Return the transformed product with product_id, or None"""
+        if isinstance(product_id, bool) or not isinstance(product_id, int):
+            return None
+        position = bisect_left(self.ids, product_id)
+        if position < len(self.ids) and self.ids[position] == product_id:
+            return json.loads(self.payload[self.starts[position]:self.ends[position]].tobytes())
+        return None
+    
+    def data(self, product_id):
+        """Return the serialized product with product_id as stored in the mapping, or None"""
+        position = bisect_left(self.ids, product_id)
+        if position < len(self.ids) and self.ids[position] == product_id:
+            return self.payload[self.starts[position]:self.ends[position]].tobytes()
+        return None
+    
+    def __contains__(self, product_id):
+        position = bisect_left(self.ids, product_id)
+        return position < len(self.ids) and self.ids[position] == product_id
+    
+    def __iter__(self):
+        """Yield every transformed product, ordered by id"""
+        for start, end in zip(self.starts, self.ends):
+            yield json.loads(self.payload[start:end].tobytes())
+    
+    def iter_merged(self, overlay=None, deleted=()):
+        """Yield (id, product JSON bytes) in id order, with overlay products (id -> product)
+        replacing or adding to the mapped ones and deleted ids left out"""
+        overlay = overlay or {}
+        added = sorted(product_id for product_id in overlay if product_id not in self)
+        next_added = 0
+        for position, product_id in enumerate(self.ids):
+            while next_added < len(added) and added[next_added] < product_id:
+                if added[next_added] not in deleted:
+                    yield added[next_added], json.dumps(overlay[added[next_added]], separators=(',', ':')).encode('utf-8')
+                next_added += 1
+            if product_id in deleted:
+                continue
+            if product_id in overlay:
+                yield product_id, json.dumps(overlay[product_id], separators=(',', ':')).encode('utf-8')
+            else:
+                yield product_id, self.payload[self.starts[position]:self.ends[position]].tobytes()
+        for product_id in added[next_added:]:
+            if product_id not in deleted:
+                yield product_id, json.dumps(overlay[product_id], separators=(',', ':')).encode('utf-8')
+    
+    def iter_listing(self, overlay=None, deleted=()):
+        """Yield the serialized listing in chunks of about SNAPSHOT_CHUNK_SIZE bytes"""
+        if not overlay and not deleted:
+            # Unchanged since it was written: stream the mapped payload as is
+            for start in range(0, len(self.payload), SNAPSHOT_CHUNK_SIZE):
+                yield self.payload[start:start + SNAPSHOT_CHUNK_SIZE].tobytes()
+            return
+        
+        chunk, size, separator = [b'['], 1, b''
+        for _, data in self.iter_merged(overlay, deleted):
+            chunk.append(separator + data)
+            size += len(data) + 1
+            separator = b','
+            if size >= SNAPSHOT_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk, size = [], 0
+        chunk.append(b']')
+        yield b''.join(chunk)
+
+CATALOG_SNAPSHOT = None
+SNAPSHOT_CHECKED_AT = float('-inf')
+SNAPSHOT_LOCK = threading.Lock()
+
+# Products changed since the mapped snapshot was written: id -> (watermark value, product).
+# Deletions are in DELETED_PRODUCTS. Once the overlay holds more than
+# SNAPSHOT_REWRITE_FRACTION of the catalog, the snapshot is rewritten in the background.
+SNAPSHOT_OVERLAY = {}
+SNAPSHOT_REWRITE_FRACTION = 0.1
+SNAPSHOT_REWRITE_THREAD = None
+
+def current_snapshot():
+    """Return the mapped snapshot, remapping it when the file has been replaced"""
+    global CATALOG_SNAPSHOT, SNAPSHOT_CHECKED_AT, CATALOG_WATERMARK, CATALOG_POLLED_AT
+    if not CATALOG_SNAPSHOT_PATH:
+        return None
+    if time.monotonic() - SNAPSHOT_CHECKED_AT < CATALOG_SNAPSHOT_CHECK_INTERVAL:
+        return CATALOG_SNAPSHOT
+    
+    with SNAPSHOT_LOCK:
+        SNAPSHOT_CHECKED_AT = time.monotonic()
+        try:
+            stat = os.stat(CATALOG_SNAPSHOT_PATH)
+        except FileNotFoundError:
+            CATALOG_SNAPSHOT = None
+            return None
+        
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if CATALOG_SNAPSHOT is None or CATALOG_SNAPSHOT.identity != identity:
+            previous = CATALOG_SNAPSHOT
+            try:
+                CATALOG_SNAPSHOT = CatalogSnapshot(CATALOG_SNAPSHOT_PATH)
+            except (OSError, ValueError) as e:
+                app.logger.warning("Could not map catalog snapshot: %s", e)
+                return CATALOG_SNAPSHOT
+            
+            # Keep only the changes the new file doesn't include yet
+            watermark = CATALOG_SNAPSHOT.header.get('watermark')
+            with CACHE_LOCK:
+                for product_id, (changed_at, _) in list(SNAPSHOT_OVERLAY.items()):
+                    if watermark is not None and changed_at is not None and changed_at <= watermark:
+                        del SNAPSHOT_OVERLAY[product_id]
+                DELETED_PRODUCTS.intersection_update(
+                    [product_id for product_id in DELETED_PRODUCTS if product_id in CATALOG_SNAPSHOT])
+                PRODUCT_INDEX.clear()
+            
+            if previous is None and watermark and CATALOG_WATERMARK and watermark < CATALOG_WATERMARK:
+                # Changes applied before any snapshot was mapped were not kept in the overlay;
+                # replay everything newer than this file on the next poll
+                CATALOG_WATERMARK = watermark
+                CATALOG_POLLED_AT = float('-inf')
+            # Results cached from the previous catalog may disagree with the new file
+            bump_catalog_version()
+    return CATALOG_SNAPSHOT
+
+def snapshot_overlay():
+    """Return a consistent copy of the overlay (id -> product) and the deleted ids"""
+    with CACHE_LOCK:
+        return ({product_id: product for product_id, (_, product) in SNAPSHOT_OVERLAY.items()},
+                frozenset(DELETED_PRODUCTS))
+
+def cached_cart_product(product_id):
+    """Return (title, price, image) from the product index or snapshot, without querying Supabase"""
+    product = PRODUCT_INDEX.get(product_id)
+    if product is None and product_id not in DELETED_PRODUCTS:
+        snapshot = current_snapshot()
+        changed = SNAPSHOT_OVERLAY.get(product_id)
+        if changed is not None:
+            row = changed[1]
+        else:
+            row = snapshot.get(product_id) if snapshot is not None else None
+        if row is not None:
+            product = PRODUCT_INDEX[product_id] = (row['title'], row['price'], row['image'])
+    return product
+
+def refresh_catalog_snapshot(path=None):
+    """Rebuild the snapshot from Supabase page by page; returns the number of products"""
+    # Read the watermark first, so changes made while paging are re-applied rather than missed
+    try:
+        watermark = fetch_catalog_watermark()
+    except Exception:
+        watermark = None
+    products = (transform_product(product) for page in iter_catalog_pages() for product in page)
+    return write_catalog_snapshot(path or CATALOG_SNAPSHOT_PATH, products, watermark=watermark)
+
+def rewrite_catalog_snapshot():
+    """Fold the overlay into a freshly written snapshot, then remap it on the next read"""
+    global SNAPSHOT_CHECKED_AT
+    try:
+        count = refresh_catalog_snapshot()
+        SNAPSHOT_CHECKED_AT = float('-inf')
+        app.logger.info("Catalog snapshot rewritten with %d products", count)
+        # The old neighbour table keeps serving until the new one replaces it
+        start_related_table_build()
+    except Exception as e:
+        # The overlay keeps serving the changes; the next large change retries
+        app.logger.warning("Catalog snapshot rewrite failed: %s", e)
+
+def start_snapshot_rewrite():
+    """Rewrite the snapshot in a background thread unless a rewrite is already running"""
+    global SNAPSHOT_REWRITE_THREAD
+    with SNAPSHOT_LOCK:
+        if SNAPSHOT_REWRITE_THREAD is not None and SNAPSHOT_REWRITE_THREAD.is_alive():
+            return
+        SNAPSHOT_REWRITE_THREAD = threading.Thread(target=rewrite_catalog_snapshot, name='catalog-snapshot', daemon=True)
+        SNAPSHOT_REWRITE_THREAD.start()
+
+# ===== Catalog change tracking =====
+# A background thread in each process checks, every CATALOG_POLL_INTERVAL seconds, the newest
+# CATALOG_WATERMARK_COLUMN value (a single-row query; the column and its trigger are set up
+# as described in the README). When it has advanced, only the changed rows are fetched, in
+# keyset-paginated batches of CATALOG_CHANGE_BATCH, and applied in place. Deleted rows leave
+# no watermark, so every CATALOG_RECONCILE_INTERVAL seconds the thread also compares the
+# table's row count with the ids this process knows, and pages through the ids to find the
+# deleted ones only when they differ. Requests never wait for either.
+CATALOG_WATERMARK_COLUMN = os.environ.get("CATALOG_WATERMARK_COLUMN", "updated_at")
+CATALOG_POLL_INTERVAL = float(os.environ.get("CATALOG_POLL_INTERVAL", "2"))
+CATALOG_RECONCILE_INTERVAL = float(os.environ.get("CATALOG_RECONCILE_INTERVAL", "15"))
+CATALOG_CHANGE_BATCH = int(os.environ.get("CATALOG_CHANGE_BATCH", "500"))
+CATALOG_WATERMARK = None
+CATALOG_POLLED_AT = float('-inf')
+CATALOG_RECONCILED_AT = float('-inf')
+# Set while polls fail (e.g. the watermark column is missing), so the warning is logged once
+CATALOG_POLL_FAILING = False
+CATALOG_POLL_LOCK = threading.Lock()
+CATALOG_POLL_THREAD = None
+
+# Callables notified as listener(rows, deleted_ids) after changes are applied
+CATALOG_CHANGE_LISTENERS = []
+
+def fetch_catalog_watermark():
+    """Return the newest watermark value in the products table, or None if it is empty"""
+    with db_slot():
+        response = (supabase.table('products').select(CATALOG_WATERMARK_COLUMN)
+                    .order(CATALOG_WATERMARK_COLUMN, desc=True).limit(1).execute())
+    if hasattr(response, 'error') and response.error is not None:
+        raise RuntimeError("Failed to fetch catalog watermark")
+    return response.data[0][CATALOG_WATERMARK_COLUMN] if response.data else None
+
+def apply_catalog_changes(rows=(), deleted_ids=()):
+    """Apply changed product rows in place and invalidate everything derived from them"""
+    snapshot = current_snapshot()
+    with CACHE_LOCK:
+        for product in rows:
+            DELETED_PRODUCTS.discard(product['id'])
+            if snapshot is not None:
+                SNAPSHOT_OVERLAY[product['id']] = (product.get(CATALOG_WATERMARK_COLUMN), transform_product(product))
+        index_products(rows)
+        for product_id in deleted_ids:
+            PRODUCT_INDEX.pop(product_id, None)
+            SNAPSHOT_OVERLAY.pop(product_id, None)
+            DELETED_PRODUCTS.add(product_id)
+        overlay_size = len(SNAPSHOT_OVERLAY) + len(DELETED_PRODUCTS)
+    
+    bump_catalog_version()
+    if snapshot is not None and overlay_size > max(CATALOG_CHANGE_BATCH, len(snapshot) * SNAPSHOT_REWRITE_FRACTION):
+        start_snapshot_rewrite()
+    for listener in CATALOG_CHANGE_LISTENERS:
+        listener(rows, deleted_ids)
+
+def iter_catalog_changes(since, until):
+    """Yield pages of rows changed after since and up to until, ordered by (watermark, id).
+    
+    Pages continue after the last (watermark, id) seen rather than at an offset, so rows
+    sharing a watermark value (e.g. from one bulk update) are neither skipped nor repeated.
+    """
+    column = CATALOG_WATERMARK_COLUMN
+    after = None
+    while True:
+        query = supabase.table('products').select('*').lte(column, until)
+        if after is None:
+            query = query.gt(column, since)
+        else:
+            query = query.or_(f'{column}.gt."{after[0]}",and({column}.eq."{after[0]}",id.gt.{after[1]})')
+        with db_slot():
+            response = query.order(column).order('id').limit(CATALOG_CHANGE_BATCH).execute()
+        if hasattr(response, 'error') and response.error is not None:
+            raise RuntimeError("Failed to fetch changed products")
+        
+        rows = response.data
+        if rows:
+            yield rows
+        if len(rows) < CATALOG_CHANGE_BATCH:
+            return
+        after = (rows[-1][column], rows[-1]['id'])
+
+def poll_catalog_changes():
+    """Apply catalog changes newer than the last watermark, at most once per poll interval"""
+    global CATALOG_WATERMARK, CATALOG_POLLED_AT, CATALOG_POLL_FAILING
+    if CATALOG_POLL_INTERVAL <= 0 or time.monotonic() - CATALOG_POLLED_AT < CATALOG_POLL_INTERVAL:
+        return
+    
+    # Only one caller polls; the others carry on with the current data
+    if not CATALOG_POLL_LOCK.acquire(blocking=False):
+        return
+    try:
+        CATALOG_POLLED_AT = time.monotonic()
+        latest = fetch_catalog_watermark()
+        
+        if CATALOG_WATERMARK is None:
+            # Start from the snapshot's watermark so changes made since it was written are applied
+            snapshot = current_snapshot()
+            CATALOG_WATERMARK = (snapshot.header.get('watermark') if snapshot is not None else None) or latest
+        
+        CATALOG_POLL_FAILING = False
+        if latest is None or latest <= CATALOG_WATERMARK:
+            return
+        
+        # Each page is applied as it arrives; if a later page fails, the next poll starts
+        # over from the old watermark and re-applies the earlier ones harmlessly
+        for rows in iter_catalog_changes(CATALOG_WATERMARK, latest):
+            apply_catalog_changes(rows)
+            incr_metric('catalog_changes_applied', len(rows))
+        CATALOG_WATERMARK = latest
+    except Overloaded:
+        pass
+    except Exception as e:
+        if not CATALOG_POLL_FAILING:
+            app.logger.warning("Catalog change poll failed (is there a %s column?): %s", CATALOG_WATERMARK_COLUMN, e)
+        CATALOG_POLL_FAILING = True
+    finally:
+        CATALOG_POLL_LOCK.release()
+
+def known_catalog_ids():
+    """Return (ids this process serves, whether that is the whole catalog)"""
+    snapshot = current_snapshot()
+    index = SEARCH_INDEX
+    if snapshot is not None:
+        overlay, _ = snapshot_overlay()
+        ids, complete = set(snapshot.ids).union(overlay), True
+    elif index is not None:
+        ids, complete = set(index.positions), True
+    else:
+        ids, complete = set(), False
+    ids.update(PRODUCT_INDEX)
+    return ids - DELETED_PRODUCTS, complete
+
+def reconcile_catalog_deletions():
+    """Apply deletions the watermark can't show, at most once per reconcile interval"""
+    global CATALOG_RECONCILED_AT
+    if time.monotonic() - CATALOG_RECONCILED_AT < CATALOG_RECONCILE_INTERVAL:
+        return
+    CATALOG_RECONCILED_AT = time.monotonic()
+    try:
+        known, complete = known_catalog_ids()
+        if not known:
+            return
+        if complete and not CATALOG_POLL_FAILING:
+            # Every insert is polled into the known ids, so equal counts mean nothing was deleted
+            with db_slot():
+                response = supabase.table('products').select('id', count='exact').limit(1).execute()
+            if response.count is not None and response.count >= len(known):
+                return
+        
+        live = set()
+        for page in iter_catalog_pages(columns='id'):
+            live.update(row['id'] for row in page)
+        deleted = known - live
+        if deleted:
+            apply_catalog_changes(deleted_ids=sorted(deleted))
+            incr_metric('catalog_changes_applied', len(deleted))
+    except Overloaded:
+        pass
+    except Exception as e:
+        app.logger.warning("Catalog reconcile failed: %s", e)
+
+def catalog_poll_loop():
+    """Poll for catalog changes and deletions until polling is switched off"""
+    while CATALOG_POLL_INTERVAL > 0:
+        poll_catalog_changes()
+        reconcile_catalog_deletions()
+        time.sleep(CATALOG_POLL_INTERVAL)
+
+@app.before_request
+def start_catalog_poller():
+    """Start this process's catalog poll thread (threads don't survive gunicorn's fork)"""
+    global CATALOG_POLL_THREAD
+    if CATALOG_POLL_INTERVAL <= 0 or (CATALOG_POLL_THREAD is not None and CATALOG_POLL_THREAD.is_alive()):
+        return
+    # Held by a poll in progress; a later request starts the thread instead of waiting here
+    if not CATALOG_POLL_LOCK.acquire(blocking=False):
+        return
+    try:
+        if CATALOG_POLL_THREAD is None or not CATALOG_POLL_THREAD.is_alive():
+            CATALOG_POLL_THREAD = threading.Thread(target=catalog_poll_loop, name='catalog-poll', daemon=True)
+            CATALOG_POLL_THREAD.start()
+    finally:
+        CATALOG_POLL_LOCK.release()
+
+@app.cli.group('catalog')
+def catalog_cli():
+    """Catalog maintenance commands"""
+
+@catalog_cli.command('snapshot')
+@click.option('--path', default=None, help='Snapshot file (defaults to CATALOG_SNAPSHOT_PATH).')
+def catalog_snapshot_command(path):
+    """Write the memory-mapped catalog snapshot from Supabase"""
+    path = path or CATALOG_SNAPSHOT_PATH
+    if not path:
+        raise click.UsageError("Pass --path or set CATALOG_SNAPSHOT_PATH")
+    count = refresh_catalog_snapshot(path)
+    click.echo(f"Wrote {count} products to {path}")
+    write_related_table(path)
+    click.echo(f"Wrote related products to {related_table_path(path)}")
+
+@catalog_cli.command('related')
+@click.option('--path', default=None, help='Snapshot file (defaults to CATALOG_SNAPSHOT_PATH).')
+@click.option('--output', default=None, help='Write the table here; without a snapshot, read the catalog from Supabase.')
+def catalog_related_command(path, output):
+    """Precompute related products and write them as a neighbour table.
+    
+    Reads the snapshot and writes the table beside it, or with only --output, reads the
+    catalog from Supabase (for deployments without a snapshot; see RELATED_TABLE_PATH).
+    """
+    path = path or CATALOG_SNAPSHOT_PATH
+    if path:
+        output = output or related_table_path(path)
+        products = (json.loads(data) for _, data in CatalogSnapshot(path).iter_merged({}, ()))
+    elif output:
+        products = (transform_product(product) for page in iter_catalog_pages() for product in page)
+    else:
+        raise click.UsageError("Pass --path or --output, or set CATALOG_SNAPSHOT_PATH")
+    count = save_related_table(products, output)
+    click.echo(f"Wrote related products for {count} products to {output}")
+
+# ===== Catalog import/export =====
+# Both directions stream: imports hold at most one upsert batch (plus the snapshot's id and
+# offset arrays), and exports hold one Supabase page.
+CATALOG_FIELDS = ('id', 'title', 'price', 'description', 'category', 'image', 'rating.rate', 'rating.count')
+CATALOG_IMPORT_BATCH = int(os.environ.get("CATALOG_IMPORT_BATCH", "500"))
+
+def catalog_product_id(value):
+    """Parse an imported id, accepting only positive whole numbers (12, 12.0 or "12")"""
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    elif isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError("id must be a positive whole number")
+    return value
+
+def normalize_catalog_record(record):
+    """Validate an imported record and flatten it to the products row shape.
+    
+    Accepts either a nested rating object or flat rating.rate/rating.count fields, which
+    is what get_products reads back. Raises ValueError for records that can't be stored,
+    including lines read_catalog_records couldn't parse.
+    """
+    if isinstance(record, ValueError):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError("record must be a JSON object")
+    rating = record.get('rating')
+    rating = rating if isinstance(rating, dict) else {}
+    
+    def field(name, default=None):
+        value = record.get(name)
+        return default if value is None or value == '' else value
+    
+    product_id = catalog_product_id(record.get('id'))
+    
+    try:
+        price = to_cents(field('price'))
+        rate = float(field('rating.rate', rating.get('rate', 0)))
+        count = int(field('rating.count', rating.get('count', 0)))
+    except (TypeError, ValueError, InvalidOperation):
+        raise ValueError("price and rating must be numeric")
+    
+    title = str(field('title', '')).strip()
+    if not title:
+        raise ValueError("title is required")
+    if price < 0:
+        raise ValueError("price must not be negative")
+    if not 0 <= rate <= 5 or count < 0:
+        raise ValueError("rating.rate must be 0-5 and rating.count non-negative")
+    
+    return {
+        'id': product_id,
+        'title': title,
+        'price': float(price),
+        'description': str(field('description', '')),
+        'category': str(field('category', '')).strip(),
+        'image': str(field('image', '')).strip(),
+        'rating.rate': rate,
+        'rating.count': count
+    }
+
+def read_catalog_records(stream, fmt):
+    """Yield (line number, record) pairs from an NDJSON or CSV stream.
+    
+    A line that isn't valid JSON yields the ValueError in place of the record, so the
+    import reports and skips it like any other invalid record.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, ValueError(f"invalid JSON: {e}")
+
+def upsert_catalog_batch(batch):
+    """Upsert one batch of normalized rows into Supabase"""
+    with db_slot():
+        response = supabase.table('products').upsert(list(batch.values())).execute()
+    if hasattr(response, 'error') and response.error is not None:
+        raise click.ClickException(f"Upsert failed: {response.error}")
+
+def catalog_format(path, fmt):
+    """Use the explicit format, or infer it from the file extension"""
+    return fmt or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+
+@catalog_cli.command('import')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=CATALOG_IMPORT_BATCH, show_default=True, help='Rows per upsert.')
+@click.option('--snapshot', 'snapshot_path', default=None, help='Afterwards rewrite the catalog snapshot at this path from Supabase.')
+@click.option('--dry-run', is_flag=True, help='Validate without writing to Supabase.')
+def catalog_import_command(source, fmt, batch_size, snapshot_path, dry_run):
+    """Validate, normalize and upsert a catalog file (use - for stdin)"""
+    if snapshot_path and dry_run:
+        raise click.UsageError("--snapshot can't be used with --dry-run, which writes nothing to Supabase")
+    fmt = catalog_format(source.name, fmt)
+    stats = {'imported': 0, 'skipped': 0}
+    
+    # Rows are keyed by id so a repeated id within one batch doesn't make the upsert fail
+    batch = {}
+    for line_number, record in read_catalog_records(source, fmt):
+        try:
+            row = normalize_catalog_record(record)
+        except ValueError as e:
+            stats['skipped'] += 1
+            click.echo(f"line {line_number}: {e}", err=True)
+            continue
+        
+        batch[row['id']] = row
+        stats['imported'] += 1
+        if len(batch) >= batch_size:
+            if not dry_run:
+                upsert_catalog_batch(batch)
+            batch = {}
+    if batch and not dry_run:
+        upsert_catalog_batch(batch)
+    
+    click.echo(f"Imported {stats['imported']} products, skipped {stats['skipped']}"
+               + (" (dry run)" if dry_run else ""))
+    if snapshot_path:
+        # Rebuilt from the table rather than the file, so importing a partial or delta file
+        # doesn't shrink the served catalog to just those rows
+        count = refresh_catalog_snapshot(snapshot_path)
+        write_related_table(snapshot_path)
+        click.echo(f"Wrote {count} products to {snapshot_path}")
+    if stats['skipped']:
+        click.get_current_context().exit(1)
+
+@catalog_cli.command('export')
+@click.argument('destination')
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv', 'snapshot']),
+              help='Defaults to the file extension (ndjson unless .csv).')
+def catalog_export_command(destination, fmt):
+    """Stream the catalog from Supabase to a file (use - for stdout)"""
+    fmt = catalog_format(destination, fmt)
+    if fmt == 'snapshot':
+        count = refresh_catalog_snapshot(destination)
+        click.echo(f"Wrote {count} products to {destination}", err=True)
+        write_related_table(destination)
+        return
+    
+    count = 0
+    with click.open_file(destination, 'w', encoding='utf-8') as out:
+        writer = csv.DictWriter(out, fieldnames=CATALOG_FIELDS, extrasaction='ignore') if fmt == 'csv' else None
+        if writer:
+            writer.writeheader()
+        for page in iter_catalog_pages():
+            for row in page:
+                if writer:
+                    writer.writerow(row)
+                else:
+                    out.write(json.dumps({field: row.get(field) for field in CATALOG_FIELDS}) + '\n')
+            count += len(page)
+    click.echo(f"Exported {count} products", err=True)
+
 @app.route('/api/products', methods=['GET'])
+@admission_control
 def get_products():
     try:
-        search_query = request.args.get('search', '').strip()
+        search_query = normalize_search(request.args.get('search', ''))
+        
+        # The full listing is served straight from the shared snapshot when there is one,
+        # with any changes made since it was written merged in
+        snapshot = current_snapshot() if not search_query else None
+        if snapshot is not None:
+            incr_metric('snapshot_listings')
+            overlay, deleted = snapshot_overlay()
+            return app.response_class(snapshot.iter_listing(overlay, deleted), mimetype='application/json')
+        
+        # ?stream=1 pages through Supabase instead of materializing the whole catalog. Searches
+        # ignore it: they return one bounded page from the same matcher either way
+        if not search_query and request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+            return stream_products()
+        
+        incr_metric('search_requests')
+        
+        # Searches return one page of at most SEARCH_MAX_RESULTS; ?offset= pages through the rest
+        if search_query:
+            offset = max(0, request.args.get('offset', 0, type=int))
+            limit = max(1, min(request.args.get('limit', SEARCH_MAX_RESULTS, type=int), SEARCH_MAX_RESULTS))
+        else:
+            offset, limit = 0, None
+        
+        # Serve repeated searches (e.g. search-as-you-type) from the LRU cache
+        cache_key = (CATALOG_VERSION, search_query, offset, limit)
+        body = search_cache_get(cache_key)
+        if body is not None:
+            incr_metric('search_cache_hits')
+            return app.response_class(body, mimetype='application/json')
+        
+        # Searches are answered from the in-process trigram index, which tolerates typos
+        body = search_catalog(search_query, offset, limit) if search_query and SEARCH_FUZZY else None
+        if body is not None:
+            incr_metric('search_index_queries')
+            search_cache_put(cache_key, body)
+            return app.response_class(body, mimetype='application/json')
         
         query = supabase.table('products').select('*')
         
         if search_query:
-            query = query.ilike('title', f'%{search_query}%')
+            query = query.ilike('title', f'%{search_query}%').order('id').range(offset, offset + limit - 1)
         
-        response = query.execute()
+        incr_metric('search_backend_calls')
+        with db_slot():
+            response = query.execute()
         
         if hasattr(response, 'error') and response.error is not None:
             return jsonify({"error": "Failed to fetch products"}), 500
             
         products = response.data
+        index_products(products)
         
-        transformed_products = []
-        for product in products:
-            transformed_product = {
-                'id': product['id'],
-                'title': product['title'],
-                'price': product['price'],
-                'description': product['description'],
-                'category': product['category'],
-                'image': product['image'],
-                'rating': {
-                    'rate': product.get('rating.rate', 0),
-                    'count': product.get('rating.count', 0)
-                }
-            }
-            transformed_products.append(transformed_product)
+        transformed_products = [transform_product(product) for product in products]
         
-        return jsonify(transformed_products)
+        body = json.dumps(transformed_products, separators=(',', ':'))
+        search_cache_put(cache_key, body)
+        return app.response_class(body, mimetype='application/json')
+    except Overloaded:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/products/<int:product_id>', methods=['GET'])
+@admission_control
 def get_product(product_id):
     """API endpoint to get a single product by ID from Supabase"""
     try:
-        response = supabase.table('products').select('*').eq('id', product_id).execute()
+        with db_slot():
+            response = supabase.table('products').select('*').eq('id', product_id).execute()
         
         if hasattr(response, 'error') and response.error is not None:
             return jsonify({"error": "Failed to fetch product from database"}), 500
@@ -86,10 +1154,1144 @@ def get_product(product_id):
             return jsonify({"error": "Product not found"}), 404
             
         product = response.data[0]
+        index_products([product])
         return jsonify(product)
+    except Overloaded:
+        raise
     except Exception as e:
         return jsonify({"error": f"Failed to fetch product: {str(e)}"}), 500
 
+# ===== Related products =====
+# Products are embedded as sparse hashed TF-IDF vectors over title, description and
+# category, and every product's top-k neighbours are precomputed with tiled matrix
+# products. A lookup is then a dict access plus one row of the neighbour table.
+RELATED_TOP_K = int(os.environ.get("RELATED_TOP_K", "8"))
+RELATED_FEATURES = int(os.environ.get("RELATED_FEATURES", "1024"))
+# Products per similarity tile: RELATED_BLOCK_SIZE against RELATED_CHUNK_SIZE at a time
+RELATED_BLOCK_SIZE = 512
+RELATED_CHUNK_SIZE = 4096
+# Above this fraction of the catalog changing at once, rebuild instead of patching
+RELATED_REBUILD_FRACTION = 0.1
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+def product_terms(product):
+    """Terms used for similarity; the category is added twice so it weighs more than a word"""
+    terms = TOKEN_PATTERN.findall(f"{product.get('title') or ''} {product.get('description') or ''}".lower())
+    category = (product.get('category') or '').lower()
+    if category:
+        terms += ['category:' + category] * 2
+    return terms
+
+class RelatedIndex:
+    """Precomputed nearest neighbours over hashed TF-IDF product vectors.
+    
+    Vectors are stored sparse: product i's nonzero features and weights are
+    indices[starts[i]:ends[i]] and values[starts[i]:ends[i]]. Similarities are computed one
+    tile at a time, expanding RELATED_BLOCK_SIZE products against RELATED_CHUNK_SIZE others,
+    so memory grows with the catalog's terms rather than with products x features.
+    """
+    
+    def __init__(self, products, k=RELATED_TOP_K, features=RELATED_FEATURES):
+        products = list(products)
+        self.k = k
+        self.features = features
+        self.ids = [product['id'] for product in products]
+        self.positions = {product_id: position for position, product_id in enumerate(self.ids)}
+        self.summaries = [(product['title'], product['price'], product['image']) for product in products]
+        
+        owners, columns, counts = self._term_counts(products)
+        document_frequency = np.bincount(columns, minlength=features)
+        self.idf = (np.log((1 + len(products)) / (1 + document_frequency)) + 1).astype(np.float32)
+        self.indices = columns.astype(np.int32)
+        self.values = self._weigh(owners, columns, counts, len(products))
+        self.starts, self.ends = self._bounds(owners, len(products))
+        self.neighbors, self.scores = self._top_k(np.arange(len(products)))
+    
+    def _term_counts(self, products):
+        """Count hashed terms per product as (product, feature, count) arrays sorted by product"""
+        owners, columns = [], []
+        for position, product in enumerate(products):
+            for term in product_terms(product):
+                owners.append(position)
+                columns.append(zlib.crc32(term.encode('utf-8')) % self.features)
+        keys, counts = np.unique(np.array(owners, dtype=np.int64) * self.features + np.array(columns, dtype=np.int64),
+                                 return_counts=True)
+        return keys // self.features, keys % self.features, counts
+    
+    def _weigh(self, owners, columns, counts, size):
+        """Apply sublinear TF and IDF weighting, then L2-normalize each product's weights"""
+        values = np.log1p(counts) * self.idf[columns]
+        norms = np.sqrt(np.bincount(owners, weights=values * values, minlength=size))
+        return (values / np.maximum(norms, 1e-12)[owners]).astype(np.float32)
+    
+    @staticmethod
+    def _bounds(owners, size):
+        """Start and end of each product's entries, given entry owners sorted by product"""
+        products = np.arange(size)
+        return np.searchsorted(owners, products), np.searchsorted(owners, products, side='right')
+    
+    def _dense(self, rows):
+        """Expand the vectors of the products at rows into a (len(rows), features) matrix"""
+        starts, lengths = self.starts[rows], self.ends[rows] - self.starts[rows]
+        # Position of every entry of every row, in row order
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        dense = np.zeros((len(rows), self.features), dtype=np.float32)
+        dense[np.repeat(np.arange(len(rows)), lengths), self.indices[entries]] = self.values[entries]
+        return dense
+    
+    def _tiles(self, rows):
+        """Yield (columns, similarity of rows to the products at columns), one chunk at a time"""
+        vectors = self._dense(rows)
+        for start in range(0, len(self.ids), RELATED_CHUNK_SIZE):
+            columns = np.arange(start, min(start + RELATED_CHUNK_SIZE, len(self.ids)))
+            yield columns, vectors @ self._dense(columns).T
+    
+    def _top_k(self, rows):
+        """Compute the k most similar products for each position in rows"""
+        k = min(self.k, len(self.ids) - 1)
+        neighbors = np.zeros((len(rows), max(k, 0)), dtype=np.int32)
+        scores = np.zeros((len(rows), max(k, 0)), dtype=np.float32)
+        if k <= 0:
+            return neighbors, scores
+        
+        for start in range(0, len(rows), RELATED_BLOCK_SIZE):
+            block = rows[start:start + RELATED_BLOCK_SIZE]
+            best = np.zeros((len(block), k), dtype=np.int32)
+            best_scores = np.full((len(block), k), -np.inf, dtype=np.float32)
+            for columns, similarity in self._tiles(block):
+                own = np.flatnonzero((block >= columns[0]) & (block <= columns[-1]))
+                similarity[own, block[own] - columns[0]] = -np.inf
+                # Keep the k best of the running best and this chunk
+                candidates = np.concatenate([best_scores, similarity], axis=1)
+                candidate_ids = np.concatenate([best, np.broadcast_to(columns.astype(np.int32), similarity.shape)], axis=1)
+                top = np.argpartition(candidates, -k, axis=1)[:, -k:]
+                best = np.take_along_axis(candidate_ids, top, axis=1)
+                best_scores = np.take_along_axis(candidates, top, axis=1)
+            order = np.argsort(-best_scores, axis=1)
+            neighbors[start:start + len(block)] = np.take_along_axis(best, order, axis=1)
+            scores[start:start + len(block)] = np.take_along_axis(best_scores, order, axis=1)
+        return neighbors, scores
+    
+    def related(self, product_id, k=None):
+        """Return [(product_id, score, (title, price, image))] for the top k, or None if unknown"""
+        position = self.positions.get(product_id)
+        if position is None:
+            return None
+        k = k or self.k
+        return [
+            (self.ids[neighbor], float(score), self.summaries[neighbor])
+            for neighbor, score in zip(self.neighbors[position][:k], self.scores[position][:k])
+            if score > 0
+        ]
+    
+    def update(self, rows, deleted_ids=()):
+        """Patch the index for changed or deleted products.
+        
+        IDF weights are kept from the last full build. Changed vectors are appended to the
+        entry arrays and their old entries left unused until the next build. Returns False
+        when so much changed that the caller should rebuild from scratch instead.
+        """
+        if len(rows) + len(deleted_ids) > max(1, len(self.ids) * RELATED_REBUILD_FRACTION):
+            return False
+        
+        changed = []
+        new_rows = [row for row in rows if row['id'] not in self.positions]
+        if new_rows:
+            first = len(self.ids)
+            empty = np.zeros(len(new_rows), dtype=self.starts.dtype)
+            self.starts = np.concatenate([self.starts, empty])
+            self.ends = np.concatenate([self.ends, empty])
+            width = self.neighbors.shape[1]
+            self.neighbors = np.vstack([self.neighbors, np.zeros((len(new_rows), width), dtype=np.int32)])
+            self.scores = np.vstack([self.scores, np.zeros((len(new_rows), width), dtype=np.float32)])
+            for offset, row in enumerate(new_rows):
+                self.ids.append(row['id'])
+                self.summaries.append(None)
+                self.positions[row['id']] = first + offset
+        
+        if rows:
+            owners, columns, counts = self._term_counts(rows)
+            starts, ends = self._bounds(owners, len(rows))
+            positions = [self.positions[row['id']] for row in rows]
+            self.starts[positions] = starts + len(self.indices)
+            self.ends[positions] = ends + len(self.indices)
+            self.indices = np.concatenate([self.indices, columns.astype(np.int32)])
+            self.values = np.concatenate([self.values, self._weigh(owners, columns, counts, len(rows))])
+            for row, position in zip(rows, positions):
+                self.summaries[position] = (row['title'], row['price'], row['image'])
+            changed.extend(positions)
+        for product_id in deleted_ids:
+            position = self.positions.pop(product_id, None)
+            if position is not None:
+                # An empty vector scores 0 against everything, so it is never returned
+                self.ends[position] = self.starts[position]
+                changed.append(position)
+        if not changed:
+            return True
+        
+        # Recompute the changed products, plus any product whose neighbour list they were in
+        # or that they are now closer to than its current k-th neighbour
+        changed = np.array(changed)
+        kth_score = self.scores[:, -1] if self.scores.shape[1] else np.full(len(self.ids), np.inf)
+        affected = np.isin(self.neighbors, changed).any(axis=1)
+        for start in range(0, len(changed), RELATED_BLOCK_SIZE):
+            for columns, similarity in self._tiles(changed[start:start + RELATED_BLOCK_SIZE]):
+                affected[columns] |= (similarity > kth_score[columns]).any(axis=0)
+        affected[changed] = True
+        
+        rows_to_update = np.flatnonzero(affected)
+        neighbors, scores = self._top_k(rows_to_update)
+        if neighbors.shape[1] != self.neighbors.shape[1]:
+            # The catalog was too small for k neighbours before; rebuild the tables
+            self.neighbors, self.scores = self._top_k(np.arange(len(self.ids)))
+        else:
+            self.neighbors[rows_to_update] = neighbors
+            self.scores[rows_to_update] = scores
+        return True
+    
+    @property
+    def nbytes(self):
+        """Memory held by the numeric arrays"""
+        return (self.indices.nbytes + self.values.nbytes + self.starts.nbytes + self.ends.nbytes
+                + self.neighbors.nbytes + self.scores.nbytes + self.idf.nbytes)
+    
+    def table(self):
+        """Return the neighbour lists as a structured array sorted by product id"""
+        live = np.array(sorted(self.positions.values()), dtype=np.intp)
+        ids = np.asarray(self.ids, dtype=np.int64)
+        table = np.zeros(len(live), dtype=related_table_dtype(self.neighbors.shape[1]))
+        table['id'] = ids[live]
+        table['neighbors'] = ids[self.neighbors[live]]
+        table['scores'] = self.scores[live]
+        return table[np.argsort(table['id'], kind='stable')]
+
+# With a catalog snapshot, the neighbour table is computed once per snapshot, outside the
+# web workers, and written beside it as <snapshot>.related.npy. Workers map it read-only,
+# so they share one copy through the page cache and never hold the TF-IDF vectors. Without
+# a snapshot, a table written ahead of time with `flask catalog related --output` can be
+# deployed with the app and named by RELATED_TABLE_PATH. Failing that, the index is built
+# in a background thread per process, and requests get a 503 until it is ready; later
+# rebuilds keep serving the old copy. That is off on Vercel, where a function is frozen
+# between requests and such a build might never finish.
+RELATED_TABLE_PATH = os.environ.get("RELATED_TABLE_PATH", "")
+RELATED_IN_PROCESS = os.environ.get("RELATED_IN_PROCESS", "0" if os.environ.get("VERCEL") else "1") != "0"
+RELATED_TABLE = None
+RELATED_TABLE_CHECKED_AT = float('-inf')
+RELATED_BUILD_PROCESS = None
+RELATED_INDEX = None
+RELATED_BUILD_THREAD = None
+# Changes that arrive while a background build runs, applied to the new index when it is done
+RELATED_PENDING = []
+RELATED_LOCK = threading.Lock()
+RELATED_RETRY_AFTER = 5
+
+class RelatedNotReady(Exception):
+    """Raised while no neighbour table or index is available yet"""
+
+def related_table_dtype(width):
+    """Record layout of the neighbour table: id, neighbour ids and their scores"""
+    return np.dtype([('id', '<i8'), ('neighbors', '<i8', (width,)), ('scores', '<f4', (width,))])
+
+def related_table_path(snapshot_path):
+    """The neighbour table written beside a snapshot file"""
+    return snapshot_path + '.related.npy'
+
+def related_table_file():
+    """The neighbour table to serve: the one beside the snapshot, else RELATED_TABLE_PATH"""
+    return related_table_path(CATALOG_SNAPSHOT_PATH) if CATALOG_SNAPSHOT_PATH else RELATED_TABLE_PATH
+
+def write_related_table(snapshot_path):
+    """Compute every product's neighbours from a snapshot file and write them beside it"""
+    products = (json.loads(data) for _, data in CatalogSnapshot(snapshot_path).iter_merged({}, ()))
+    return save_related_table(products, related_table_path(snapshot_path))
+
+def save_related_table(products, path):
+    """Compute every product's neighbours and atomically write the table to path"""
+    table = RelatedIndex(products).table()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            np.save(out, table)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return len(table)
+
+def start_related_table_build(snapshot_path=None):
+    """Write the neighbour table for a snapshot in a separate process.
+    
+    A process rather than a thread keeps the O(n^2) build out of the web workers' CPU time
+    and the GIL, and is safe to start from the gunicorn master before it forks.
+    """
+    global RELATED_BUILD_PROCESS
+    snapshot_path = snapshot_path or CATALOG_SNAPSHOT_PATH
+    with RELATED_LOCK:
+        if RELATED_BUILD_PROCESS is not None and RELATED_BUILD_PROCESS.poll() is None:
+            return RELATED_BUILD_PROCESS
+        RELATED_BUILD_PROCESS = subprocess.Popen(
+            [sys.executable, '-m', 'flask', '--app', os.path.abspath(__file__),
+             'catalog', 'related', '--path', snapshot_path])
+        return RELATED_BUILD_PROCESS
+
+def current_related_table():
+    """Return the mapped neighbour table for the current snapshot, or None if there is none yet"""
+    global RELATED_TABLE, RELATED_TABLE_CHECKED_AT
+    if time.monotonic() - RELATED_TABLE_CHECKED_AT < CATALOG_SNAPSHOT_CHECK_INTERVAL:
+        return RELATED_TABLE and RELATED_TABLE[1]
+    
+    with RELATED_LOCK:
+        RELATED_TABLE_CHECKED_AT = time.monotonic()
+        path = related_table_file()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            RELATED_TABLE = None
+            return None
+        
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if RELATED_TABLE is None or RELATED_TABLE[0] != identity:
+            try:
+                RELATED_TABLE = (identity, np.load(path, mmap_mode='r'))
+            except (OSError, ValueError) as e:
+                app.logger.warning("Could not map related products table: %s", e)
+    return RELATED_TABLE and RELATED_TABLE[1]
+
+def table_related(table, product_id, k):
+    """Look a product up in a neighbour table; None if it isn't there"""
+    ids = table['id']
+    position = int(np.searchsorted(ids, product_id))
+    if position == len(ids) or ids[position] != product_id:
+        return None
+    
+    record = table[position]
+    neighbors = [(neighbor, score) for neighbor, score in zip(record['neighbors'].tolist(), record['scores'].tolist())
+                 if score > 0]
+    # Summaries come from the overlay or snapshot, so edits show before the next rebuild
+    summaries = {neighbor: cached_cart_product(neighbor) for neighbor, _ in neighbors}
+    missing = [neighbor for neighbor, summary in summaries.items()
+               if summary is None and neighbor not in DELETED_PRODUCTS]
+    if missing and current_snapshot() is None:
+        # A deployed table without a snapshot: look the products up once, then keep them
+        summaries.update(fetch_product_summaries(missing))
+    return [(neighbor, score, summaries[neighbor]) for neighbor, score in neighbors
+            if summaries.get(neighbor) is not None][:k]
+
+def fetch_product_summaries(product_ids):
+    """Fetch {id: (title, price, image)} from Supabase and record them in the product index"""
+    with db_slot():
+        response = supabase.table('products').select('id,title,price,image').in_('id', product_ids).execute()
+    if hasattr(response, 'error') and response.error is not None:
+        raise RuntimeError("Failed to fetch related products")
+    index_products(response.data)
+    return {row['id']: (row['title'], row['price'], row['image']) for row in response.data}
+
+def iter_catalog_products(metric=None):
+    """Yield every transformed product, from the snapshot when it is current or else Supabase.
+    
+    When given, metric is incremented for every page read from Supabase.
+    """
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        overlay, deleted = snapshot_overlay()
+        for _, data in snapshot.iter_merged(overlay, deleted):
+            yield json.loads(data)
+    else:
+        for page in iter_catalog_pages():
+            if metric:
+                incr_metric(metric)
+            for product in page:
+                yield transform_product(product)
+
+def related_index():
+    """Return the in-process related index, or None while its first build is running"""
+    if RELATED_INDEX is None:
+        start_related_build()
+    return RELATED_INDEX
+
+def start_related_build():
+    """Build the in-process related index in a background thread unless one is running"""
+    global RELATED_BUILD_THREAD
+    with RELATED_LOCK:
+        if RELATED_BUILD_THREAD is not None and RELATED_BUILD_THREAD.is_alive():
+            return
+        RELATED_PENDING.clear()
+        RELATED_BUILD_THREAD = threading.Thread(target=build_related_index, name='related-index', daemon=True)
+        RELATED_BUILD_THREAD.start()
+
+def build_related_index():
+    """Build a fresh related index and swap it in once it is complete"""
+    global RELATED_INDEX
+    try:
+        index = RelatedIndex(iter_catalog_products())
+    except Exception as e:
+        app.logger.warning("Related products index build failed: %s", e)
+        return
+    with RELATED_LOCK:
+        for rows, deleted_ids in RELATED_PENDING:
+            index.update(rows, deleted_ids)
+        RELATED_PENDING.clear()
+        RELATED_INDEX = index
+
+def find_related(product_id, k):
+    """Return the product's neighbours, or None if it is unknown.
+    
+    Raises RelatedNotReady until a neighbour table or the first in-process build is ready.
+    """
+    if related_table_file():
+        if product_id in DELETED_PRODUCTS:
+            return None
+        table = current_related_table()
+        if table is None:
+            raise RelatedNotReady()
+        related = table_related(table, product_id, k)
+        if related is None and cached_cart_product(product_id) is not None:
+            # Added after the table was built; it gets neighbours with the next snapshot
+            return []
+        return related
+    
+    if not RELATED_IN_PROCESS:
+        # No table to serve and no in-process build; the product simply has no suggestions
+        return []
+    index = related_index()
+    if index is None:
+        raise RelatedNotReady()
+    with RELATED_LOCK:
+        return index.related(product_id, k)
+
+def update_related_index(rows, deleted_ids):
+    """Catalog change listener that patches the in-process index, or rebuilds it in the background"""
+    with RELATED_LOCK:
+        if RELATED_BUILD_THREAD is not None and RELATED_BUILD_THREAD.is_alive():
+            RELATED_PENDING.append((rows, deleted_ids))
+        if RELATED_INDEX is None or RELATED_INDEX.update(rows, deleted_ids):
+            return
+    # The current index keeps serving until the rebuild replaces it
+    start_related_build()
+
+CATALOG_CHANGE_LISTENERS.append(update_related_index)
+
+# ===== Fuzzy search =====
+# Titles and categories are split into words and each word, padded as "  word ", into
+# trigrams. Postings are stored CSR-style in numpy arrays, so a query is a handful of slices,
+# a bincount of shared trigrams per product and a sort. Products matching the query as a
+# substring rank first, then by the fraction of the query's trigrams they contain, then by
+# Dice similarity, which prefers shorter titles.
+SEARCH_FUZZY = os.environ.get("SEARCH_FUZZY", "1") != "0"
+# Fraction of the query's trigrams a product must contain to match without a substring hit
+SEARCH_MIN_SIMILARITY = float(os.environ.get("SEARCH_MIN_SIMILARITY", "0.4"))
+# Most results returned for one search; a short query can match a large share of the catalog
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", "100"))
+# Above this fraction of the catalog changed since the last build, rebuild instead of patching
+SEARCH_REBUILD_FRACTION = 0.1
+
+def search_text(product):
+    """Normalized words searched for a product: its title followed by its category"""
+    return ' '.join(TOKEN_PATTERN.findall(f"{product.get('title') or ''} {product.get('category') or ''}".lower()))
+
+def trigrams(text):
+    """Return the set of padded word trigrams of normalized text"""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class SearchIndex:
+    """Trigram index over product titles and categories with ranked, typo-tolerant lookup.
+    
+    With payloads=False the index holds no product JSON, and listing() reads results from
+    the mapped snapshot and its overlay instead.
+    """
+    
+    def __init__(self, products, payloads=True):
+        self.ids = []
+        self.positions = {}
+        self.texts = []
+        # Each product's response JSON, so results are joined without re-serializing
+        self.payloads = [] if payloads else None
+        self.grams = {}
+        sizes = array('i')
+        gram_column = array('i')
+        doc_column = array('i')
+        for product in products:
+            position = self._add(product)
+            grams = [self.grams.setdefault(gram, len(self.grams)) for gram in trigrams(self.texts[position])]
+            gram_column.extend(grams)
+            doc_column.extend([position] * len(grams))
+            sizes.append(len(grams))
+        
+        gram_column = np.frombuffer(gram_column, dtype=np.int32)
+        order = np.argsort(gram_column, kind='stable')
+        self.postings = np.frombuffer(doc_column, dtype=np.int32)[order]
+        self.offsets = np.zeros(len(self.grams) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(gram_column, minlength=len(self.grams)), out=self.offsets[1:])
+        # (product count, trigram counts, live mask), replaced as one tuple by update() so a
+        # query running alongside an update sees either the old or the new state, never a mix
+        self.state = (len(self.ids), np.frombuffer(sizes, dtype=np.int32).copy(), np.ones(len(self.ids), dtype=bool))
+        # Postings of products added since the build: gram id -> [positions]
+        self.extra = {}
+        self.changed = 0
+    
+    def _add(self, product):
+        """Append a product's id, text and payload, returning its position"""
+        position = len(self.ids)
+        self.ids.append(product['id'])
+        self.positions[product['id']] = position
+        self.texts.append(search_text(product))
+        if self.payloads is not None:
+            self.payloads.append(json.dumps(product, separators=(',', ':')).encode('utf-8'))
+        return position
+    
+    def _postings(self, gram_id):
+        """Positions of products containing a trigram, including ones added since the build"""
+        postings = self.postings[self.offsets[gram_id]:self.offsets[gram_id + 1]] if gram_id + 1 < len(self.offsets) else self.postings[:0]
+        extra = self.extra.get(gram_id)
+        return np.concatenate([postings, np.array(extra, dtype=np.int32)]) if extra else postings
+    
+    def search(self, query):
+        """Return the positions of products matching query, best first.
+        
+        Safe to call while update() runs: postings of products appended after the state was
+        read are counted and then cut off.
+        """
+        count, sizes, alive = self.state
+        phrase = ' '.join(TOKEN_PATTERN.findall(query.lower()))
+        query_grams = trigrams(phrase)
+        known = [self.grams[gram] for gram in query_grams if gram in self.grams]
+        if not known:
+            return np.zeros(0, dtype=np.intp)
+        
+        shared = np.bincount(np.concatenate([self._postings(gram) for gram in known]), minlength=count)[:count]
+        keep = shared >= SEARCH_MIN_SIMILARITY * len(query_grams)
+        
+        # Every 3-character window of the phrase occurs in a product containing it, so a
+        # product holding all of them is treated as a substring match
+        windows = {phrase[i:i + 3] for i in range(len(phrase) - 2) if ' ' not in phrase[i:i + 3]}
+        if windows and all(window in self.grams for window in windows):
+            window_hits = np.bincount(np.concatenate([self._postings(self.grams[window]) for window in windows]),
+                                      minlength=count)[:count]
+            substring = window_hits == len(windows)
+            keep |= substring
+        else:
+            substring = None
+        keep &= alive
+        
+        matches = np.flatnonzero(keep)
+        shared = shared[matches]
+        # Substring matches first, then containment; Dice only breaks containment ties, which
+        # differ by at least 1 / len(query_grams)
+        score = shared / len(query_grams) + 1e-3 * (2 * shared / (len(query_grams) + sizes[matches]))
+        if substring is not None:
+            score += 2 * substring[matches]
+        order = np.argsort(-score, kind='stable')
+        return matches[order]
+    
+    def listing(self, positions):
+        """Serialize the products at positions as a JSON array, or None if there is no snapshot to read"""
+        if self.payloads is not None:
+            return b'[' + b','.join(self.payloads[position] for position in positions) + b']'
+        
+        snapshot = current_snapshot()
+        if snapshot is None:
+            return None
+        parts = []
+        with CACHE_LOCK:
+            for position in positions:
+                product_id = self.ids[position]
+                changed = SNAPSHOT_OVERLAY.get(product_id)
+                if changed is not None:
+                    parts.append(json.dumps(changed[1], separators=(',', ':')).encode('utf-8'))
+                elif product_id not in DELETED_PRODUCTS:
+                    data = snapshot.data(product_id)
+                    if data is not None:
+                        parts.append(data)
+        return b'[' + b','.join(parts) + b']'
+    
+    def update(self, rows, deleted_ids=()):
+        """Patch the index for changed or deleted products.
+        
+        Changed products are appended and their old entries masked out, both published at
+        once by replacing self.state. Callers serialize updates; queries need no lock.
+        Returns False once enough has changed since the build that the caller should
+        rebuild instead.
+        """
+        self.changed += len(rows) + len(deleted_ids)
+        if self.changed > max(1, len(self.ids) * SEARCH_REBUILD_FRACTION):
+            return False
+        
+        replaced = [self.positions.pop(product_id, None) for product_id in chain(deleted_ids, (row['id'] for row in rows))]
+        
+        added = []
+        for row in rows:
+            position = self._add(transform_product(row))
+            grams = trigrams(self.texts[position])
+            for gram in grams:
+                self.extra.setdefault(self.grams.setdefault(gram, len(self.grams)), []).append(position)
+            added.append(len(grams))
+        
+        count, sizes, alive = self.state
+        alive = np.concatenate([alive, np.ones(len(added), dtype=bool)])
+        alive[[position for position in replaced if position is not None]] = False
+        self.state = (count + len(added), np.concatenate([sizes, np.array(added, dtype=np.int32)]), alive)
+        return True
+    
+    @property
+    def nbytes(self):
+        """Approximate memory held by the index: arrays, payload and text strings, and the maps"""
+        _, sizes, alive = self.state
+        arrays = self.postings.nbytes + self.offsets.nbytes + sizes.nbytes + alive.nbytes
+        payloads = self.payloads or ()
+        containers = (self.ids, self.positions, self.texts, payloads, self.grams, self.extra)
+        objects = chain(self.ids, self.positions.values(), self.texts, payloads,
+                        self.grams, self.grams.values(), self.extra.values())
+        return arrays + sum(map(sys.getsizeof, containers)) + sum(map(sys.getsizeof, objects))
+
+# The index is built in a background thread and swapped in when complete; until the first
+# build finishes, searches fall back to a plain ilike query. Queries read SEARCH_INDEX
+# without a lock. SEARCH_INDEX_LOCK serializes updates and the swap, and changes that
+# arrive during a build are queued in SEARCH_PENDING and replayed onto the new index.
+SEARCH_INDEX = None
+SEARCH_INDEX_LOCK = threading.Lock()
+SEARCH_BUILD_THREAD = None
+SEARCH_PENDING = []
+
+def search_catalog(search_query, offset=0, limit=None):
+    """Return the JSON listing of one page of products matching search_query, best first,
+    or None until the index is built"""
+    index = SEARCH_INDEX
+    if index is None:
+        start_search_build()
+        return None
+    limit = limit or SEARCH_MAX_RESULTS
+    body = index.listing(index.search(search_query)[offset:offset + limit])
+    if body is None:
+        # Built over a snapshot that has since gone; rebuild from Supabase
+        start_search_build()
+    return body
+
+def start_search_build():
+    """Build the search index in a background thread unless a build is already running"""
+    global SEARCH_BUILD_THREAD
+    with SEARCH_INDEX_LOCK:
+        if SEARCH_BUILD_THREAD is not None and SEARCH_BUILD_THREAD.is_alive():
+            return
+        # Cleared here rather than in the thread, so no change queued after this point is lost
+        SEARCH_PENDING.clear()
+        SEARCH_BUILD_THREAD = threading.Thread(target=build_search_index, name='search-index', daemon=True)
+        SEARCH_BUILD_THREAD.start()
+
+def build_search_index():
+    """Build a fresh index from one catalog scan, catch it up and swap it in"""
+    global SEARCH_INDEX
+    while True:
+        try:
+            # With a snapshot mapped, results are read from it rather than held per process
+            index = SearchIndex(iter_catalog_products(metric='search_backend_calls'),
+                                payloads=current_snapshot() is None)
+        except Exception as e:
+            # The old index, or the ilike fallback, keeps serving; the next search retries
+            app.logger.warning("Search index build failed: %s", e)
+            return
+        
+        with SEARCH_INDEX_LOCK:
+            caught_up = all(index.update(rows, deleted_ids) for rows, deleted_ids in SEARCH_PENDING)
+            SEARCH_PENDING.clear()
+            if caught_up:
+                SEARCH_INDEX = index
+                break
+        # Too much changed during the build to patch in; scan again
+    # Listings cached from the old index or the fallback may differ from the new index
+    bump_catalog_version()
+
+def update_search_index(rows, deleted_ids):
+    """Catalog change listener that patches the search index, or rebuilds it in the background"""
+    with SEARCH_INDEX_LOCK:
+        if SEARCH_BUILD_THREAD is not None and SEARCH_BUILD_THREAD.is_alive():
+            SEARCH_PENDING.append((rows, deleted_ids))
+        if SEARCH_INDEX is None or SEARCH_INDEX.update(rows, deleted_ids):
+            return
+    # The current index keeps serving until the rebuild replaces it
+    start_search_build()
+
+CATALOG_CHANGE_LISTENERS.append(update_search_index)
+
+@app.route('/api/products/<int:product_id>/related', methods=['GET'])
+@admission_control
+def get_related_products(product_id):
+    """API endpoint to get the products most similar to a product"""
+    k = max(1, min(request.args.get('k', RELATED_TOP_K, type=int), RELATED_TOP_K))
+    try:
+        related = find_related(product_id, k)
+    except RelatedNotReady:
+        response = jsonify({"error": "Related products are still being computed"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(RELATED_RETRY_AFTER)
+        return response
+    except Overloaded:
+        raise
+    except Exception as e:
+        return jsonify({"error": f"Failed to load related products: {str(e)}"}), 500
+    
+    if related is None:
+        return jsonify({"error": "Product not found"}), 404
+    
+    return jsonify([
+        {'id': related_id, 'title': title, 'price': price, 'image': image, 'score': round(score, 4)}
+        for related_id, score, (title, price, image) in related
+    ])
+
+# ===== Product thumbnails =====
+# Resized, recompressed variants of images stored under PRODUCT_IMAGE_DIR. Each variant is
+# written once to THUMBNAIL_CACHE_DIR under a hash of the source bytes and the variant
+# parameters, so a replaced source image produces new files and old ones are never served.
+# Product JSON names local images with ?v=<source digest>, which the client passes on to
+# /api/images. A URL naming the current digest always gets the same bytes, so it is cached
+# for a year as immutable; a replaced image gets a new URL rather than waiting out a cache.
+# Unversioned or outdated URLs (e.g. from a snapshot written before the image changed) are
+# kept for THUMBNAIL_MAX_AGE seconds and then revalidated by ETag, the variant's hash.
+# Least recently used variants are deleted once the directory grows past
+# THUMBNAIL_CACHE_MAX_BYTES.
+LOCAL_IMAGE_PREFIX = '/static/images/'
+PRODUCT_IMAGE_DIR = os.environ.get("PRODUCT_IMAGE_DIR", os.path.join(app.static_folder, 'images'))
+THUMBNAIL_CACHE_DIR = os.environ.get("THUMBNAIL_CACHE_DIR", os.path.join(tempfile.gettempdir(), 'sploosh-thumbnails'))
+THUMBNAIL_WIDTHS = (160, 320, 640)
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_MAX_AGE = int(os.environ.get("THUMBNAIL_MAX_AGE", "300"))
+THUMBNAIL_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+THUMBNAIL_VERSION_LENGTH = 16
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get("THUMBNAIL_CACHE_MAX_BYTES", str(512 * 2**20)))
+# A cache hit refreshes the variant's mtime, which eviction orders by, at most this often
+THUMBNAIL_TOUCH_INTERVAL = 3600
+THUMBNAIL_FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpeg': ('JPEG', 'image/jpeg')}
+THUMBNAIL_SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+# Resizing is CPU bound; cap concurrent encodes so a cold grid can't starve other requests
+THUMBNAIL_WORKERS = threading.BoundedSemaphore(int(os.environ.get("THUMBNAIL_WORKERS", "2")))
+THUMBNAIL_LOCK = threading.Lock()
+# (path, mtime_ns, size) -> sha256 of the source, so sources are only hashed when they change
+SOURCE_DIGESTS = {}
+# Bytes in THUMBNAIL_CACHE_DIR as of the last scan plus what this process has written since;
+# None until the first render
+THUMBNAIL_CACHE_BYTES = None
+
+def source_digest(path):
+    """Return the sha256 hex digest of a source image, memoized on its mtime and size"""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with THUMBNAIL_LOCK:
+        digest = SOURCE_DIGESTS.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(1 << 16), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with THUMBNAIL_LOCK:
+            SOURCE_DIGESTS[key] = digest
+    return digest
+
+def versioned_image(image):
+    """Add ?v=<source digest> to a local product image URL; other images are returned as is"""
+    if not isinstance(image, str) or not image.startswith(LOCAL_IMAGE_PREFIX):
+        return image
+    name = image[len(LOCAL_IMAGE_PREFIX):].split('?', 1)[0]
+    source_path = safe_join(PRODUCT_IMAGE_DIR, name)
+    if source_path is None or not os.path.isfile(source_path):
+        return image
+    return f"{LOCAL_IMAGE_PREFIX}{name}?v={source_digest(source_path)[:THUMBNAIL_VERSION_LENGTH]}"
+
+def prune_thumbnail_cache(keep=None):
+    """Delete the least recently used variants until the cache is under 90% of its limit.
+    
+    The variant at keep, just rendered for a waiting request, is never deleted. Returns the
+    bytes left in the cache directory.
+    """
+    entries = []
+    with os.scandir(THUMBNAIL_CACHE_DIR) as scan:
+        for entry in scan:
+            if entry.name.endswith('.tmp') or entry.path == keep:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries) + (os.path.getsize(keep) if keep else 0)
+    if total > THUMBNAIL_CACHE_MAX_BYTES:
+        for _, size, path in sorted(entries):
+            if total <= THUMBNAIL_CACHE_MAX_BYTES * 0.9:
+                break
+            try:
+                os.remove(path)
+                incr_metric('thumbnails_evicted')
+            except FileNotFoundError:
+                pass
+            total -= size
+    return total
+
+def record_thumbnail(path):
+    """Count a newly rendered variant, pruning the cache once it is over THUMBNAIL_CACHE_MAX_BYTES"""
+    global THUMBNAIL_CACHE_BYTES
+    with THUMBNAIL_LOCK:
+        if THUMBNAIL_CACHE_BYTES is not None:
+            THUMBNAIL_CACHE_BYTES += os.path.getsize(path)
+            if THUMBNAIL_CACHE_BYTES <= THUMBNAIL_CACHE_MAX_BYTES:
+                return
+        # Other processes write to the same directory, so measure it rather than trust the count
+        THUMBNAIL_CACHE_BYTES = prune_thumbnail_cache(keep=path)
+
+def thumbnail_format():
+    """Pick the output format from ?fmt= or the Accept header; returns (name, negotiated)"""
+    fmt = request.args.get('fmt', '').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt:
+        return fmt, False
+    return ('webp' if request.accept_mimetypes['image/webp'] else 'jpeg'), True
+
+def render_thumbnail(source_path, width, fmt, dest):
+    """Resize source_path to at most width pixels wide and write it to dest atomically"""
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        
+        pil_format, _ = THUMBNAIL_FORMATS[fmt]
+        if fmt == 'jpeg':
+            # JPEG has no alpha channel; flatten transparent images onto white
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            options = {'quality': THUMBNAIL_QUALITY, 'optimize': True, 'progressive': True}
+        else:
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            options = {'quality': THUMBNAIL_QUALITY, 'method': 4}
+        
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                image.save(output, pil_format, **options)
+            os.replace(tmp_path, dest)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+@app.route('/api/images/<path:filename>', methods=['GET'])
+def get_thumbnail(filename):
+    """Serve a resized variant of a local product image (?w=160|320|640&fmt=webp|jpeg&v=<digest>)"""
+    width = request.args.get('w', THUMBNAIL_WIDTHS[1], type=int)
+    if width not in THUMBNAIL_WIDTHS:
+        return jsonify({"error": f"Width must be one of {', '.join(map(str, THUMBNAIL_WIDTHS))}"}), 400
+    fmt, negotiated = thumbnail_format()
+    if fmt not in THUMBNAIL_FORMATS:
+        return jsonify({"error": "Format must be webp or jpeg"}), 400
+    
+    source_path = safe_join(PRODUCT_IMAGE_DIR, filename)
+    if (source_path is None or not source_path.lower().endswith(THUMBNAIL_SOURCE_EXTENSIONS)
+            or not os.path.isfile(source_path)):
+        return jsonify({"error": "Image not found"}), 404
+    
+    try:
+        source = source_digest(source_path)
+        variant = f"{source}:{width}:{fmt}:{THUMBNAIL_QUALITY}"
+        digest = hashlib.sha256(variant.encode()).hexdigest()[:32]
+        dest = os.path.join(THUMBNAIL_CACHE_DIR, f"{digest}.{fmt}")
+        immutable = request.args.get('v') == source[:THUMBNAIL_VERSION_LENGTH]
+        
+        # A second attempt covers a variant evicted between the check and send_file
+        for attempt in range(2):
+            try:
+                modified = os.stat(dest).st_mtime
+            except FileNotFoundError:
+                os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+                with THUMBNAIL_WORKERS:
+                    # Another request may have rendered it while we waited
+                    if not os.path.exists(dest):
+                        render_thumbnail(source_path, width, fmt, dest)
+                        incr_metric('thumbnails_generated')
+                        record_thumbnail(dest)
+            else:
+                incr_metric('thumbnail_cache_hits')
+                if time.time() - modified > THUMBNAIL_TOUCH_INTERVAL:
+                    os.utime(dest)
+            
+            try:
+                response = send_file(dest, mimetype=THUMBNAIL_FORMATS[fmt][1], etag=digest,
+                                     max_age=THUMBNAIL_IMMUTABLE_MAX_AGE if immutable else THUMBNAIL_MAX_AGE,
+                                     conditional=True)
+                break
+            except FileNotFoundError:
+                if attempt:
+                    raise
+    except (UnidentifiedImageError, Image.DecompressionBombError):
+        return jsonify({"error": "Unsupported image"}), 415
+    except Exception as e:
+        return jsonify({"error": f"Failed to create thumbnail: {str(e)}"}), 500
+    
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    if negotiated:
+        response.vary.add('Accept')
+    return response
+
+# ===== Cart persistence =====
+# With CART_STORE_DIR set, every cart mutation appends the user's whole cart to a write-ahead
+# log (one JSON line, flushed but not fsynced). Every CART_SNAPSHOT_INTERVAL seconds or
+# CART_SNAPSHOT_EVERY records, the log is rotated and the store is written in the background
+# as gzipped JSON. Each worker restores the snapshot plus the logs in a background thread on
+# its first cart request. Cart endpoints wait up to CART_RESTORE_TIMEOUT for it and answer 503
+# past that, so nothing is logged before the restored sequence number is known. The
+# directory belongs to a single process, just as CARTS does: the first process to restore
+# takes an exclusive lock on it, and any other gets 503 on cart endpoints (only) until that
+# process exits. gunicorn.conf.py refuses to start more than one worker with a store.
+CART_STORE_DIR = os.environ.get("CART_STORE_DIR", "")
+CART_SNAPSHOT_INTERVAL = float(os.environ.get("CART_SNAPSHOT_INTERVAL", "60"))
+CART_SNAPSHOT_EVERY = int(os.environ.get("CART_SNAPSHOT_EVERY", "1000"))
+CART_RESTORE_TIMEOUT = float(os.environ.get("CART_RESTORE_TIMEOUT", "5"))
+CART_SNAPSHOT_FILE = 'carts.json.gz'
+CART_WAL_FILE = 'carts.wal'
+CART_ROTATED_WAL_FILE = 'carts.wal.1'
+CART_STORE_LOCK_FILE = 'carts.lock'
+
+CART_LOCK = threading.Lock()
+CART_RESTORED = threading.Event()
+CART_RESTORE_STARTED = False
+CART_WAL = None
+CART_WAL_RECORDS = 0
+CART_SEQUENCE = 0
+CART_SNAPSHOT_AT = time.monotonic()
+CART_SNAPSHOT_THREAD = None
+CART_STORE_LOCK = None
+
+class CartsUnavailable(Exception):
+    """Raised when another process owns CART_STORE_DIR, or carts are still being restored"""
+
+@app.errorhandler(CartsUnavailable)
+def handle_carts_unavailable(e):
+    """Ask the client to retry once the store is free (e.g. an old worker finished draining)"""
+    response = jsonify({"error": "Carts are unavailable, please retry shortly"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+def cart_store_path(name):
+    return os.path.join(CART_STORE_DIR, name)
+
+def lock_cart_store():
+    """Take an exclusive lock on CART_STORE_DIR for this process; False if another holds it"""
+    global CART_STORE_LOCK
+    if CART_STORE_LOCK is None and fcntl is not None:
+        os.makedirs(CART_STORE_DIR, exist_ok=True)
+        lock = open(cart_store_path(CART_STORE_LOCK_FILE), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+        CART_STORE_LOCK = lock
+    return True
+
+def restore_carts():
+    """Load the cart snapshot and replay the write-ahead logs into CARTS"""
+    global CART_SEQUENCE
+    try:
+        restored, versions, sequence = {}, {}, 0
+        try:
+            with gzip.open(cart_store_path(CART_SNAPSHOT_FILE), 'rt', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            restored, versions, sequence = snapshot['carts'], snapshot.get('versions', {}), snapshot['seq']
+        except FileNotFoundError:
+            pass
+        
+        snapshot_sequence = sequence
+        for name in (CART_ROTATED_WAL_FILE, CART_WAL_FILE):
+            try:
+                with open(cart_store_path(name), encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # A torn write from a crash; records appended after it still replay
+                            continue
+                        # Records already folded into the snapshot are skipped
+                        if record['s'] <= snapshot_sequence:
+                            continue
+                        sequence = max(sequence, record['s'])
+                        versions[record['u']] = record.get('v', 0)
+                        if record['c']:
+                            restored[record['u']] = record['c']
+                        else:
+                            restored.pop(record['u'], None)
+            except FileNotFoundError:
+                pass
+        
+        with CART_LOCK:
+            CART_SEQUENCE = max(CART_SEQUENCE, sequence)
+            # Cart endpoints wait for restore, so nothing in CARTS is newer than this
+            CARTS.update(restored)
+        with CART_CONDITION:
+            for user_id, version in versions.items():
+                CART_VERSIONS[user_id] = max(CART_VERSIONS.get(user_id, 0), version)
+    except Exception as e:
+        app.logger.warning("Could not restore carts: %s", e)
+    finally:
+        CART_RESTORED.set()
+
+def start_cart_restore():
+    """Begin restoring carts in the background, once per process"""
+    global CART_RESTORE_STARTED
+    with CART_LOCK:
+        if CART_RESTORE_STARTED:
+            return
+        if CART_STORE_DIR and not lock_cart_store():
+            # Not latched: a later request retries once the other process is gone
+            raise CartsUnavailable()
+        CART_RESTORE_STARTED = True
+    
+    if CART_STORE_DIR:
+        threading.Thread(target=restore_carts, name='cart-restore', daemon=True).start()
+    else:
+        CART_RESTORED.set()
+
+def wait_for_carts():
+    """Block cart endpoints until restored carts are in place, or raise CartsUnavailable"""
+    start_cart_restore()
+    if not CART_RESTORED.wait(CART_RESTORE_TIMEOUT):
+        # Mutating now would log records numbered below the restored sequence, and be skipped
+        raise CartsUnavailable()
+
+def write_cart_snapshot(carts, versions, sequence):
+    """Write a gzipped snapshot of carts and drop the log it supersedes"""
+    global CART_SNAPSHOT_THREAD
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=CART_STORE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=1) as f:
+                snapshot = {'seq': sequence, 'carts': carts, 'versions': versions}
+                f.write(json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+            os.replace(tmp_path, cart_store_path(CART_SNAPSHOT_FILE))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        os.remove(cart_store_path(CART_ROTATED_WAL_FILE))
+    except Exception as e:
+        # The rotated log is kept, so nothing is lost; the next snapshot retries
+        app.logger.warning("Could not snapshot carts: %s", e)
+    finally:
+        CART_SNAPSHOT_THREAD = None
+
+def log_cart(user_id):
+    """Append the user's cart to the write-ahead log, snapshotting the store when due"""
+    global CART_WAL, CART_WAL_RECORDS, CART_SEQUENCE, CART_SNAPSHOT_AT, CART_SNAPSHOT_THREAD
+    if not CART_STORE_DIR:
+        return
+    
+    with CART_LOCK:
+        if CART_WAL is None:
+            os.makedirs(CART_STORE_DIR, exist_ok=True)
+            CART_WAL = open(cart_store_path(CART_WAL_FILE), 'a', encoding='utf-8')
+        CART_SEQUENCE += 1
+        record = {'s': CART_SEQUENCE, 'u': user_id, 'v': CART_VERSIONS.get(user_id, 0), 'c': CARTS.get(user_id, [])}
+        CART_WAL.write(json.dumps(record, separators=(',', ':')) + '\n')
+        CART_WAL.flush()
+        CART_WAL_RECORDS += 1
+        
+        due = (CART_WAL_RECORDS >= CART_SNAPSHOT_EVERY
+               or time.monotonic() - CART_SNAPSHOT_AT >= CART_SNAPSHOT_INTERVAL)
+        # Until restore finishes CARTS is missing carts that only the files on disk hold
+        if not due or CART_SNAPSHOT_THREAD is not None or not CART_RESTORED.is_set():
+            return
+        
+        CART_WAL.close()
+        if os.path.exists(cart_store_path(CART_ROTATED_WAL_FILE)):
+            # The last snapshot failed, so its log is still needed: append this one to it, and
+            # the snapshot below, which covers both, removes it
+            with open(cart_store_path(CART_WAL_FILE), 'rb') as wal, \
+                    open(cart_store_path(CART_ROTATED_WAL_FILE), 'ab') as rotated:
+                shutil.copyfileobj(wal, rotated)
+            os.remove(cart_store_path(CART_WAL_FILE))
+        else:
+            os.replace(cart_store_path(CART_WAL_FILE), cart_store_path(CART_ROTATED_WAL_FILE))
+        CART_WAL = open(cart_store_path(CART_WAL_FILE), 'a', encoding='utf-8')
+        CART_WAL_RECORDS = 0
+        CART_SNAPSHOT_AT = time.monotonic()
+        # Cart handlers mutate CARTS without CART_LOCK, so iterate over a copy
+        carts = {user: [dict(item) for item in list(cart)] for user, cart in list(CARTS.items()) if cart}
+        versions = {user: CART_VERSIONS.get(user, 0) for user in carts}
+        CART_SNAPSHOT_THREAD = threading.Thread(target=write_cart_snapshot, args=(carts, versions, CART_SEQUENCE),
+                                                name='cart-snapshot', daemon=True)
+        CART_SNAPSHOT_THREAD.start()
+
+# ===== Cart change events =====
+# Each cart carries a version that every mutation bumps. Mutation responses return it, and
+# /api/cart/events pushes the same changes as Server-Sent Events to tabs on the cart page,
+# so they stay in sync without polling; other pages refetch when shown again. A stream holds
+# a server thread, so each process serves at most CART_EVENTS_MAX_STREAMS (gunicorn.conf.py
+# sets a quarter of its threads), each closing after CART_EVENTS_MAX_AGE seconds;
+# EventSource reconnects with Last-Event-ID and resumes. Tabs over the cap get the cart
+# once and retry in 30 seconds.
+# Versions only mean something within one process, so every version is sent with
+# CART_EPOCH; a client that sees a different epoch takes that server's cart as is.
+# On serverless hosts (Vercel) requests land on different instances and a stream would hold
+# a function invocation open, so events are off there unless CART_EVENTS=1; GET /api/cart
+# tells the client whether to subscribe with X-Cart-Events.
+CART_EVENTS_ENABLED = os.environ.get("CART_EVENTS", "0" if os.environ.get("VERCEL") else "1") != "0"
+CART_EVENTS_MAX_STREAMS = int(os.environ.get("CART_EVENTS_MAX_STREAMS", "16"))
+CART_EVENTS_MAX_AGE = float(os.environ.get("CART_EVENTS_MAX_AGE", "25"))
+CART_EVENTS_HEARTBEAT = float(os.environ.get("CART_EVENTS_HEARTBEAT", "10"))
+CART_EVENT_HISTORY = 16
+
+# Replaced in each gunicorn worker by post_fork, so a restarted worker gets a new epoch
+CART_EPOCH = uuid.uuid4().hex
+CART_VERSIONS = {}
+CART_EVENTS = {}
+CART_CONDITION = threading.Condition()
+CART_STREAMS = threading.BoundedSemaphore(CART_EVENTS_MAX_STREAMS)
+
+def cart_changed(user_id, delta):
+    """Record a cart mutation: bump the version, wake event streams and log it; returns the version"""
+    with CART_CONDITION:
+        version = CART_VERSIONS.get(user_id, 0) + 1
+        CART_VERSIONS[user_id] = version
+        history = CART_EVENTS.get(user_id)
+        if history is None:
+            history = CART_EVENTS[user_id] = deque(maxlen=CART_EVENT_HISTORY)
+        history.append((version, delta))
+        CART_CONDITION.notify_all()
+    log_cart(user_id)
+    return version
+
+def cart_events_since(user_id, since):
+    """Return deltas newer than since, or None when the client needs the whole cart"""
+    version = CART_VERSIONS.get(user_id, 0)
+    if since is None or since > version:
+        return None
+    if since == version:
+        return []
+    history = CART_EVENTS.get(user_id, ())
+    if not history or history[0][0] > since + 1:
+        return None
+    return [(event_version, delta) for event_version, delta in history if event_version > since]
+
+def format_event(event, version, data):
+    data = dict(data, version=version, epoch=CART_EPOCH)
+    return f"id: {CART_EPOCH}:{version}\nevent: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+def parse_event_id(event_id):
+    """Return the version in an "epoch:version" event id, or None unless it is from this process"""
+    epoch, _, version = (event_id or '').partition(':')
+    if epoch != CART_EPOCH or not version.isdigit():
+        return None
+    return int(version)
+
 @app.route('/api/cart', methods=['GET'])
 def get_cart():
     """API endpoint to get user's cart"""
@@ -97,13 +2299,72 @@ def get_cart():
     if not user_id:
         return jsonify({"error": "User ID is required"}), 400
     
+    wait_for_carts()
+    
     # Return empty cart if user doesn't have one yet
     if user_id not in CARTS:
         CARTS[user_id] = []
     
-    return jsonify(CARTS[user_id])
+    response = jsonify(CARTS[user_id])
+    response.headers['X-Cart-Version'] = str(CART_VERSIONS.get(user_id, 0))
+    response.headers['X-Cart-Epoch'] = CART_EPOCH
+    response.headers['X-Cart-Events'] = '1' if CART_EVENTS_ENABLED else '0'
+    return response
+
+@app.route('/api/cart/events', methods=['GET'])
+def cart_events():
+    """API endpoint streaming a user's cart changes as Server-Sent Events"""
+    if not CART_EVENTS_ENABLED:
+        return jsonify({"error": "Cart events are disabled"}), 404
+    
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"error": "User ID is required"}), 400
+    
+    wait_for_carts()
+    
+    since = parse_event_id(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    
+    def generate():
+        if not CART_STREAMS.acquire(blocking=False):
+            # Ask the browser to come back later rather than tying up another thread, but
+            # send the cart now so a tab over the cap still syncs on every retry
+            with CART_CONDITION:
+                version = CART_VERSIONS.get(user_id, 0)
+                cart = [dict(item) for item in CARTS.get(user_id, [])]
+            yield "retry: 30000\n\n"
+            yield format_event('cart', version, {'cart': cart})
+            return
+        try:
+            last = since
+            yield "retry: 3000\n\n"
+            deadline = time.monotonic() + CART_EVENTS_MAX_AGE
+            while time.monotonic() < deadline:
+                with CART_CONDITION:
+                    events = cart_events_since(user_id, last)
+                    if events == []:
+                        CART_CONDITION.wait(min(CART_EVENTS_HEARTBEAT, max(0, deadline - time.monotonic())))
+                        events = cart_events_since(user_id, last)
+                    version = CART_VERSIONS.get(user_id, 0)
+                    cart = [dict(item) for item in CARTS.get(user_id, [])] if events is None else None
+                
+                if events is None:
+                    yield format_event('cart', version, {'cart': cart})
+                    last = version
+                elif events:
+                    for event_version, delta in events:
+                        yield format_event('delta', event_version, delta)
+                    last = events[-1][0]
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            CART_STREAMS.release()
+    
+    return app.response_class(generate(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/cart/add', methods=['POST'])
+@admission_control
 def add_to_cart():
     """API endpoint to add item to cart"""
     data = request.json
@@ -116,6 +2377,8 @@ def add_to_cart():
     if not user_id or not product_id:
         return jsonify({"error": "User ID and Product ID are required"}), 400
     
+    wait_for_carts()
+    
     # Initialize cart if it doesn't exist
     if user_id not in CARTS:
         CARTS[user_id] = []
@@ -124,31 +2387,46 @@ def add_to_cart():
     for item in CARTS[user_id]:
         if item['product_id'] == product_id:
             item['quantity'] += 1
-            return jsonify({"success": True, "cart": CARTS[user_id]})
+            version = cart_changed(user_id, {'op': 'set', 'item': dict(item)})
+            return jsonify({"success": True, "cart": CARTS[user_id], "version": version, "epoch": CART_EPOCH})
     
     # Add new item to cart
     try:
-        # Fetch product details from Supabase
-        response = supabase.table('products').select('*').eq('id', product_id).execute()
-        
-        if hasattr(response, 'error') and response.error is not None:
-            return jsonify({"error": "Failed to fetch product from database"}), 500
-            
-        if not response.data:
-            return jsonify({"error": "Product not found"}), 404
+        # Resolve product details from the in-memory index, querying Supabase only on a miss
+        product = cached_cart_product(product_id)
+        if product is not None:
+            incr_metric('product_index_hits')
+        else:
+            incr_metric('product_index_misses')
+            with db_slot():
+                response = supabase.table('products').select('id,title,price,image').eq('id', product_id).execute()
             
-        product = response.data[0]
+            if hasattr(response, 'error') and response.error is not None:
+                return jsonify({"error": "Failed to fetch product from database"}), 500
+                
+            if not response.data:
+                return jsonify({"error": "Product not found"}), 404
+                
+            row = response.data[0]
+            index_products([row])
+            product = (row['title'], row['price'], versioned_image(row['image']))
+        
+        title, price, image = product
         
         # Add to cart with quantity 1
-        CARTS[user_id].append({
+        item = {
             'product_id': product_id,
-            'title': product['title'],
-            'price': product['price'],
-            'image': product['image'],
+            'title': title,
+            'price': price,
+            'image': image,
             'quantity': 1
-        })
+        }
+        CARTS[user_id].append(item)
+        version = cart_changed(user_id, {'op': 'set', 'item': dict(item)})
         
-        return jsonify({"success": True, "cart": CARTS[user_id]})
+        return jsonify({"success": True, "cart": CARTS[user_id], "version": version, "epoch": CART_EPOCH})
+    except Overloaded:
+        raise
     except Exception as e:
         return jsonify({"error": f"Failed to fetch product: {str(e)}"}), 500
 
@@ -165,10 +2443,91 @@ def remove_from_cart():
     if not user_id or not product_id:
         return jsonify({"error": "User ID and Product ID are required"}), 400
     
+    wait_for_carts()
+    
+    version = CART_VERSIONS.get(user_id, 0)
     if user_id in CARTS:
         CARTS[user_id] = [item for item in CARTS[user_id] if item['product_id'] != product_id]
+        version = cart_changed(user_id, {'op': 'remove', 'product_id': product_id})
     
-    return jsonify({"success": True, "cart": CARTS.get(user_id, [])})
+    return jsonify({"success": True, "cart": CARTS.get(user_id, []), "version": version, "epoch": CART_EPOCH})
+
+# Checkout repricing limits: carts larger than this are rejected outright, and validation
+# that runs past the budget (seconds) is abandoned with a 503
+CHECKOUT_MAX_ITEMS = int(os.environ.get("CHECKOUT_MAX_ITEMS", "500"))
+CHECKOUT_VALIDATION_BUDGET = float(os.environ.get("CHECKOUT_VALIDATION_BUDGET", "2.0"))
+CENT = Decimal('0.01')
+
+def to_cents(value):
+    """Convert a JSON number to an exact Decimal amount rounded to cents"""
+    return Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+def reprice_items(items, deadline):
+    """Reprice checkout items from the catalog with one bulk query.
+    
+    Prices always come from Supabase, never from the listing caches, which may lag behind
+    it. Returns (priced_items, total, unknown_ids, stale_items). Raises TimeoutError once
+    the deadline (a time.monotonic() value) has passed.
+    """
+    with db_slot():
+        response = (supabase.table('products').select('id,title,price,image')
+                    .in_('id', list({item['product_id'] for item in items})).execute())
+    if hasattr(response, 'error') and response.error is not None:
+        raise RuntimeError("Failed to fetch products for validation")
+    index_products(response.data)
+    catalog = {row['id']: (row['title'], row['price'], row['image']) for row in response.data}
+    
+    priced_items = []
+    unknown_ids = []
+    stale_items = []
+    total = Decimal('0')
+    for position, item in enumerate(items):
+        if position % 256 == 0 and time.monotonic() > deadline:
+            raise TimeoutError("Checkout validation took too long")
+        
+        product_id = item['product_id']
+        product = catalog.get(product_id)
+        if product is None:
+            unknown_ids.append(product_id)
+            continue
+        
+        title, price, image = product
+        current_price = to_cents(price)
+        if to_cents(item['price']) != current_price:
+            stale_items.append({
+                'product_id': product_id,
+                'price': item['price'],
+                'current_price': float(current_price)
+            })
+        
+        total += current_price * item['quantity']
+        priced_items.append({
+            'product_id': product_id,
+            'title': title,
+            'price': float(current_price),
+            'image': image,
+            'quantity': item['quantity']
+        })
+    
+    if time.monotonic() > deadline:
+        raise TimeoutError("Checkout validation took too long")
+    return priced_items, total, unknown_ids, stale_items
+
+def invalid_checkout_item(item):
+    """Return True unless item has a positive integer product_id and quantity and a price"""
+    if not isinstance(item, dict):
+        return True
+    product_id = item.get('product_id')
+    if isinstance(product_id, bool) or not isinstance(product_id, int) or product_id < 1:
+        return True
+    quantity = item.get('quantity')
+    if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 1:
+        return True
+    try:
+        to_cents(item.get('price'))
+    except (InvalidOperation, TypeError, ValueError):
+        return True
+    return False
 
 @app.route('/api/checkout', methods=['POST'])
 def checkout():
@@ -183,7 +2542,38 @@ def checkout():
     if not user_id or not items:
         return jsonify({"error": "User ID and Items are required"}), 400
     
+    if not isinstance(items, list) or any(invalid_checkout_item(item) for item in items):
+        return jsonify({"error": "Each item needs a product_id, a price and a positive quantity"}), 400
+    
+    if len(items) > CHECKOUT_MAX_ITEMS:
+        return jsonify({"error": f"Carts are limited to {CHECKOUT_MAX_ITEMS} items"}), 400
+    
+    wait_for_carts()
+    
     try:
+        # Validate client-supplied prices against the catalog before storing anything
+        deadline = time.monotonic() + CHECKOUT_VALIDATION_BUDGET
+        try:
+            items, total, unknown_ids, stale_items = reprice_items(items, deadline)
+        except TimeoutError:
+            response = jsonify({"error": "Checkout is busy, please try again"})
+            response.status_code = 503
+            response.headers['Retry-After'] = '1'
+            return response
+        
+        if unknown_ids:
+            return jsonify({"error": "Some products no longer exist", "product_ids": unknown_ids}), 400
+        
+        if stale_items:
+            # Refresh the stored cart so the client can re-confirm at the current prices
+            current_prices = {item['product_id']: item['current_price'] for item in stale_items}
+            for item in CARTS.get(user_id, []):
+                if item['product_id'] in current_prices:
+                    item['price'] = current_prices[item['product_id']]
+            if user_id in CARTS:
+                cart_changed(user_id, {'op': 'replace', 'cart': [dict(item) for item in CARTS[user_id]]})
+            return jsonify({"error": "Some prices have changed", "stale_items": stale_items}), 409
+        
         # Check if user_id is in the old format and convert if needed
         if user_id.startswith('user_'):
             # For existing users with the old format, generate a new UUID
@@ -194,18 +2584,20 @@ def checkout():
             new_uuid_generated = False
         
         # First, add to users table
-        user_response = supabase.table('users').upsert(
-            {"user_id": user_id}
-        ).execute()
+        with db_slot():
+            user_response = supabase.table('users').upsert(
+                {"user_id": user_id}
+            ).execute()
         
         if hasattr(user_response, 'error') and user_response.error is not None:
             return jsonify({"error": f"Failed to create user entry: {user_response.error}"}), 500
         
         # Then add to orders table with the items JSON
-        order_response = supabase.table('orders').insert({
-            "user_id": user_id,
-            "items": items
-        }).execute()
+        with db_slot():
+            order_response = supabase.table('orders').insert({
+                "user_id": user_id,
+                "items": items
+            }).execute()
         
         if hasattr(order_response, 'error') and order_response.error is not None:
             return jsonify({"error": f"Failed to create order entry: {order_response.error}"}), 500
@@ -213,11 +2605,13 @@ def checkout():
         # Clear the cart after successful checkout
         if user_id in CARTS:
             CARTS[user_id] = []
+            cart_changed(user_id, {'op': 'clear'})
         
         response_data = {
             "success": True, 
             "message": "Order processed successfully",
-            "order_id": order_response.data[0]['id'] if order_response.data else None
+            "order_id": order_response.data[0]['id'] if order_response.data else None,
+            "total": str(total)
         }
         
         # If we generated a new UUID, include it in the response
@@ -226,9 +2620,24 @@ def checkout():
         
         return jsonify(response_data)
         
+    except Overloaded:
+        raise
     except Exception as e:
         return jsonify({"error": f"Checkout failed: {str(e)}"}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """API endpoint exposing in-process cache counters"""
+    with METRICS_LOCK:
+        metrics = dict(METRICS)
+    
+    # Backend calls per search request shows how much the cache is saving
+    requests_seen = metrics['search_requests']
+    metrics['search_backend_calls_per_request'] = (
+        round(metrics['search_backend_calls'] / requests_seen, 3) if requests_seen else 0.0
+    )
+    return jsonify(metrics)
+
 @app.route('/<path:path>')
 def catch_all(path):
     """A special route that catches all other requests"""
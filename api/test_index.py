@@ -4,15 +4,17 @@ import uuid
 from unittest.mock import patch, MagicMock
 
 # Import the Flask application from index.py instead of app.py
-from index import app as flask_app
+from index import app as flask_app, clear_caches
 
 @pytest.fixture
-def app():
+def app(monkeypatch):
     """Create a Flask test client fixture for our tests"""
     # Configure app for testing
     flask_app.config.update({
         "TESTING": True,
     })
+    clear_caches()
+    monkeypatch.setattr('index.CATALOG_POLL_INTERVAL', 0)
     
     # Return test client
     with flask_app.test_client() as testing_client:
@@ -241,6 +243,7 @@ def test_checkout_success(mock_supabase, app):
     # Setup mock responses
     user_response = MockSupabaseResponse(data=[{"user_id": "test_user4"}])
     order_response = MockSupabaseResponse(data=[{"id": 123}])
+    products_response = MockSupabaseResponse(data=[{"id": 1, "title": "Test", "price": 19.99, "image": "test.jpg"}])
     
     # Configure mock to return different responses for different tables
     def side_effect_table(table_name):
@@ -250,6 +253,8 @@ def test_checkout_success(mock_supabase, app):
             mock_table.upsert.return_value.execute.return_value = user_response
         elif table_name == 'orders':
             mock_table.insert.return_value.execute.return_value = order_response
+        elif table_name == 'products':
+            mock_table.select.return_value.in_.return_value.execute.return_value = products_response
             
         return mock_table
     
@@ -273,6 +278,7 @@ def test_checkout_with_uuid_conversion(mock_supabase, app):
     # Setup mock responses
     user_response = MockSupabaseResponse(data=[{"user_id": "some-uuid"}])
     order_response = MockSupabaseResponse(data=[{"id": 456}])
+    products_response = MockSupabaseResponse(data=[{"id": 2, "title": "Test2", "price": 29.99, "image": "test2.jpg"}])
     
     # Configure mock
     def side_effect_table(table_name):
@@ -282,6 +288,8 @@ def test_checkout_with_uuid_conversion(mock_supabase, app):
             mock_table.upsert.return_value.execute.return_value = user_response
         elif table_name == 'orders':
             mock_table.insert.return_value.execute.return_value = order_response
+        elif table_name == 'products':
+            mock_table.select.return_value.in_.return_value.execute.return_value = products_response
             
         return mock_table
     
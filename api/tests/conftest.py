@@ -11,7 +11,7 @@ from supabase import create_client
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 
 # Import your Flask app - adjust this import based on your actual file structure
-from api.index import app as flask_app
+from api.index import app as flask_app, clear_caches
 
 @pytest.fixture
 def app():
@@ -28,6 +28,12 @@ def app():
     # Return test app
     return test_app
 
+@pytest.fixture(autouse=True)
+def reset_caches(monkeypatch):
+    """Start every test with empty in-memory caches and catalog polling switched off."""
+    clear_caches()
+    monkeypatch.setattr('api.index.CATALOG_POLL_INTERVAL', 0)
+
 @pytest.fixture
 def client(app):
     """A test client for the app."""
@@ -119,4 +119,71 @@ def test_remove_from_cart(client):
     # Assertions
     assert response.status_code == 200
     assert data['success'] == True
-    assert len(data['cart']) == 0
\ No newline at end of file
+    assert len(data['cart']) == 0
+
+def test_add_to_cart_uses_product_index(client):
+    """Products seen in a listing are added without another database query."""
+    mock_products = [
+        {
+            'id': 7,
+            'title': 'Indexed Product',
+            'price': 9.99,
+            'description': 'Test description',
+            'category': 'test',
+            'image': 'indexed.jpg',
+            'rating.rate': 4.0,
+            'rating.count': 3
+        }
+    ]
+    mock_response = MagicMock()
+    mock_response.data = mock_products
+    mock_response.error = None
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.return_value.select.return_value.execute.return_value = mock_response
+        client.get('/api/products')
+        
+        response = client.post('/api/cart/add',
+                            json={
+                                'user_id': 'test_user_index',
+                                'product_id': 7
+                            },
+                            content_type='application/json')
+        data = json.loads(response.data)
+        
+        # Assertions
+        assert response.status_code == 200
+        assert data['cart'][0]['title'] == 'Indexed Product'
+        assert data['cart'][0]['image'] == 'indexed.jpg'
+        mock_table.return_value.select.return_value.eq.assert_not_called()
+
+def test_add_to_cart_index_miss_queries_once(client):
+    """A miss falls back to Supabase once, then later adds hit the index."""
+    mock_product = {
+        'id': 8,
+        'title': 'Missed Product',
+        'price': 5.0,
+        'image': 'missed.jpg'
+    }
+    mock_response = MagicMock()
+    mock_response.data = [mock_product]
+    mock_response.error = None
+    
+    with patch('api.index.supabase.table') as mock_table:
+        execute = mock_table.return_value.select.return_value.eq.return_value.execute
+        execute.return_value = mock_response
+        
+        for user_id in ('test_user_miss1', 'test_user_miss2'):
+            response = client.post('/api/cart/add',
+                                json={
+                                    'user_id': user_id,
+                                    'product_id': 8
+                                },
+                                content_type='application/json')
+            assert response.status_code == 200
+        
+        assert execute.call_count == 1
+    
+    metrics = json.loads(client.get('/api/metrics').data)
+    assert metrics['product_index_misses'] == 1
+    assert metrics['product_index_hits'] == 1
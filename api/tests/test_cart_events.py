@@ -0,0 +1,89 @@
+import json
+import threading
+import pytest
+
+import api.index
+
+@pytest.fixture(autouse=True)
+def short_streams(monkeypatch):
+    """Keep event streams short so tests read them to completion."""
+    monkeypatch.setattr(api.index, 'CART_EVENTS_MAX_AGE', 0.2)
+    monkeypatch.setattr(api.index, 'CART_EVENTS_HEARTBEAT', 0.05)
+    api.index.PRODUCT_INDEX[1] = ('Test Product', 19.99, 'test.jpg')
+    api.index.PRODUCT_INDEX[2] = ('Other Product', 5.0, 'other.jpg')
+
+def add(client, user_id, product_id):
+    return json.loads(client.post('/api/cart/add',
+                                  json={'user_id': user_id, 'product_id': product_id},
+                                  content_type='application/json').data)
+
+def parse_events(body):
+    """Split an SSE body into (event, id, data) tuples, skipping comments and retry hints."""
+    events = []
+    for block in body.decode('utf-8').strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':') and ': ' in line)
+        if 'event' in fields:
+            epoch, version = fields['id'].split(':')
+            assert epoch == api.index.CART_EPOCH
+            events.append((fields['event'], int(version), json.loads(fields['data'])))
+    return events
+
+def test_mutations_return_versions(client):
+    """Each mutation bumps the cart version returned to the client."""
+    assert add(client, 'events_user1', 1)['version'] == 1
+    assert add(client, 'events_user1', 1)['version'] == 2
+    removed = json.loads(client.post('/api/cart/remove',
+                                     json={'user_id': 'events_user1', 'product_id': 1},
+                                     content_type='application/json').data)
+    assert removed['version'] == 3
+    
+    response = client.get('/api/cart?user_id=events_user1')
+    assert response.headers['X-Cart-Version'] == '3'
+    assert response.headers['X-Cart-Epoch'] == removed['epoch'] == api.index.CART_EPOCH
+    assert response.headers['X-Cart-Events'] == '1'
+
+def test_event_stream_sends_deltas_since_version(client):
+    """A client that has seen version 1 receives only the later deltas."""
+    add(client, 'events_user2', 1)
+    add(client, 'events_user2', 2)
+    add(client, 'events_user2', 2)
+    
+    response = client.get('/api/cart/events?user_id=events_user2', headers={'Last-Event-ID': f'{api.index.CART_EPOCH}:1'})
+    events = parse_events(response.data)
+    
+    assert response.mimetype == 'text/event-stream'
+    assert [(event, version) for event, version, _ in events] == [('delta', 2), ('delta', 3)]
+    assert events[1][2] == {'op': 'set', 'version': 3, 'epoch': api.index.CART_EPOCH, 'item': {
+        'product_id': 2, 'title': 'Other Product', 'price': 5.0, 'image': 'other.jpg', 'quantity': 2}}
+
+def test_event_stream_resyncs_with_full_cart(client, monkeypatch):
+    """New connections, clients too far behind and clients of another epoch get the whole cart."""
+    monkeypatch.setattr(api.index, 'CART_EVENT_HISTORY', 2)
+    for _ in range(4):
+        add(client, 'events_user3', 1)
+    
+    for since in ('', f'{api.index.CART_EPOCH}:1', 'restarted:3', '3'):
+        url = f'/api/cart/events?user_id=events_user3&since={since}'
+        events = parse_events(client.get(url).data)
+        assert [(event, version) for event, version, _ in events] == [('cart', 4)]
+        assert events[0][2]['cart'][0]['quantity'] == 4
+
+def test_event_stream_limit(client, monkeypatch):
+    """Streams beyond the per-process limit get the cart once and are told to retry later."""
+    add(client, 'events_user4', 1)
+    monkeypatch.setattr(api.index, 'CART_STREAMS', threading.BoundedSemaphore(1))
+    api.index.CART_STREAMS.acquire()
+    try:
+        response = client.get('/api/cart/events?user_id=events_user4')
+    finally:
+        api.index.CART_STREAMS.release()
+    
+    assert response.data.startswith(b'retry: 30000\n\n')
+    assert [(event, version) for event, version, _ in parse_events(response.data)] == [('cart', 1)]
+
+def test_event_stream_disabled(client, monkeypatch):
+    """With events switched off (the default on Vercel) clients are told not to subscribe."""
+    monkeypatch.setattr(api.index, 'CART_EVENTS_ENABLED', False)
+    
+    assert client.get('/api/cart?user_id=events_user5').headers['X-Cart-Events'] == '0'
+    assert client.get('/api/cart/events?user_id=events_user5').status_code == 404
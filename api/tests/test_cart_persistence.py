@@ -0,0 +1,134 @@
+import fcntl
+import gzip
+import json
+import os
+import threading
+import pytest
+
+import api.index
+
+@pytest.fixture
+def cart_store(tmp_path, monkeypatch):
+    """Persist carts to a temporary directory."""
+    monkeypatch.setattr(api.index, 'CART_STORE_DIR', str(tmp_path))
+    api.index.PRODUCT_INDEX[1] = ('Test Product', 19.99, 'test.jpg')
+    api.index.PRODUCT_INDEX[2] = ('Other Product', 5.0, 'other.jpg')
+    yield tmp_path
+    api.index.clear_caches()
+
+def add(client, user_id, product_id):
+    return client.post('/api/cart/add',
+                       json={'user_id': user_id, 'product_id': product_id},
+                       content_type='application/json')
+
+def simulate_restart(user_ids):
+    """Drop the in-memory carts and restore them from disk."""
+    api.index.clear_caches()
+    for user_id in user_ids:
+        api.index.CARTS.pop(user_id, None)
+    api.index.restore_carts()
+
+def test_carts_restored_from_write_ahead_log(client, cart_store):
+    """Mutations are replayed from the log after a restart."""
+    add(client, 'persist_user1', 1)
+    add(client, 'persist_user1', 1)
+    add(client, 'persist_user1', 2)
+    client.post('/api/cart/remove',
+                json={'user_id': 'persist_user1', 'product_id': 2},
+                content_type='application/json')
+    
+    simulate_restart(['persist_user1'])
+    
+    assert api.index.CARTS['persist_user1'] == [
+        {'product_id': 1, 'title': 'Test Product', 'price': 19.99, 'image': 'test.jpg', 'quantity': 2}
+    ]
+
+def test_snapshot_rotates_log(client, cart_store, monkeypatch):
+    """Snapshots fold the log into a gzipped file, and later records still replay."""
+    monkeypatch.setattr(api.index, 'CART_SNAPSHOT_EVERY', 2)
+    add(client, 'persist_user2', 1)
+    add(client, 'persist_user3', 1)
+    snapshot_thread = api.index.CART_SNAPSHOT_THREAD
+    if snapshot_thread is not None:
+        snapshot_thread.join()
+    add(client, 'persist_user3', 2)
+    
+    with gzip.open(cart_store / 'carts.json.gz', 'rt') as f:
+        snapshot = json.load(f)
+    assert {'persist_user2', 'persist_user3'} <= set(snapshot['carts'])
+    assert not os.path.exists(cart_store / 'carts.wal.1')
+    
+    simulate_restart(['persist_user2', 'persist_user3'])
+    
+    assert len(api.index.CARTS['persist_user2']) == 1
+    assert [item['product_id'] for item in api.index.CARTS['persist_user3']] == [1, 2]
+
+def test_torn_log_tail_ignored(client, cart_store):
+    """A partially written last record doesn't prevent restore."""
+    add(client, 'persist_user4', 1)
+    with open(cart_store / 'carts.wal', 'a') as f:
+        f.write('{"s": 99, "u": "persist_us')
+    
+    simulate_restart(['persist_user4'])
+    
+    assert api.index.CARTS['persist_user4'][0]['product_id'] == 1
+    assert api.index.CART_RESTORED.is_set()
+
+def test_leftover_rotated_log_folded_into_next_snapshot(client, cart_store, monkeypatch):
+    """A rotated log left by a failed snapshot is kept until the next snapshot covers it."""
+    monkeypatch.setattr(api.index, 'CART_SNAPSHOT_EVERY', 1)
+    leftover = {'s': 1, 'u': 'persist_user5', 'v': 1,
+                'c': [{'product_id': 2, 'title': 'Other Product', 'price': 5.0, 'image': 'other.jpg', 'quantity': 1}]}
+    (cart_store / 'carts.wal.1').write_text(json.dumps(leftover) + '\n')
+    
+    add(client, 'persist_user6', 1)
+    snapshot_thread = api.index.CART_SNAPSHOT_THREAD
+    if snapshot_thread is not None:
+        snapshot_thread.join()
+    
+    with gzip.open(cart_store / 'carts.json.gz', 'rt') as f:
+        snapshot = json.load(f)
+    assert {'persist_user5', 'persist_user6'} <= set(snapshot['carts'])
+    assert not os.path.exists(cart_store / 'carts.wal.1')
+
+def test_store_owned_by_another_process(client, cart_store):
+    """Cart endpoints answer 503 while another process holds the store lock."""
+    with open(cart_store / 'carts.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        response = add(client, 'persist_user7', 1)
+        
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    
+    assert add(client, 'persist_user7', 1).status_code == 200
+
+def test_other_routes_unaffected_by_store_lock(client, cart_store):
+    """Only cart endpoints depend on owning the store."""
+    with open(cart_store / 'carts.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        
+        assert client.get('/api/metrics').status_code == 200
+        assert client.get('/api/cart?user_id=persist_user8').status_code == 503
+
+def test_mutations_rejected_until_restored(client, cart_store, monkeypatch):
+    """Past CART_RESTORE_TIMEOUT cart requests get 503 instead of logging out-of-sequence records."""
+    release = threading.Event()
+    restore = api.index.restore_carts
+    
+    def slow_restore():
+        release.wait()
+        restore()
+    
+    monkeypatch.setattr(api.index, 'CART_RESTORE_TIMEOUT', 0.01)
+    monkeypatch.setattr(api.index, 'restore_carts', slow_restore)
+    
+    response = add(client, 'persist_user9', 1)
+    
+    assert response.status_code == 503
+    assert not os.path.exists(cart_store / 'carts.wal')
+    
+    release.set()
+    api.index.CART_RESTORED.wait()
+    assert add(client, 'persist_user9', 1).status_code == 200
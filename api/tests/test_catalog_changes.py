@@ -0,0 +1,197 @@
+import json
+import threading
+import pytest
+from unittest.mock import patch, MagicMock
+
+import api.index
+from api.index import apply_catalog_changes, write_catalog_snapshot
+
+def make_row(product_id, price=10.0, updated_at='2025-01-01T00:00:00'):
+    """Build a products row as stored in Supabase."""
+    return {
+        'id': product_id,
+        'title': f'Product {product_id}',
+        'price': price,
+        'description': 'Test description',
+        'category': 'test',
+        'image': f'{product_id}.jpg',
+        'rating.rate': 4.0,
+        'rating.count': 1,
+        'updated_at': updated_at
+    }
+
+def make_response(data):
+    """Wrap rows in a mock Supabase response."""
+    mock_response = MagicMock()
+    mock_response.data = data
+    mock_response.error = None
+    return mock_response
+
+def test_pushed_change_updates_index_and_listing(client):
+    """A pushed change reprices cached products and invalidates cached listings."""
+    with patch('api.index.supabase.table') as mock_table:
+        execute = mock_table.return_value.select.return_value.execute
+        execute.return_value = make_response([make_row(1, price=10.0)])
+        client.get('/api/products')
+        
+        apply_catalog_changes([make_row(1, price=15.0)])
+        assert api.index.PRODUCT_INDEX[1][1] == 15.0
+        
+        execute.return_value = make_response([make_row(1, price=15.0)])
+        response = client.get('/api/products')
+        assert json.loads(response.data)[0]['price'] == 15.0
+        assert execute.call_count == 2
+
+def test_pushed_deletion_hides_snapshot_product(client, tmp_path, monkeypatch):
+    """Deleted products are not resurrected from an older snapshot."""
+    path = str(tmp_path / 'catalog.snap')
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_PATH', path)
+    write_catalog_snapshot(path, [api.index.transform_product(make_row(2))])
+    assert api.index.cached_cart_product(2) is not None
+    
+    apply_catalog_changes(deleted_ids=[2])
+    
+    assert api.index.cached_cart_product(2) is None
+    with patch('api.index.supabase.table') as mock_table:
+        assert json.loads(client.get('/api/products').data) == []
+        mock_table.assert_not_called()
+
+def test_changes_are_overlaid_on_the_snapshot(client, tmp_path, monkeypatch):
+    """Changed and added products are merged into snapshot reads without reloading the table."""
+    path = str(tmp_path / 'catalog.snap')
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_PATH', path)
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_CHECK_INTERVAL', 0)
+    snapshot_rows = [make_row(1), make_row(3)]
+    write_catalog_snapshot(path, [api.index.transform_product(row) for row in snapshot_rows],
+                           watermark='2025-01-01T00:00:00')
+    
+    apply_catalog_changes([make_row(1, price=15.0, updated_at='2025-01-02T00:00:00'),
+                           make_row(2, updated_at='2025-01-02T00:00:00')])
+    
+    with patch('api.index.supabase.table') as mock_table:
+        listing = json.loads(client.get('/api/products').data)
+        mock_table.assert_not_called()
+    assert [(product['id'], product['price']) for product in listing] == [(1, 15.0), (2, 10.0), (3, 10.0)]
+    assert [product['id'] for product in api.index.iter_catalog_products()] == [1, 2, 3]
+    
+    # A rewritten snapshot that includes the changes retires them from the overlay
+    rows = [make_row(1, price=15.0), make_row(2), make_row(3)]
+    write_catalog_snapshot(path, [api.index.transform_product(row) for row in rows], watermark='2025-01-02T00:00:00')
+    assert api.index.current_snapshot().header['watermark'] == '2025-01-02T00:00:00'
+    assert api.index.SNAPSHOT_OVERLAY == {}
+    assert [product['price'] for product in json.loads(client.get('/api/products').data)] == [15.0, 10.0, 10.0]
+
+def test_large_overlay_rewrites_the_snapshot(client, tmp_path, monkeypatch):
+    """Past the rewrite threshold the snapshot, then its related table, is rebuilt in the background."""
+    path = str(tmp_path / 'catalog.snap')
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_PATH', path)
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_CHECK_INTERVAL', 0)
+    monkeypatch.setattr(api.index, 'CATALOG_CHANGE_BATCH', 1)
+    write_catalog_snapshot(path, [api.index.transform_product(make_row(1))])
+    
+    with patch('api.index.refresh_catalog_snapshot') as refresh, \
+            patch('api.index.start_related_table_build') as build_related:
+        apply_catalog_changes([make_row(2), make_row(3)])
+        api.index.SNAPSHOT_REWRITE_THREAD.join()
+    
+    refresh.assert_called_once_with()
+    build_related.assert_called_once_with()
+
+def test_poll_applies_only_changed_rows(client, monkeypatch):
+    """Polling fetches rows newer than the watermark and applies them incrementally."""
+    monkeypatch.setattr(api.index, 'CATALOG_POLL_INTERVAL', 2)
+    api.index.PRODUCT_INDEX[3] = ('Product 3', 10.0, '3.jpg')
+    api.index.PRODUCT_INDEX[4] = ('Product 4', 10.0, '4.jpg')
+    
+    with patch('api.index.supabase.table') as mock_table:
+        watermark = mock_table.return_value.select.return_value.order.return_value.limit.return_value.execute
+        changed = (mock_table.return_value.select.return_value.lte.return_value.gt.return_value
+                   .order.return_value.order.return_value.limit.return_value.execute)
+        
+        watermark.return_value = make_response([{'updated_at': '2025-01-01T00:00:00'}])
+        api.index.poll_catalog_changes()
+        assert api.index.CATALOG_WATERMARK == '2025-01-01T00:00:00'
+        changed.assert_not_called()
+        
+        # Within the poll interval nothing is queried
+        api.index.poll_catalog_changes()
+        assert watermark.call_count == 1
+        
+        monkeypatch.setattr(api.index, 'CATALOG_POLLED_AT', float('-inf'))
+        watermark.return_value = make_response([{'updated_at': '2025-01-02T00:00:00'}])
+        changed.return_value = make_response([make_row(3, price=8.0, updated_at='2025-01-02T00:00:00')])
+        api.index.poll_catalog_changes()
+        
+        mock_table.return_value.select.return_value.lte.assert_called_with('updated_at', '2025-01-02T00:00:00')
+        mock_table.return_value.select.return_value.lte.return_value.gt.assert_called_with('updated_at', '2025-01-01T00:00:00')
+        assert api.index.CATALOG_WATERMARK == '2025-01-02T00:00:00'
+        assert api.index.PRODUCT_INDEX[3][1] == 8.0
+        assert api.index.PRODUCT_INDEX[4][1] == 10.0
+
+def test_poll_pages_through_large_change_sets(client, monkeypatch):
+    """Change sets bigger than one batch are fetched page by page after the last key seen."""
+    monkeypatch.setattr(api.index, 'CATALOG_POLL_INTERVAL', 2)
+    monkeypatch.setattr(api.index, 'CATALOG_CHANGE_BATCH', 2)
+    monkeypatch.setattr(api.index, 'CATALOG_WATERMARK', '2025-01-01T00:00:00')
+    stamp = '2025-01-02T00:00:00'
+    
+    with patch('api.index.supabase.table') as mock_table:
+        select = mock_table.return_value.select.return_value
+        select.order.return_value.limit.return_value.execute.return_value = make_response([{'updated_at': stamp}])
+        first = select.lte.return_value.gt.return_value.order.return_value.order.return_value.limit.return_value.execute
+        rest = select.lte.return_value.or_.return_value.order.return_value.order.return_value.limit.return_value.execute
+        first.return_value = make_response([make_row(1, updated_at=stamp), make_row(2, updated_at=stamp)])
+        rest.side_effect = [make_response([make_row(3, updated_at=stamp), make_row(4, updated_at=stamp)]),
+                            make_response([make_row(5, updated_at=stamp)])]
+        
+        api.index.poll_catalog_changes()
+        
+        select.lte.return_value.or_.assert_called_with(
+            f'updated_at.gt."{stamp}",and(updated_at.eq."{stamp}",id.gt.4)')
+    
+    assert sorted(api.index.PRODUCT_INDEX) == [1, 2, 3, 4, 5]
+    assert api.index.CATALOG_WATERMARK == stamp
+
+def test_requests_start_the_poll_thread_without_polling(client, monkeypatch):
+    """Polling runs in a background thread; requests only make sure it is running."""
+    monkeypatch.setattr(api.index, 'CATALOG_POLL_INTERVAL', 2)
+    started = threading.Event()
+    
+    with patch('api.index.catalog_poll_loop', started.set), patch('api.index.supabase.table') as mock_table:
+        client.get('/api/metrics')
+        
+        assert started.wait(1)
+        assert not mock_table.called
+
+def test_reconcile_finds_deleted_products(client):
+    """Ids missing from the table are applied as deletions."""
+    api.index.PRODUCT_INDEX[3] = ('Product 3', 10.0, '3.jpg')
+    api.index.PRODUCT_INDEX[4] = ('Product 4', 10.0, '4.jpg')
+    
+    with patch('api.index.supabase.table') as mock_table:
+        pages = mock_table.return_value.select.return_value.order.return_value.range.return_value.execute
+        pages.return_value = make_response([{'id': 3}])
+        
+        api.index.reconcile_catalog_deletions()
+    
+    assert 4 in api.index.DELETED_PRODUCTS
+    assert set(api.index.PRODUCT_INDEX) == {3}
+
+def test_reconcile_skips_id_scan_when_counts_match(client):
+    """With the whole catalog known, a single count query shows nothing was deleted."""
+    api.index.SEARCH_INDEX = api.index.SearchIndex(api.index.transform_product(make_row(i)) for i in (1, 2))
+    
+    with patch('api.index.supabase.table') as mock_table:
+        count = mock_table.return_value.select.return_value.limit.return_value.execute
+        pages = mock_table.return_value.select.return_value.order.return_value.range.return_value.execute
+        count.return_value = MagicMock(count=2, error=None)
+        
+        api.index.reconcile_catalog_deletions()
+        pages.assert_not_called()
+        
+        count.return_value = MagicMock(count=1, error=None)
+        pages.return_value = make_response([{'id': 1}])
+        api.index.CATALOG_RECONCILED_AT = float('-inf')
+        api.index.reconcile_catalog_deletions()
+    
+    assert 2 not in api.index.SEARCH_INDEX.positions
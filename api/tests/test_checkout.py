@@ -2,6 +2,8 @@ import json
 import pytest
 from unittest.mock import patch, MagicMock
 
+import api.index
+
 def test_checkout_success(client):
     """Test successful checkout process."""
     # Mock data
@@ -23,6 +25,10 @@ def test_checkout_success(client):
     mock_order_response.data = [{'id': 123}]
     mock_order_response.error = None
     
+    mock_products_response = MagicMock()
+    mock_products_response.data = [{'id': 1, 'title': 'Test Product', 'price': 19.99, 'image': 'test.jpg'}]
+    mock_products_response.error = None
+    
     # Patch the supabase client's execute methods
     with patch('api.index.supabase.table') as mock_table:
         # Configure the mock for users table
@@ -33,12 +39,18 @@ def test_checkout_success(client):
         mock_table_orders = MagicMock()
         mock_table_orders.insert.return_value.execute.return_value = mock_order_response
         
+        # Configure the mock for the products table used to validate prices
+        mock_table_products = MagicMock()
+        mock_table_products.select.return_value.in_.return_value.execute.return_value = mock_products_response
+        
         # Set up the mock table method to return different mocks based on table name
         def side_effect(table_name):
             if table_name == 'users':
                 return mock_table_users
             elif table_name == 'orders':
                 return mock_table_orders
+            elif table_name == 'products':
+                return mock_table_products
         
         mock_table.side_effect = side_effect
         
@@ -55,6 +67,7 @@ def test_checkout_success(client):
         assert response.status_code == 200
         assert data['success'] == True
         assert data['order_id'] == 123
+        assert data['total'] == '39.98'
 
 def test_checkout_with_uuid_generation(client):
     """Test checkout with UUID generation for legacy user IDs."""
@@ -77,6 +90,10 @@ def test_checkout_with_uuid_generation(client):
     mock_order_response.data = [{'id': 124}]
     mock_order_response.error = None
     
+    mock_products_response = MagicMock()
+    mock_products_response.data = [{'id': 1, 'title': 'Test Product', 'price': 19.99, 'image': 'test.jpg'}]
+    mock_products_response.error = None
+    
     # Patch the supabase client and uuid generation
     with patch('api.index.supabase.table') as mock_table, \
          patch('uuid.uuid4', return_value='new-uuid'):
@@ -88,12 +105,17 @@ def test_checkout_with_uuid_generation(client):
         mock_table_orders = MagicMock()
         mock_table_orders.insert.return_value.execute.return_value = mock_order_response
         
+        mock_table_products = MagicMock()
+        mock_table_products.select.return_value.in_.return_value.execute.return_value = mock_products_response
+        
         # Set up the mock table method
         def side_effect(table_name):
             if table_name == 'users':
                 return mock_table_users
             elif table_name == 'orders':
                 return mock_table_orders
+            elif table_name == 'products':
+                return mock_table_products
         
         mock_table.side_effect = side_effect
         
@@ -128,8 +150,13 @@ def test_checkout_error_handling(client):
     mock_error_response = MagicMock()
     mock_error_response.error = "Database error"
     
+    mock_products_response = MagicMock()
+    mock_products_response.data = [{'id': 1, 'title': 'Test Product', 'price': 19.99, 'image': 'test.jpg'}]
+    mock_products_response.error = None
+    
     # Patch the supabase client
     with patch('api.index.supabase.table') as mock_table:
+        mock_table.return_value.select.return_value.in_.return_value.execute.return_value = mock_products_response
         mock_table.return_value.upsert.return_value.execute.return_value = mock_error_response
         
         # Make request to checkout endpoint
@@ -143,4 +170,111 @@ def test_checkout_error_handling(client):
         
         # Assertions
         assert response.status_code == 500
-        assert 'error' in data
\ No newline at end of file
+        assert 'error' in data
+
+def make_checkout_tables(products):
+    """Mock the users, orders and products tables for a checkout."""
+    tables = {name: MagicMock() for name in ('users', 'orders', 'products')}
+    
+    user_response = MagicMock()
+    user_response.data = [{'user_id': 'test_user'}]
+    user_response.error = None
+    tables['users'].upsert.return_value.execute.return_value = user_response
+    
+    order_response = MagicMock()
+    order_response.data = [{'id': 200}]
+    order_response.error = None
+    tables['orders'].insert.return_value.execute.return_value = order_response
+    
+    products_response = MagicMock()
+    products_response.data = products
+    products_response.error = None
+    tables['products'].select.return_value.in_.return_value.execute.return_value = products_response
+    return tables
+
+def test_checkout_rejects_stale_prices(client):
+    """Items priced differently from the catalog are rejected with 409."""
+    tables = make_checkout_tables([{'id': 1, 'title': 'Test Product', 'price': 24.99, 'image': 'test.jpg'}])
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.side_effect = tables.__getitem__
+        
+        response = client.post('/api/checkout',
+                             json={
+                                 'user_id': 'test_user',
+                                 'items': [{'product_id': 1, 'title': 'Test Product', 'price': 19.99, 'quantity': 1}]
+                             },
+                             content_type='application/json')
+        data = json.loads(response.data)
+        
+        # Assertions
+        assert response.status_code == 409
+        assert data['stale_items'] == [{'product_id': 1, 'price': 19.99, 'current_price': 24.99}]
+        tables['orders'].insert.assert_not_called()
+
+def test_checkout_reprices_large_cart_in_one_query(client):
+    """Hundreds of lines are validated with a single bulk query and an exact total."""
+    products = [{'id': i, 'title': f'Product {i}', 'price': 0.1, 'image': f'{i}.jpg'} for i in range(1, 301)]
+    items = [{'product_id': i, 'title': f'Product {i}', 'price': 0.1, 'quantity': 1} for i in range(1, 301)]
+    tables = make_checkout_tables(products)
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.side_effect = tables.__getitem__
+        
+        response = client.post('/api/checkout',
+                             json={'user_id': 'test_user', 'items': items},
+                             content_type='application/json')
+        data = json.loads(response.data)
+        
+        # Assertions
+        assert response.status_code == 200
+        assert data['total'] == '30.00'
+        assert tables['products'].select.return_value.in_.call_count == 1
+        stored_items = tables['orders'].insert.call_args[0][0]['items']
+        assert len(stored_items) == 300
+
+def test_checkout_rejects_invalid_items(client):
+    """Malformed quantities are rejected before touching the database."""
+    with patch('api.index.supabase.table') as mock_table:
+        response = client.post('/api/checkout',
+                             json={
+                                 'user_id': 'test_user',
+                                 'items': [{'product_id': 1, 'price': 19.99, 'quantity': 0}]
+                             },
+                             content_type='application/json')
+        
+        assert response.status_code == 400
+        mock_table.assert_not_called()
+
+@pytest.mark.parametrize('product_id', ['1', 1.0, True, 0])
+def test_checkout_rejects_non_integer_product_ids(client, product_id):
+    """Product ids must be positive integers, matching how the catalog is keyed."""
+    with patch('api.index.supabase.table') as mock_table:
+        response = client.post('/api/checkout',
+                             json={
+                                 'user_id': 'test_user',
+                                 'items': [{'product_id': product_id, 'price': 19.99, 'quantity': 1}]
+                             },
+                             content_type='application/json')
+        
+        assert response.status_code == 400
+        mock_table.assert_not_called()
+
+def test_checkout_ignores_cached_listing_prices(client):
+    """A price cached from an earlier listing is never trusted for checkout."""
+    api.index.index_products([{'id': 1, 'title': 'Test Product', 'price': 19.99, 'image': 'test.jpg'}])
+    tables = make_checkout_tables([{'id': 1, 'title': 'Test Product', 'price': 24.99, 'image': 'test.jpg'}])
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.side_effect = tables.__getitem__
+        
+        response = client.post('/api/checkout',
+                             json={
+                                 'user_id': 'test_user',
+                                 'items': [{'product_id': 1, 'price': 19.99, 'quantity': 1}]
+                             },
+                             content_type='application/json')
+        
+        assert response.status_code == 409
+        assert tables['products'].select.return_value.in_.call_count == 1
+        assert api.index.PRODUCT_INDEX[1][1] == 24.99
@@ -0,0 +1,174 @@
+import json
+import numpy as np
+import pytest
+from unittest.mock import patch, MagicMock
+
+import api.index
+from api.index import CatalogSnapshot, normalize_catalog_record, write_catalog_snapshot
+
+def ok_response(data=None):
+    """Build a successful mock Supabase response."""
+    mock_response = MagicMock()
+    mock_response.data = data or []
+    mock_response.error = None
+    return mock_response
+
+@pytest.fixture
+def runner(app):
+    return app.test_cli_runner()
+
+def test_normalize_catalog_record_flattens_rating():
+    """Nested and flat rating fields end up in the shape get_products reads."""
+    row = normalize_catalog_record({'id': '3', 'title': ' Tee ', 'price': '19.999',
+                                    'rating': {'rate': 4.5, 'count': 10}})
+    
+    assert row['id'] == 3
+    assert row['title'] == 'Tee'
+    assert row['price'] == 20.0
+    assert row['rating.rate'] == 4.5
+    assert row['rating.count'] == 10
+    
+    with pytest.raises(ValueError):
+        normalize_catalog_record({'id': 4, 'title': 'Tee', 'price': -1})
+
+@pytest.mark.parametrize('product_id', [1.7, True, '1.5', -2, 0, None, 'abc'])
+def test_normalize_catalog_record_rejects_non_integral_ids(product_id):
+    """Ids that aren't positive whole numbers are rejected rather than truncated."""
+    with pytest.raises(ValueError, match='id must be a positive whole number'):
+        normalize_catalog_record({'id': product_id, 'title': 'Tee', 'price': 1})
+
+def test_import_reports_malformed_lines(runner, tmp_path):
+    """Unparseable and non-object lines are skipped and reported; repeated ids keep the last row."""
+    source = tmp_path / 'catalog.ndjson'
+    source.write_text('\n'.join([
+        json.dumps({'id': 1, 'title': 'One', 'price': 10}),
+        '{"id": 2, "title": ',
+        json.dumps([3, 'Three']),
+        json.dumps({'id': 1, 'title': 'One again', 'price': 11}),
+        json.dumps({'id': 5, 'title': 'Five', 'price': 50}),
+    ]) + '\n')
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.return_value.upsert.return_value.execute.return_value = ok_response()
+        
+        result = runner.invoke(args=['catalog', 'import', str(source)])
+        
+        assert result.exit_code == 1
+        assert 'line 2: invalid JSON' in result.output
+        assert 'line 3: record must be a JSON object' in result.output
+        assert 'Imported 3 products, skipped 2' in result.output
+        batches = [call.args[0] for call in mock_table.return_value.upsert.call_args_list]
+        assert [(row['id'], row['title']) for batch in batches for row in batch] == [(1, 'One again'), (5, 'Five')]
+
+def test_snapshot_keeps_last_repeated_id(tmp_path):
+    """A repeated id in the product stream is written once, with its last payload."""
+    snapshot_path = tmp_path / 'catalog.snap'
+    products = [{'id': 1, 'title': 'One'}, {'id': 1, 'title': 'One again'}, {'id': 5, 'title': 'Five'}]
+    
+    assert write_catalog_snapshot(str(snapshot_path), products) == 2
+    
+    snapshot = CatalogSnapshot(str(snapshot_path))
+    assert snapshot.get(1)['title'] == 'One again'
+    assert [product['id'] for product in json.loads(b''.join(snapshot.iter_listing()))] == [1, 5]
+
+def test_import_ndjson_in_batches(runner, tmp_path):
+    """Valid rows are upserted in batches; the snapshot is then rebuilt from the whole table."""
+    source = tmp_path / 'catalog.ndjson'
+    lines = [
+        {'id': 1, 'title': 'One', 'price': 10, 'rating': {'rate': 4, 'count': 2}},
+        {'id': 2, 'title': 'Two', 'price': 20},
+        {'id': 3, 'title': '', 'price': 30},
+        {'id': 4, 'title': 'Four', 'price': 40},
+    ]
+    source.write_text('\n'.join(json.dumps(line) for line in lines) + '\n')
+    snapshot_path = tmp_path / 'catalog.snap'
+    # Product 9 was imported earlier and isn't in this file; it must stay in the snapshot
+    table_rows = [{'id': product_id, 'title': title, 'price': price, 'description': '', 'category': 'tops',
+                   'image': '', 'rating.rate': 4.0, 'rating.count': 2}
+                  for product_id, title, price in [(1, 'One', 10.0), (2, 'Two', 20.0), (4, 'Four', 40.0), (9, 'Nine', 90.0)]]
+    
+    with patch('api.index.supabase.table') as mock_table, \
+         patch('api.index.write_related_table') as mock_related:
+        mock_table.return_value.upsert.return_value.execute.return_value = ok_response()
+        mock_table.return_value.select.return_value.order.return_value.limit.return_value.execute.return_value = ok_response()
+        mock_table.return_value.select.return_value.order.return_value.range.return_value.execute.return_value = ok_response(table_rows)
+        
+        result = runner.invoke(args=['catalog', 'import', str(source), '--batch-size', '2',
+                                     '--snapshot', str(snapshot_path)])
+        
+        assert result.exit_code == 1
+        assert 'line 3: title is required' in result.output
+        assert 'Imported 3 products, skipped 1' in result.output
+        assert f'Wrote 4 products to {snapshot_path}' in result.output
+        batches = [call.args[0] for call in mock_table.return_value.upsert.call_args_list]
+        assert [[row['id'] for row in batch] for batch in batches] == [[1, 2], [4]]
+        assert batches[0][0]['rating.count'] == 2
+        mock_related.assert_called_once_with(str(snapshot_path))
+    
+    snapshot = CatalogSnapshot(str(snapshot_path))
+    assert len(snapshot) == 4
+    assert snapshot.get(1)['rating'] == {'rate': 4.0, 'count': 2}
+    assert snapshot.get(9)['title'] == 'Nine'
+
+def test_import_snapshot_refused_with_dry_run(runner, tmp_path):
+    """--snapshot would read a table --dry-run never wrote, so the combination is refused."""
+    source = tmp_path / 'catalog.ndjson'
+    source.write_text(json.dumps({'id': 1, 'title': 'One', 'price': 10}) + '\n')
+    
+    with patch('api.index.supabase.table') as mock_table:
+        result = runner.invoke(args=['catalog', 'import', str(source), '--dry-run',
+                                     '--snapshot', str(tmp_path / 'catalog.snap')])
+        
+        assert result.exit_code == 2
+        assert "--snapshot can't be used with --dry-run" in result.output
+        mock_table.assert_not_called()
+    assert not (tmp_path / 'catalog.snap').exists()
+
+def test_import_csv_dry_run(runner, tmp_path):
+    """CSV files are validated without writing when --dry-run is given."""
+    source = tmp_path / 'catalog.csv'
+    source.write_text('id,title,price,category,rating.rate,rating.count\n1,One,9.5,tops,3.5,7\n')
+    
+    with patch('api.index.supabase.table') as mock_table:
+        result = runner.invoke(args=['catalog', 'import', str(source), '--dry-run'])
+        
+        assert result.exit_code == 0
+        assert 'Imported 1 products, skipped 0 (dry run)' in result.output
+        mock_table.assert_not_called()
+
+def test_export_csv(runner, tmp_path):
+    """Exports page through Supabase and write the catalog columns."""
+    destination = tmp_path / 'catalog.csv'
+    rows = [{'id': 1, 'title': 'One', 'price': 10.0, 'description': 'd', 'category': 'c',
+             'image': 'i.jpg', 'rating.rate': 4.0, 'rating.count': 1, 'updated_at': 'x'}]
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.return_value.select.return_value.order.return_value.range.return_value.execute.return_value = ok_response(rows)
+        
+        result = runner.invoke(args=['catalog', 'export', str(destination)])
+        
+        assert result.exit_code == 0
+        assert destination.read_text().splitlines() == [
+            'id,title,price,description,category,image,rating.rate,rating.count',
+            '1,One,10.0,d,c,i.jpg,4.0,1',
+        ]
+
+def test_related_table_from_supabase(runner, tmp_path, monkeypatch):
+    """Without a snapshot, --output computes the neighbour table from the products table."""
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_PATH', '')
+    output = tmp_path / 'related.npy'
+    rows = [{'id': product_id, 'title': title, 'price': 10.0, 'description': '', 'category': category,
+             'image': '', 'rating.rate': 4.0, 'rating.count': 1}
+            for product_id, title, category in [(1, 'Rain Jacket', 'outerwear'), (2, 'Winter Jacket', 'outerwear'),
+                                                (3, 'Gold Earrings', 'jewelery')]]
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.return_value.select.return_value.order.return_value.range.return_value.execute.return_value = ok_response(rows)
+        
+        result = runner.invoke(args=['catalog', 'related', '--output', str(output)])
+    
+    assert result.exit_code == 0
+    assert f'Wrote related products for 3 products to {output}' in result.output
+    table = np.load(str(output))
+    assert table['id'].tolist() == [1, 2, 3]
+    assert table['neighbors'][0][0] == 2
@@ -2,6 +2,8 @@ import json
 import pytest
 from unittest.mock import patch, MagicMock
 
+import api.index
+
 def test_get_products(client, monkeypatch):
     """Test the /api/products endpoint."""
     # Mock data that would come from Supabase
@@ -84,4 +86,70 @@ def test_get_product_not_found(client, monkeypatch):
         
         # Assertions
         assert response.status_code == 404
-        assert 'error' in data
\ No newline at end of file
+        assert 'error' in data
+
+def test_get_products_stream(client, monkeypatch):
+    """The streaming mode pages through Supabase and returns one JSON array."""
+    monkeypatch.setattr(api.index, 'CATALOG_PAGE_SIZE', 2)
+    
+    def make_page(ids):
+        page = MagicMock()
+        page.data = [
+            {
+                'id': i,
+                'title': f'Product {i}',
+                'price': 10.0,
+                'description': 'Test description',
+                'category': 'test',
+                'image': f'{i}.jpg',
+                'rating.rate': 4.0,
+                'rating.count': i
+            }
+            for i in ids
+        ]
+        page.error = None
+        return page
+    
+    with patch('api.index.supabase.table') as mock_table:
+        paged = mock_table.return_value.select.return_value.order.return_value.range
+        paged.return_value.execute.side_effect = [make_page([1, 2]), make_page([3])]
+        
+        response = client.get('/api/products?stream=1')
+        data = json.loads(response.data)
+        
+        # Assertions
+        assert response.status_code == 200
+        assert [product['id'] for product in data] == [1, 2, 3]
+        assert data[2]['rating']['count'] == 3
+        assert [call.args for call in paged.call_args_list] == [(0, 1), (2, 3)]
+
+def test_get_products_stream_error(client):
+    """A failing first page is reported as a 500 before streaming starts."""
+    mock_response = MagicMock()
+    mock_response.error = "Database error"
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.return_value.select.return_value.order.return_value.range.return_value.execute.return_value = mock_response
+        
+        response = client.get('/api/products?stream=1')
+        
+        assert response.status_code == 500
+        assert 'error' in json.loads(response.data)
+
+def test_stream_search_uses_the_search_path(client):
+    """?stream=1 with a search returns the same bounded, fuzzy-ranked results as without it."""
+    api.index.SEARCH_INDEX = api.index.SearchIndex([
+        {'id': 1, 'title': 'Rain Jacket', 'price': 10.0, 'description': '', 'category': 'outerwear',
+         'image': '1.jpg', 'rating': {'rate': 4.0, 'count': 1}},
+        {'id': 2, 'title': 'Gold Earrings', 'price': 10.0, 'description': '', 'category': 'jewelery',
+         'image': '2.jpg', 'rating': {'rate': 4.0, 'count': 1}},
+    ])
+    
+    with patch('api.index.supabase.table') as mock_table:
+        streamed = client.get('/api/products?stream=1&search=jakcet')
+        buffered = client.get('/api/products?search=jakcet')
+        
+        assert streamed.status_code == 200
+        assert [product['id'] for product in json.loads(streamed.data)] == [1]
+        assert streamed.data == buffered.data
+        assert not mock_table.called
@@ -0,0 +1,94 @@
+import json
+import threading
+import pytest
+from unittest.mock import patch, MagicMock
+
+import api.index
+
+@pytest.fixture
+def mock_product_table():
+    """Patch Supabase so single-product lookups succeed."""
+    mock_response = MagicMock()
+    mock_response.data = [{'id': 1, 'title': 'Test Product', 'price': 19.99, 'image': 'test.jpg'}]
+    mock_response.error = None
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.return_value.select.return_value.eq.return_value.execute.return_value = mock_response
+        yield mock_table
+
+def test_client_over_burst_is_shed(client, monkeypatch, mock_product_table):
+    """A client that exhausts its bucket gets 429 with Retry-After."""
+    monkeypatch.setattr(api.index, 'RATE_LIMIT_CLIENT_BURST', 2)
+    monkeypatch.setattr(api.index, 'RATE_LIMIT_CLIENT_RATE', 0.5)
+    
+    statuses = [client.get('/api/products/1').status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    
+    response = client.get('/api/products/1')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert 'error' in json.loads(response.data)
+    
+    # Other clients keep their own budget
+    other = client.get('/api/products/1', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert other.status_code == 200
+    
+    metrics = json.loads(client.get('/api/metrics').data)
+    assert metrics['admitted'] == 3
+    assert metrics['shed_rate_limited'] == 2
+
+def test_global_bucket_sheds_all_clients(client, monkeypatch, mock_product_table):
+    """The global bucket caps total admitted traffic across clients."""
+    monkeypatch.setattr(api.index, 'GLOBAL_BUCKET', api.index.TokenBucket(0.5, 1))
+    
+    first = client.get('/api/products/1', environ_base={'REMOTE_ADDR': '10.0.0.3'})
+    second = client.get('/api/products/1', environ_base={'REMOTE_ADDR': '10.0.0.4'})
+    
+    assert first.status_code == 200
+    assert second.status_code == 429
+
+def test_forwarded_for_is_not_trusted_by_default(client, monkeypatch, mock_product_table):
+    """Without a trusted proxy, a spoofed X-Forwarded-For doesn't buy a fresh bucket."""
+    monkeypatch.setattr(api.index, 'RATE_LIMIT_CLIENT_BURST', 1)
+    monkeypatch.setattr(api.index, 'RATE_LIMIT_CLIENT_RATE', 0.5)
+    
+    statuses = [
+        client.get('/api/products/1', headers={'X-Forwarded-For': f'10.1.0.{n}'}).status_code
+        for n in range(3)
+    ]
+    
+    assert statuses == [200, 429, 429]
+    assert len(api.index.CLIENT_BUCKETS) == 1
+
+def test_saturated_database_sheds_load(client, monkeypatch, mock_product_table):
+    """Requests are shed when every database slot is busy."""
+    monkeypatch.setattr(api.index, 'DB_SEMAPHORE', threading.BoundedSemaphore(1))
+    monkeypatch.setattr(api.index, 'DB_ACQUIRE_TIMEOUT', 0.01)
+    
+    api.index.DB_SEMAPHORE.acquire()
+    try:
+        response = client.get('/api/products/1')
+    finally:
+        api.index.DB_SEMAPHORE.release()
+    
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert json.loads(client.get('/api/metrics').data)['shed_db_busy'] == 1
+
+def test_requests_served_without_supabase_are_not_limited(client, monkeypatch):
+    """Only requests that reach Supabase spend tokens; cached searches never do."""
+    monkeypatch.setattr(api.index, 'RATE_LIMIT_CLIENT_BURST', 1)
+    monkeypatch.setattr(api.index, 'RATE_LIMIT_CLIENT_RATE', 0.01)
+    monkeypatch.setattr(api.index, 'SEARCH_FUZZY', False)
+    response = MagicMock(data=[{'id': 1, 'title': 'Blue Shirt', 'price': 19.99, 'description': 'd',
+                                'category': 'c', 'image': 'test.jpg'}], error=None)
+    
+    with patch('api.index.supabase.table') as mock_table:
+        mock_table.return_value.select.return_value.ilike.return_value.order.return_value.range.return_value.execute.return_value = response
+        
+        statuses = [client.get('/api/products?search=shirt').status_code for _ in range(5)]
+        assert statuses == [200] * 5
+        assert client.get('/api/products?search=jacket').status_code == 429
+    
+    metrics = json.loads(client.get('/api/metrics').data)
+    assert metrics['admitted'] == 1
+    assert metrics['search_cache_hits'] == 4
@@ -0,0 +1,177 @@
+import json
+import threading
+import pytest
+from unittest.mock import patch, MagicMock
+
+import api.index
+from api.index import RelatedIndex
+
+CATALOG = [
+    (1, 'Slim Fit Cotton T-Shirt', 'Soft cotton tee for everyday wear', "men's clothing"),
+    (2, 'Classic Cotton T-Shirt', 'Breathable cotton tee with a crew neck', "men's clothing"),
+    (3, 'Waterproof Rain Jacket', 'Hooded jacket that keeps you dry', 'outerwear'),
+    (4, 'Insulated Winter Jacket', 'Warm hooded jacket for cold weather', 'outerwear'),
+    (5, 'Gold Hoop Earrings', 'Lightweight gold plated earrings', 'jewelery'),
+]
+
+def make_product(product_id, title, description, category):
+    """Build a transformed product."""
+    return {
+        'id': product_id,
+        'title': title,
+        'price': 10.0,
+        'description': description,
+        'category': category,
+        'image': f'{product_id}.jpg',
+        'rating': {'rate': 4.0, 'count': 1}
+    }
+
+@pytest.fixture
+def products():
+    return [make_product(*entry) for entry in CATALOG]
+
+def test_related_ranks_similar_products_first(products):
+    """Neighbours come back ordered by similarity."""
+    index = RelatedIndex(products, k=3)
+    
+    assert [product_id for product_id, _, _ in index.related(1)][0] == 2
+    assert [product_id for product_id, _, _ in index.related(3)][0] == 4
+    assert index.related(99) is None
+
+def test_related_index_incremental_update(products):
+    """Changed and new products are patched in without a rebuild."""
+    index = RelatedIndex(products, k=2)
+    index.update([make_product(6, 'Lightweight Rain Jacket', 'Packable hooded jacket', 'outerwear')])
+    
+    assert index.related(6)[0][0] in (3, 4)
+    assert 6 in [product_id for product_id, _, _ in index.related(3)]
+    
+    index.update([], deleted_ids=[6])
+    assert index.related(6) is None
+    assert 6 not in [product_id for product_id, _, _ in index.related(3)]
+
+def test_related_endpoint(client, products):
+    """The index is built once in the background; requests get a 503 until it is ready."""
+    page = MagicMock()
+    page.data = [
+        {
+            'id': product['id'],
+            'title': product['title'],
+            'price': product['price'],
+            'description': product['description'],
+            'category': product['category'],
+            'image': product['image']
+        }
+        for product in products
+    ]
+    page.error = None
+    
+    with patch('api.index.supabase.table') as mock_table:
+        execute = mock_table.return_value.select.return_value.order.return_value.range.return_value.execute
+        execute.return_value = page
+        
+        response = client.get('/api/products/3/related?k=2')
+        assert response.status_code == 503
+        assert response.headers['Retry-After']
+        
+        api.index.RELATED_BUILD_THREAD.join()
+        response = client.get('/api/products/3/related?k=2')
+        data = json.loads(response.data)
+        
+        assert response.status_code == 200
+        assert 1 <= len(data) <= 2
+        assert all(product['score'] > 0 for product in data)
+        assert data[0]['id'] == 4
+        assert data[0]['title'] == 'Insulated Winter Jacket'
+        
+        assert client.get('/api/products/99/related').status_code == 404
+        assert execute.call_count == 1
+
+def test_catalog_change_patches_related_index(client, products, monkeypatch):
+    """Catalog change notifications reach the related index."""
+    monkeypatch.setattr(api.index, 'RELATED_REBUILD_FRACTION', 0.5)
+    api.index.RELATED_INDEX = RelatedIndex(products, k=2)
+    
+    api.index.apply_catalog_changes(deleted_ids=[4])
+    
+    assert api.index.RELATED_INDEX.related(4) is None
+    assert 4 not in [product_id for product_id, _, _ in api.index.RELATED_INDEX.related(3)]
+
+def test_large_catalog_change_rebuilds_in_background(client, products):
+    """Too many changes at once start a rebuild while the old index keeps serving."""
+    old_index = api.index.RELATED_INDEX = RelatedIndex(products, k=2)
+    release = threading.Event()
+    
+    def slow_catalog():
+        release.wait()
+        yield from products[1:]
+    
+    with patch('api.index.iter_catalog_products', slow_catalog):
+        api.index.apply_catalog_changes(products[:3])
+        
+        assert api.index.RELATED_INDEX is old_index
+        assert client.get('/api/products/3/related').status_code == 200
+        
+        release.set()
+        api.index.RELATED_BUILD_THREAD.join()
+    
+    assert api.index.RELATED_INDEX is not old_index
+    assert api.index.RELATED_INDEX.related(1) is None
+
+def test_related_table_is_shared_from_the_snapshot(client, products, tmp_path, monkeypatch):
+    """With a snapshot, neighbours come from the precomputed table file without any query."""
+    path = str(tmp_path / 'catalog.snap')
+    api.index.write_catalog_snapshot(path, products)
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_PATH', path)
+    
+    with patch('api.index.supabase.table') as mock_table:
+        assert client.get('/api/products/3/related').status_code == 503
+        
+        api.index.write_related_table(path)
+        api.index.RELATED_TABLE_CHECKED_AT = float('-inf')
+        data = json.loads(client.get('/api/products/3/related?k=2').data)
+        
+        assert [product['id'] for product in data][0] == 4
+        assert data[0]['title'] == 'Insulated Winter Jacket'
+        assert client.get('/api/products/99/related').status_code == 404
+        
+        api.index.apply_catalog_changes([make_product(6, 'Denim Jacket', 'Hooded denim jacket', 'outerwear')],
+                                        deleted_ids=[4])
+        
+        assert 4 not in [product['id'] for product in json.loads(client.get('/api/products/3/related').data)]
+        assert client.get('/api/products/4/related').status_code == 404
+        assert json.loads(client.get('/api/products/6/related').data) == []
+        assert not mock_table.called
+    assert api.index.RELATED_INDEX is None
+
+def test_deployed_table_without_snapshot(client, products, tmp_path, monkeypatch):
+    """RELATED_TABLE_PATH serves a precomputed table; missing summaries are fetched once."""
+    path = str(tmp_path / 'related.npy')
+    api.index.save_related_table(products, path)
+    monkeypatch.setattr(api.index, 'RELATED_TABLE_PATH', path)
+    
+    with patch('api.index.supabase.table') as mock_table:
+        execute = mock_table.return_value.select.return_value.in_.return_value.execute
+        execute.return_value = MagicMock(data=[{'id': 4, 'title': 'Insulated Winter Jacket', 'price': 10.0,
+                                                'image': '4.jpg'}], error=None)
+        
+        data = json.loads(client.get('/api/products/3/related?k=1').data)
+        assert data[0]['id'] == 4
+        assert data[0]['title'] == 'Insulated Winter Jacket'
+        client.get('/api/products/3/related?k=1')
+        
+        assert execute.call_count == 1
+    assert api.index.RELATED_INDEX is None
+
+def test_no_in_process_build_without_table(client, monkeypatch):
+    """With in-process builds off and no table, products get no suggestions rather than a build."""
+    monkeypatch.setattr(api.index, 'RELATED_IN_PROCESS', False)
+    
+    with patch('api.index.supabase.table') as mock_table, \
+         patch('api.index.start_related_build') as start_build:
+        response = client.get('/api/products/3/related')
+        
+        assert response.status_code == 200
+        assert json.loads(response.data) == []
+        assert not mock_table.called
+        start_build.assert_not_called()
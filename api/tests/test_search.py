@@ -0,0 +1,150 @@
+import json
+import threading
+import pytest
+from unittest.mock import patch, MagicMock
+
+import api.index
+from api.index import SearchIndex, apply_catalog_changes
+
+CATALOG = [
+    (1, 'Waterproof Rain Jacket', 'outerwear'),
+    (2, 'Slim Fit Cotton T-Shirt', "men's clothing"),
+    (3, 'Insulated Winter Jacket with Hood', 'outerwear'),
+    (4, 'Gold Hoop Earrings', 'jewelery'),
+    (5, 'Jacket', 'outerwear'),
+]
+
+def make_row(product_id, title, category):
+    """Build a products row as stored in Supabase."""
+    return {
+        'id': product_id,
+        'title': title,
+        'price': 10.0,
+        'description': 'Test description',
+        'category': category,
+        'image': f'{product_id}.jpg',
+        'rating.rate': 4.0,
+        'rating.count': 1
+    }
+
+@pytest.fixture
+def index():
+    return SearchIndex(api.index.transform_product(make_row(*entry)) for entry in CATALOG)
+
+def search_ids(index, query):
+    """Return the ids of the products matching query, best first."""
+    return [index.ids[position] for position in index.search(query)]
+
+def test_search_tolerates_typos(index):
+    """Misspelled queries still find the intended products."""
+    assert set(search_ids(index, 'jakcet')) == {1, 3, 5}
+    assert search_ids(index, 'erings') == [4]
+    assert search_ids(index, 'zzzz') == []
+
+def test_search_ranks_substring_matches_first(index):
+    """Exact substring hits rank first, shorter titles ahead of longer ones."""
+    assert search_ids(index, 'jacket') == [5, 1, 3]
+    assert search_ids(index, 't-shirt') == [2]
+    assert search_ids(index, 'OUTERWEAR')[:3] == [5, 1, 3]
+
+def test_search_index_incremental_update(index, monkeypatch):
+    """Changed, added and deleted products are reflected without a rebuild."""
+    monkeypatch.setattr(api.index, 'SEARCH_REBUILD_FRACTION', 1.0)
+    
+    assert index.update([make_row(4, 'Gold Hoop Jacket Pin', 'jewelery'), make_row(6, 'Denim Jacket', 'outerwear')],
+                        deleted_ids=[1])
+    
+    assert set(search_ids(index, 'jacket')) == {3, 4, 5, 6}
+    assert search_ids(index, 'earrings') == []
+    assert json.loads(index.listing(index.search('denim')))[0]['title'] == 'Denim Jacket'
+    assert not index.update([make_row(7, 'Scarf', 'accessories')] * 10)
+
+def test_search_endpoint_uses_index(client):
+    """The index is built off the request path from one catalog scan and follows catalog changes."""
+    with patch('api.index.supabase.table') as mock_table:
+        execute = mock_table.return_value.select.return_value.order.return_value.range.return_value.execute
+        execute.return_value = MagicMock(data=[make_row(*entry) for entry in CATALOG], error=None)
+        ilike = mock_table.return_value.select.return_value.ilike.return_value.order.return_value.range.return_value.execute
+        ilike.return_value = MagicMock(data=[make_row(*CATALOG[0])], error=None)
+        
+        # Until the index is ready a plain substring query answers
+        response = client.get('/api/products?search=jacket')
+        assert [product['id'] for product in json.loads(response.data)] == [1]
+        api.index.SEARCH_BUILD_THREAD.join()
+        
+        response = client.get('/api/products?search=jakcet')
+        client.get('/api/products?search=earings')
+        
+        assert response.status_code == 200
+        assert [product['id'] for product in json.loads(response.data)][:1] == [5]
+        assert execute.call_count == 1
+        
+        apply_catalog_changes([make_row(5, 'Parka', 'outerwear')])
+        response = client.get('/api/products?search=jacket')
+        
+        assert [product['id'] for product in json.loads(response.data)] == [1, 3]
+        assert execute.call_count == 1
+    
+    metrics = json.loads(client.get('/api/metrics').data)
+    assert metrics['search_index_queries'] == 3
+    # The fallback query plus the one page of the index build's catalog scan
+    assert metrics['search_backend_calls'] == 2
+
+def test_large_change_rebuilds_while_old_index_serves(client, monkeypatch):
+    """A change too large to patch starts a rebuild; queries keep using the old index meanwhile."""
+    old_index = api.index.SEARCH_INDEX = SearchIndex(api.index.transform_product(make_row(*entry)) for entry in CATALOG)
+    release = threading.Event()
+    
+    def slow_catalog(metric=None):
+        release.wait()
+        yield api.index.transform_product(make_row(6, 'Denim Jacket', 'outerwear'))
+    
+    with patch('api.index.iter_catalog_products', slow_catalog):
+        apply_catalog_changes([make_row(7, 'Scarf', 'accessories')] * 10)
+        
+        assert api.index.SEARCH_INDEX is old_index
+        assert 5 in [product['id'] for product in json.loads(client.get('/api/products?search=jacket').data)]
+        
+        apply_catalog_changes([make_row(8, 'Rain Jacket', 'outerwear')])
+        release.set()
+        api.index.SEARCH_BUILD_THREAD.join()
+    
+    assert [product['id'] for product in json.loads(client.get('/api/products?search=jacket').data)] == [8, 6]
+
+def test_search_index_nbytes_counts_python_objects(index):
+    """Reported size covers payloads, texts and the trigram map, not just the arrays."""
+    _, sizes, alive = index.state
+    arrays = index.postings.nbytes + index.offsets.nbytes + sizes.nbytes + alive.nbytes
+    
+    assert index.nbytes > arrays + sum(len(payload) for payload in index.payloads) + len(index.grams) * 50
+
+def test_search_results_are_paged(client, monkeypatch):
+    """Searches return at most SEARCH_MAX_RESULTS products; offset and limit page through the rest."""
+    monkeypatch.setattr(api.index, 'SEARCH_MAX_RESULTS', 2)
+    api.index.SEARCH_INDEX = SearchIndex(api.index.transform_product(make_row(*entry)) for entry in CATALOG)
+    
+    def page(query):
+        return [product['id'] for product in json.loads(client.get(f'/api/products?search={query}').data)]
+    
+    assert page('jacket') == [5, 1]
+    assert page('jacket&offset=2') == [3]
+    assert page('jacket&limit=1&offset=1') == [1]
+    assert page('jacket&limit=50') == [5, 1]
+
+def test_snapshot_backed_index_reads_products_from_snapshot(client, tmp_path, monkeypatch):
+    """Built over a snapshot, the index holds no product JSON and lists current snapshot and overlay rows."""
+    snapshot_path = str(tmp_path / 'catalog.snap')
+    api.index.write_catalog_snapshot(snapshot_path, (api.index.transform_product(make_row(*entry)) for entry in CATALOG))
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_PATH', snapshot_path)
+    monkeypatch.setattr(api.index, 'SEARCH_REBUILD_FRACTION', 1.0)
+    
+    api.index.start_search_build()
+    api.index.SEARCH_BUILD_THREAD.join()
+    assert api.index.SEARCH_INDEX.payloads is None
+    
+    apply_catalog_changes([make_row(1, 'Waterproof Rain Jacket XL', 'outerwear')], deleted_ids=[3])
+    products = json.loads(client.get('/api/products?search=jacket').data)
+    
+    assert [product['id'] for product in products] == [5, 1]
+    assert products[1]['title'] == 'Waterproof Rain Jacket XL'
+    assert products[0] == api.index.current_snapshot().get(5)
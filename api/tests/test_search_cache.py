@@ -0,0 +1,90 @@
+import json
+import pytest
+from unittest.mock import patch, MagicMock
+
+import api.index
+
+def make_products_response(title='Blue Shirt'):
+    """Build a mock Supabase response holding a single product."""
+    mock_response = MagicMock()
+    mock_response.data = [
+        {
+            'id': 1,
+            'title': title,
+            'price': 19.99,
+            'description': 'Test description',
+            'category': 'test',
+            'image': 'test.jpg',
+            'rating.rate': 4.5,
+            'rating.count': 120
+        }
+    ]
+    mock_response.error = None
+    return mock_response
+
+def test_repeated_search_served_from_cache(client, monkeypatch):
+    """Equivalent searches hit Supabase only once."""
+    monkeypatch.setattr(api.index, 'SEARCH_FUZZY', False)
+    with patch('api.index.supabase.table') as mock_table:
+        execute = mock_table.return_value.select.return_value.ilike.return_value.order.return_value.range.return_value.execute
+        execute.return_value = make_products_response()
+        
+        first = client.get('/api/products?search=Shirt')
+        second = client.get('/api/products?search=%20%20shirt%20')
+        
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert json.loads(first.data) == json.loads(second.data)
+        assert execute.call_count == 1
+        mock_table.return_value.select.return_value.ilike.assert_called_with('title', '%shirt%')
+    
+    metrics = json.loads(client.get('/api/metrics').data)
+    assert metrics['search_requests'] == 2
+    assert metrics['search_cache_hits'] == 1
+    assert metrics['search_backend_calls'] == 1
+    assert metrics['search_backend_calls_per_request'] == 0.5
+
+def test_catalog_version_bump_invalidates_cache(client):
+    """Bumping the catalog version forces a fresh query."""
+    with patch('api.index.supabase.table') as mock_table:
+        execute = mock_table.return_value.select.return_value.execute
+        execute.return_value = make_products_response('Old Title')
+        client.get('/api/products')
+        
+        api.index.bump_catalog_version()
+        execute.return_value = make_products_response('New Title')
+        response = client.get('/api/products')
+        
+        assert execute.call_count == 2
+        assert json.loads(response.data)[0]['title'] == 'New Title'
+
+def test_search_cache_evicts_least_recently_used(client, monkeypatch):
+    """The cache never grows past SEARCH_CACHE_SIZE entries."""
+    monkeypatch.setattr(api.index, 'SEARCH_CACHE_SIZE', 2)
+    monkeypatch.setattr(api.index, 'SEARCH_FUZZY', False)
+    with patch('api.index.supabase.table') as mock_table:
+        execute = mock_table.return_value.select.return_value.ilike.return_value.order.return_value.range.return_value.execute
+        execute.return_value = make_products_response()
+        
+        for query in ('a', 'b', 'c'):
+            client.get(f'/api/products?search={query}')
+        client.get('/api/products?search=a')
+        
+        assert len(api.index.SEARCH_CACHE) == 2
+        assert execute.call_count == 4
+
+def test_search_cache_bounded_by_bytes(monkeypatch):
+    """Total cached body size stays under SEARCH_CACHE_MAX_BYTES and oversized bodies are skipped."""
+    monkeypatch.setattr(api.index, 'SEARCH_CACHE_MAX_BYTES', 100)
+    monkeypatch.setattr(api.index, 'SEARCH_CACHE_MAX_ENTRY_BYTES', 50)
+    
+    for key in 'abc':
+        api.index.search_cache_put(key, b'x' * 40)
+    api.index.search_cache_put('a', b'x' * 30)
+    api.index.search_cache_put('big', b'x' * 60)
+    
+    assert list(api.index.SEARCH_CACHE) == ['c', 'a']
+    assert api.index.SEARCH_CACHE_BYTES == 70
+    
+    api.index.bump_catalog_version()
+    assert api.index.SEARCH_CACHE_BYTES == 0
@@ -0,0 +1,78 @@
+import json
+import os
+import pytest
+from unittest.mock import patch
+
+import api.index
+from api.index import CatalogSnapshot, write_catalog_snapshot
+
+def make_product(product_id, price=10.0):
+    """Build a transformed product as served by /api/products."""
+    return {
+        'id': product_id,
+        'title': f'Product {product_id}',
+        'price': price,
+        'description': 'Test description',
+        'category': 'test',
+        'image': f'{product_id}.jpg',
+        'rating': {'rate': 4.0, 'count': 1}
+    }
+
+@pytest.fixture
+def snapshot_path(tmp_path, monkeypatch):
+    """Point the app at a snapshot file in a temporary directory."""
+    path = str(tmp_path / 'catalog.snap')
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_PATH', path)
+    monkeypatch.setattr(api.index, 'CATALOG_SNAPSHOT_CHECK_INTERVAL', 0)
+    return path
+
+def test_snapshot_round_trip(tmp_path):
+    """Products can be looked up by id and listed from the mapped file."""
+    path = str(tmp_path / 'catalog.snap')
+    products = [make_product(3), make_product(1), make_product(2)]
+    
+    assert write_catalog_snapshot(path, iter(products)) == 3
+    snapshot = CatalogSnapshot(path)
+    
+    assert len(snapshot) == 3
+    assert snapshot.get(2) == make_product(2)
+    assert snapshot.get(4) is None
+    assert snapshot.get('2') is None
+    assert [product['id'] for product in snapshot] == [1, 2, 3]
+    assert json.loads(b''.join(snapshot.iter_listing())) == products
+    assert os.listdir(tmp_path) == ['catalog.snap']
+
+def test_listing_served_from_snapshot(client, snapshot_path):
+    """The full listing never touches Supabase while a snapshot exists."""
+    write_catalog_snapshot(snapshot_path, [make_product(1), make_product(2)])
+    
+    with patch('api.index.supabase.table') as mock_table:
+        response = client.get('/api/products')
+        
+        assert response.status_code == 200
+        assert [product['id'] for product in json.loads(response.data)] == [1, 2]
+        mock_table.assert_not_called()
+
+def test_snapshot_swapped_without_restart(client, snapshot_path):
+    """Atomically replacing the file is picked up by the running app."""
+    write_catalog_snapshot(snapshot_path, [make_product(1, price=10.0)])
+    client.get('/api/products')
+    
+    write_catalog_snapshot(snapshot_path, [make_product(1, price=12.5)])
+    response = client.get('/api/products')
+    
+    assert json.loads(response.data)[0]['price'] == 12.5
+
+def test_add_to_cart_resolved_from_snapshot(client, snapshot_path):
+    """add_to_cart reads line-item details from the snapshot on an index miss."""
+    write_catalog_snapshot(snapshot_path, [make_product(5)])
+    
+    with patch('api.index.supabase.table') as mock_table:
+        response = client.post('/api/cart/add',
+                            json={'user_id': 'test_user_snapshot', 'product_id': 5},
+                            content_type='application/json')
+        data = json.loads(response.data)
+        
+        assert response.status_code == 200
+        assert data['cart'][0]['title'] == 'Product 5'
+        mock_table.assert_not_called()
@@ -0,0 +1,128 @@
+import io
+import os
+import pytest
+from PIL import Image
+
+import api.index
+
+@pytest.fixture
+def image_dirs(tmp_path, monkeypatch):
+    """Point the app at temporary source and thumbnail cache directories."""
+    source_dir = tmp_path / 'images'
+    cache_dir = tmp_path / 'thumbs'
+    source_dir.mkdir()
+    Image.new('RGBA', (1200, 800), (200, 30, 30, 128)).save(source_dir / 'shirt.png')
+    monkeypatch.setattr(api.index, 'PRODUCT_IMAGE_DIR', str(source_dir))
+    monkeypatch.setattr(api.index, 'THUMBNAIL_CACHE_DIR', str(cache_dir))
+    return source_dir, cache_dir
+
+def test_thumbnail_resizes_and_negotiates_format(client, image_dirs):
+    """WebP is served when accepted, JPEG otherwise, at the requested width."""
+    response = client.get('/api/images/shirt.png?w=320', headers={'Accept': 'image/webp,*/*'})
+    
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    assert 'Accept' in response.headers['Vary']
+    assert response.cache_control.max_age == api.index.THUMBNAIL_MAX_AGE <= 3600
+    assert response.headers['ETag']
+    with Image.open(io.BytesIO(response.data)) as image:
+        assert image.size == (320, 213)
+    
+    response = client.get('/api/images/shirt.png?w=160', headers={'Accept': 'image/png'})
+    
+    assert response.mimetype == 'image/jpeg'
+    with Image.open(io.BytesIO(response.data)) as image:
+        assert image.format == 'JPEG'
+        assert image.size == (160, 107)
+
+def test_thumbnail_is_cached_by_content_hash(client, image_dirs):
+    """Variants are rendered once, revalidate by ETag and change when the source does."""
+    source_dir, cache_dir = image_dirs
+    
+    first = client.get('/api/images/shirt.png?w=640&fmt=jpeg')
+    second = client.get('/api/images/shirt.png?w=640&fmt=jpeg')
+    
+    assert first.status_code == second.status_code == 200
+    assert len(os.listdir(cache_dir)) == 1
+    assert api.index.METRICS['thumbnails_generated'] == 1
+    assert api.index.METRICS['thumbnail_cache_hits'] == 1
+    
+    etag = first.headers['ETag']
+    revalidated = client.get('/api/images/shirt.png?w=640&fmt=jpeg', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    
+    Image.new('RGB', (1000, 1000), (0, 0, 255)).save(source_dir / 'shirt.png')
+    os.utime(source_dir / 'shirt.png', ns=(0, 0))
+    changed = client.get('/api/images/shirt.png?w=640&fmt=jpeg')
+    
+    assert changed.headers['ETag'] != etag
+    assert len(os.listdir(cache_dir)) == 2
+
+@pytest.mark.parametrize('url, status', [
+    ('/api/images/shirt.png?w=500', 400),
+    ('/api/images/shirt.png?fmt=gif', 400),
+    ('/api/images/missing.png', 404),
+    ('/api/images/../index.py', 404),
+])
+def test_thumbnail_rejects_bad_requests(client, image_dirs, url, status):
+    """Only configured widths and formats of images inside the image directory are served."""
+    response = client.get(url)
+    
+    assert response.status_code == status
+
+def test_thumbnail_unsupported_image(client, image_dirs):
+    """Files that aren't images are reported rather than failing the worker."""
+    source_dir, _ = image_dirs
+    (source_dir / 'broken.jpg').write_bytes(b'not an image')
+    
+    response = client.get('/api/images/broken.jpg')
+    
+    assert response.status_code == 415
+
+def test_versioned_url_is_immutable(client, image_dirs):
+    """Product JSON names the source digest; URLs carrying the current one are cached for a year."""
+    source_dir, _ = image_dirs
+    image = api.index.versioned_image('/static/images/shirt.png')
+    version = image.split('?v=')[1]
+    
+    assert image.startswith('/static/images/shirt.png?v=')
+    assert api.index.versioned_image(image) == image
+    assert api.index.versioned_image('https://example.com/a.jpg') == 'https://example.com/a.jpg'
+    assert api.index.versioned_image('/static/images/missing.png') == '/static/images/missing.png'
+    
+    response = client.get(f'/api/images/shirt.png?w=320&v={version}')
+    assert response.cache_control.max_age == api.index.THUMBNAIL_IMMUTABLE_MAX_AGE
+    assert response.cache_control.immutable
+    
+    # A URL from before the source changed still gets the current image, but only briefly
+    Image.new('RGB', (1000, 1000), (0, 0, 255)).save(source_dir / 'shirt.png')
+    os.utime(source_dir / 'shirt.png', ns=(0, 0))
+    response = client.get(f'/api/images/shirt.png?w=320&v={version}')
+    assert response.cache_control.max_age == api.index.THUMBNAIL_MAX_AGE
+    assert not response.cache_control.immutable
+    assert api.index.versioned_image('/static/images/shirt.png') != image
+
+def test_thumbnail_cache_evicts_least_recently_used(image_dirs, monkeypatch):
+    """Over its limit, the cache deletes the oldest variants until it is under 90% of it."""
+    _, cache_dir = image_dirs
+    cache_dir.mkdir()
+    for mtime, name in enumerate(['a.webp', 'b.webp', 'c.webp'], start=1):
+        (cache_dir / name).write_bytes(b'x' * 100)
+        os.utime(cache_dir / name, (mtime, mtime))
+    monkeypatch.setattr(api.index, 'THUMBNAIL_CACHE_MAX_BYTES', 250)
+    
+    assert api.index.prune_thumbnail_cache() == 200
+    assert sorted(os.listdir(cache_dir)) == ['b.webp', 'c.webp']
+    assert api.index.prune_thumbnail_cache(keep=str(cache_dir / 'b.webp')) == 200
+
+def test_thumbnail_cache_keeps_the_variant_being_served(client, image_dirs, monkeypatch):
+    """A variant larger than the whole cache is still served, and replaces everything else."""
+    _, cache_dir = image_dirs
+    monkeypatch.setattr(api.index, 'THUMBNAIL_CACHE_MAX_BYTES', 1)
+    
+    assert client.get('/api/images/shirt.png?w=160&fmt=jpeg').status_code == 200
+    response = client.get('/api/images/shirt.png?w=320&fmt=jpeg')
+    
+    assert response.status_code == 200
+    assert len(os.listdir(cache_dir)) == 1
+    assert api.index.METRICS['thumbnails_evicted'] == 1
@@ -0,0 +1,69 @@
+"""Benchmark building and querying the related-products index.
+
+    python benchmarks/bench_related.py 1000 5000 20000
+
+Reports build time, memory held by the index arrays, peak allocation during the
+build, and the average lookup latency, for synthetic catalogs of each size.
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# The app creates a Supabase client at import time; nothing here talks to it
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_KEY", "benchmark")
+
+from api.index import RelatedIndex
+
+ADJECTIVES = ['slim', 'classic', 'waterproof', 'insulated', 'cotton', 'wool', 'linen', 'denim',
+              'leather', 'vintage', 'oversized', 'cropped', 'striped', 'floral', 'hooded', 'casual']
+NOUNS = ['shirt', 'jacket', 'dress', 'jeans', 'sweater', 'hoodie', 'coat', 'skirt', 'shorts',
+         'blouse', 'boots', 'sneakers', 'scarf', 'hat', 'earrings', 'backpack']
+CATEGORIES = ["men's clothing", "women's clothing", 'outerwear', 'footwear', 'jewelery', 'accessories']
+
+def make_catalog(size, seed=0):
+    """Build a synthetic catalog of transformed products"""
+    rng = random.Random(seed)
+    return [
+        {
+            'id': product_id,
+            'title': f"{rng.choice(ADJECTIVES)} {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}",
+            'price': round(rng.uniform(5, 200), 2),
+            'description': ' '.join(rng.choice(ADJECTIVES + NOUNS) for _ in range(12)),
+            'category': rng.choice(CATEGORIES),
+            'image': f'/static/images/{product_id}.jpg',
+        }
+        for product_id in range(1, size + 1)
+    ]
+
+def bench(size, lookups=1000):
+    """Return (build seconds, index bytes, peak build bytes, mean lookup seconds)"""
+    catalog = make_catalog(size)
+    
+    tracemalloc.start()
+    started = time.perf_counter()
+    index = RelatedIndex(catalog)
+    build_seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    ids = [random.randint(1, size) for _ in range(lookups)]
+    started = time.perf_counter()
+    for product_id in ids:
+        index.related(product_id)
+    lookup_seconds = (time.perf_counter() - started) / lookups
+    return build_seconds, index.nbytes, peak, lookup_seconds
+
+def main(sizes):
+    print(f"{'products':>10} {'build (s)':>10} {'index (MB)':>11} {'peak (MB)':>10} {'lookup (us)':>12}")
+    for size in sizes:
+        build_seconds, index_bytes, peak, lookup_seconds = bench(size)
+        print(f"{size:>10} {build_seconds:>10.2f} {index_bytes / 2**20:>11.1f} "
+              f"{peak / 2**20:>10.1f} {lookup_seconds * 1e6:>12.1f}")
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 5000, 20000])
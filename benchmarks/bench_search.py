@@ -0,0 +1,81 @@
+"""Benchmark building and querying the fuzzy search index.
+
+    python benchmarks/bench_search.py 10000 100000
+
+Reports build time, memory held by the index (arrays plus the payload and text
+strings and the trigram map), the same without payloads as when results are read
+from a mapped snapshot, peak allocation during the build, and the median and 99th percentile query latency for a mix of exact,
+misspelled and partial queries, for synthetic catalogs of each size.
+"""
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# The app creates a Supabase client at import time; nothing here talks to it
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_KEY", "benchmark")
+
+from api.index import SearchIndex
+from bench_related import ADJECTIVES, NOUNS, make_catalog
+
+def misspell(word, rng):
+    """Swap two adjacent letters, as a fast typist would"""
+    if len(word) < 3:
+        return word
+    i = rng.randrange(len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+def make_queries(count, seed=1):
+    """Build a mix of exact words, two-word phrases, typos and prefixes"""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        word = rng.choice(NOUNS)
+        queries.append(rng.choice([
+            word,
+            f"{rng.choice(ADJECTIVES)} {word}",
+            misspell(word, rng),
+            word[:rng.randint(2, len(word))],
+        ]))
+    return queries
+
+def bench(size, queries=500):
+    """Return (build seconds, index bytes, bytes without payloads, peak build bytes,
+    median and p99 query seconds)"""
+    catalog = make_catalog(size)
+    
+    # tracemalloc slows the pure-Python tokenizing severalfold, so time an untraced build
+    started = time.perf_counter()
+    index = SearchIndex(catalog)
+    build_seconds = time.perf_counter() - started
+    
+    tracemalloc.start()
+    SearchIndex(catalog)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    lean_bytes = SearchIndex(catalog, payloads=False).nbytes
+    
+    timings = []
+    for query in make_queries(queries):
+        started = time.perf_counter()
+        index.search(query)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return build_seconds, index.nbytes, lean_bytes, peak, statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+def main(sizes):
+    print(f"{'products':>10} {'build (s)':>10} {'index (MB)':>11} {'no payloads (MB)':>17} {'peak (MB)':>10} "
+          f"{'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for size in sizes:
+        build_seconds, index_bytes, lean_bytes, peak, median, p99 = bench(size)
+        print(f"{size:>10} {build_seconds:>10.2f} {index_bytes / 2**20:>11.1f} {lean_bytes / 2**20:>17.1f} "
+              f"{peak / 2**20:>10.1f} {median * 1e3:>9.3f} {p99 * 1e3:>9.3f}")
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
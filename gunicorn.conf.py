@@ -0,0 +1,58 @@
+"""Gunicorn settings for running Sploosh in production.
+
+    gunicorn -c gunicorn.conf.py
+
+The app is preloaded in the master, which writes the catalog snapshot once before
+forking; every worker then maps that same file instead of holding its own copy. The
+related-products table is computed from the snapshot in a separate process and mapped
+the same way once it appears.
+"""
+import os
+
+# Must be set before the app is preloaded so api.index picks it up
+os.environ.setdefault("CATALOG_SNAPSHOT_PATH", "/tmp/sploosh-catalog.snap")
+
+wsgi_app = "api.index:app"
+bind = os.environ.get("BIND", f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+# Rate limits key on the peer address. Behind nginx or a load balancer every request comes
+# from the proxy, so set TRUSTED_PROXY_HOPS to the number of proxies that append to
+# X-Forwarded-For. It defaults to 0 here, where the header is whatever the client sent.
+preload_app = True
+worker_class = "gthread"
+# Carts live in each process's memory, so a second worker would see different carts.
+# Scale with threads; only raise WEB_CONCURRENCY once carts are stored outside the process.
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+if os.environ.get("CART_STORE_DIR") and workers > 1:
+    raise RuntimeError("CART_STORE_DIR belongs to a single process; set WEB_CONCURRENCY=1")
+threads = int(os.environ.get("GUNICORN_THREADS", "24"))
+# Each open /api/cart/events stream (one per tab on the cart page) holds a thread, so cap
+# streams at a quarter of the threads and keep the rest for ordinary requests
+os.environ.setdefault("CART_EVENTS_MAX_STREAMS", str(max(1, threads // 4)))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+keepalive = 5
+
+
+def when_ready(server):
+    """Write the shared catalog snapshot once, before any worker is forked"""
+    from api.index import refresh_catalog_snapshot, start_related_table_build
+
+    try:
+        count = refresh_catalog_snapshot()
+        server.log.info("Catalog snapshot written with %d products", count)
+    except Exception as e:
+        # Workers fall back to querying Supabase until a snapshot appears
+        server.log.warning("Could not write catalog snapshot: %s", e)
+        return
+    # Related products answer 503 until this finishes; the workers don't wait for it
+    start_related_table_build()
+
+
+def post_fork(server, worker):
+    """Give each worker its own Supabase client and cart epoch rather than the master's"""
+    import uuid
+    import api.index
+    from supabase import create_client
+
+    api.index.supabase = create_client(api.index.supabase_url, api.index.supabase_key)
+    # A replacement worker starts its cart versions over, so clients must not compare them
+    api.index.CART_EPOCH = uuid.uuid4().hex
@@ -17,13 +17,33 @@ document.addEventListener('DOMContentLoaded', async function() {
         localStorage.setItem('user_id', USER_ID);
     }
     
-    // Initialize cart display
-    const cartCount = document.getElementById('cart-count');
-    updateCartDisplay();
+    // Search-as-you-type settings
+    const SEARCH_DEBOUNCE_MS = 250;
+    
+    // Locally stored product images are served as resized variants from /api/images
+    const LOCAL_IMAGE_PREFIX = '/static/images/';
+    const THUMBNAIL_WIDTHS = [160, 320, 640];
     
     // Handle page-specific content
     const currentPage = window.location.pathname;
     
+    // Local copy of the cart and the server version it reflects. Mutation responses and
+    // pushed events carry versions, so the cart never needs re-fetching after a change.
+    // Versions are only comparable within one server epoch (process).
+    const cartCount = document.getElementById('cart-count');
+    let currentCart = [];
+    let cartVersion = 0;
+    let cartEpoch = null;
+    let cartEventsEnabled = false;
+    let cartEvents = null;
+    const cartSynced = updateCartDisplay();
+    // Only the cart page keeps an event stream open, since each one holds a server thread
+    if (currentPage === '/cart') cartSynced.catch(() => {}).then(subscribeToCartEvents);
+    document.addEventListener('visibilitychange', () => {
+        // Without a stream, pick up changes made in other tabs when this one is shown again
+        if (document.visibilityState === 'visible' && !cartEvents) updateCartDisplay().catch(() => {});
+    });
+    
     if (currentPage === '/' || currentPage === '/index') {
         // Home page - show featured products
         await loadFeaturedProducts();
@@ -57,15 +77,42 @@ document.addEventListener('DOMContentLoaded', async function() {
         // Inside loadAllProducts or after page load:
         const searchInput = document.getElementById('product-search');
         if (searchInput) {
-            searchInput.addEventListener('input', async function () {
-                const query = this.value.trim();
+            let debounceTimer = null;
+            let searchController = null;
+            
+            // Only search once typing pauses, and cancel any search still in flight
+            // so a slow, stale response can never overwrite newer results
+            const runSearch = async (query) => {
+                if (searchController) {
+                    searchController.abort();
+                }
+                const controller = new AbortController();
+                searchController = controller;
                 try {
-                    const response = await fetch(`/api/products?search=${encodeURIComponent(query)}`);
+                    const response = await fetch(`/api/products?search=${encodeURIComponent(query)}`, {
+                        signal: controller.signal
+                    });
+                    if (!response.ok) {
+                        // e.g. 429 when the server sheds load; keep the current results
+                        throw new Error(`HTTP error! Status: ${response.status}`);
+                    }
                     const products = await response.json();
                     displayProducts(products, 'all-products-grid');
                 } catch (error) {
-                    console.error('Search failed:', error);
+                    if (error.name !== 'AbortError') {
+                        console.error('Search failed:', error);
+                    }
+                } finally {
+                    if (searchController === controller) {
+                        searchController = null;
+                    }
                 }
+            };
+            
+            searchInput.addEventListener('input', function () {
+                const query = this.value.trim();
+                clearTimeout(debounceTimer);
+                debounceTimer = setTimeout(() => runSearch(query), SEARCH_DEBOUNCE_MS);
             });
         }
         try {
@@ -88,135 +135,140 @@ document.addEventListener('DOMContentLoaded', async function() {
     
     async function loadCartPage() {
         try {
-            const cartContainer = document.getElementById('cart-container');
-            if (!cartContainer) return;
-            
-            const cartItems = await fetchCartItems();
-            
-            if (cartItems.length === 0) {
-                cartContainer.innerHTML = `
-                    <div class="empty-cart">
-                        <p>Your cart is empty.</p>
-                        <a href="/products" class="add-to-cart" style="display: inline-block; margin-top: 20px;">Shop Now</a>
-                    </div>
-                `;
-                return;
-            }
-            
-            // Calculate total
-            const total = cartItems.reduce((sum, item) => sum + (item.price * item.quantity), 0);
-            
-            // Create cart HTML
+            // The cart page is rendered by setCart() once the initial sync completes
+            await cartSynced;
+        } catch (error) {
+            console.error('Error loading cart:', error);
+            document.getElementById('cart-container').innerHTML = '<p class="error">Failed to load cart. Please try again later.</p>';
+        }
+    }
+    
+    function renderCartPage() {
+        const cartContainer = document.getElementById('cart-container');
+        if (!cartContainer) return;
+        
+        const cartItems = currentCart;
+        
+        if (cartItems.length === 0) {
             cartContainer.innerHTML = `
-                <div class="cart-items">
-                    <div class="cart-header">
-                        <div class="header-item">Product</div>
-                        <div class="header-item">Price</div>
-                        <div class="header-item">Quantity</div>
-                        <div class="header-item">Total</div>
-                        <div class="header-item">Action</div>
-                    </div>
-                    <div id="cart-items-list">
-                        ${cartItems.map(item => `
-                            <div class="cart-item">
-                                <div class="cart-item-product">
-                                    <img src="${item.image}" alt="${item.title}" class="cart-item-image">
-                                    <div class="cart-item-title">${item.title}</div>
-                                </div>
-                                <div class="cart-item-price">$${item.price.toFixed(2)}</div>
-                                <div class="cart-item-quantity">${item.quantity}</div>
-                                <div class="cart-item-total">$${(item.price * item.quantity).toFixed(2)}</div>
-                                <div class="cart-item-action">
-                                    <button class="remove-from-cart" data-id="${item.product_id}">Remove</button>
-                                </div>
+                <div class="empty-cart">
+                    <p>Your cart is empty.</p>
+                    <a href="/products" class="add-to-cart" style="display: inline-block; margin-top: 20px;">Shop Now</a>
+                </div>
+            `;
+            return;
+        }
+        
+        // Calculate total
+        const total = cartItems.reduce((sum, item) => sum + (item.price * item.quantity), 0);
+        
+        // Create cart HTML
+        cartContainer.innerHTML = `
+            <div class="cart-items">
+                <div class="cart-header">
+                    <div class="header-item">Product</div>
+                    <div class="header-item">Price</div>
+                    <div class="header-item">Quantity</div>
+                    <div class="header-item">Total</div>
+                    <div class="header-item">Action</div>
+                </div>
+                <div id="cart-items-list">
+                    ${cartItems.map(item => `
+                        <div class="cart-item">
+                            <div class="cart-item-product">
+                                <img ${imageAttributes(item.image, '60px')} alt="${item.title}" class="cart-item-image">
+                                <div class="cart-item-title">${item.title}</div>
                             </div>
-                        `).join('')}
-                    </div>
+                            <div class="cart-item-price">$${item.price.toFixed(2)}</div>
+                            <div class="cart-item-quantity">${item.quantity}</div>
+                            <div class="cart-item-total">$${(item.price * item.quantity).toFixed(2)}</div>
+                            <div class="cart-item-action">
+                                <button class="remove-from-cart" data-id="${item.product_id}">Remove</button>
+                            </div>
+                        </div>
+                    `).join('')}
                 </div>
-                <div class="cart-summary">
-                    <div class="cart-total">
-                        Total: <span class="total-amount">$${total.toFixed(2)}</span>
-                    </div>
-                    <button class="checkout-btn">Proceed to Checkout</button>
+            </div>
+            <div class="cart-summary">
+                <div class="cart-total">
+                    Total: <span class="total-amount">$${total.toFixed(2)}</span>
                 </div>
-            `;
-            
-            // Add event listeners to remove buttons
-            document.querySelectorAll('.remove-from-cart').forEach(button => {
-                button.addEventListener('click', async function() {
-                    const productId = parseInt(this.getAttribute('data-id'));
-                    await removeFromCart(productId);
-                });
+                <button class="checkout-btn">Proceed to Checkout</button>
+            </div>
+        `;
+        
+        // Add event listeners to remove buttons
+        document.querySelectorAll('.remove-from-cart').forEach(button => {
+            button.addEventListener('click', async function() {
+                const productId = parseInt(this.getAttribute('data-id'));
+                await removeFromCart(productId);
             });
-            
-            // Add event listener to checkout button
-            document.querySelector('.checkout-btn').addEventListener('click', async function() {
-                try {
-                    // Get cart items
-                    const cartItems = await fetchCartItems();
-                    
-                    if (cartItems.length === 0) {
-                        alert('Your cart is empty.');
-                        return;
+        });
+        
+        // Add event listener to checkout button
+        document.querySelector('.checkout-btn').addEventListener('click', async function() {
+            try {
+                // Get cart items
+                const cartItems = currentCart;
+                
+                if (cartItems.length === 0) {
+                    alert('Your cart is empty.');
+                    return;
+                }
+                
+                // Disable the button during processing
+                this.disabled = true;
+                this.textContent = 'Processing...';
+                
+                // Send checkout request to backend
+                const response = await fetch('/api/checkout', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        user_id: USER_ID,
+                        items: cartItems
+                    })
+                });
+                
+                const data = await response.json();
+                
+                if (data.success) {
+                    // If server generated a new UUID, update our local storage
+                    if (data.new_user_id) {
+                        USER_ID = data.new_user_id;
+                        localStorage.setItem('user_id', USER_ID);
+                        console.log('Updated to new UUID:', USER_ID);
                     }
                     
-                    // Disable the button during processing
-                    this.disabled = true;
-                    this.textContent = 'Processing...';
-                    
-                    // Send checkout request to backend
-                    const response = await fetch('/api/checkout', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json'
-                        },
-                        body: JSON.stringify({
-                            user_id: USER_ID,
-                            items: cartItems
-                        })
-                    });
+                    // Show success message
+                    alert('Order processed successfully!');
                     
-                    const data = await response.json();
-                    
-                    if (data.success) {
-                        // If server generated a new UUID, update our local storage
-                        if (data.new_user_id) {
-                            USER_ID = data.new_user_id;
-                            localStorage.setItem('user_id', USER_ID);
-                            console.log('Updated to new UUID:', USER_ID);
-                        }
-                        
-                        // Show success message
-                        alert('Order processed successfully!');
-                        
-                        // Update cart display
-                        updateCartDisplay();
-                        
-                        // Redirect to confirmation page or show confirmation message
-                        // For now, just reload the cart page
-                        window.location.reload();
-                    } else {
-                        console.error('Checkout error:', data.error);
-                        alert(`Checkout failed: ${data.error}`);
-                        
-                        // Re-enable the button
-                        this.disabled = false;
-                        this.textContent = 'Proceed to Checkout';
-                    }
-                } catch (error) {
-                    console.error('Failed to process checkout:', error);
-                    alert('Failed to process checkout. Please try again.');
+                    // Redirect to confirmation page or show confirmation message
+                    // For now, just reload the cart page
+                    window.location.reload();
+                } else if (response.status === 409) {
+                    // Prices changed since the items were added; show the refreshed cart
+                    alert('Some prices have changed. Please review your cart before checking out.');
+                    await updateCartDisplay();
+                } else {
+                    console.error('Checkout error:', data.error);
+                    alert(`Checkout failed: ${data.error}`);
                     
                     // Re-enable the button
                     this.disabled = false;
                     this.textContent = 'Proceed to Checkout';
                 }
-            });
-            
-        } catch (error) {
-            console.error('Error loading cart:', error);
-            document.getElementById('cart-container').innerHTML = '<p class="error">Failed to load cart. Please try again later.</p>';
-        }
+            } catch (error) {
+                console.error('Failed to process checkout:', error);
+                alert('Failed to process checkout. Please try again.');
+                
+                // Re-enable the button
+                this.disabled = false;
+                this.textContent = 'Proceed to Checkout';
+            }
+        });
     }
     
     function createCategoryFilters(categories) {
@@ -280,7 +332,7 @@ document.addEventListener('DOMContentLoaded', async function() {
             const productCard = document.createElement('div');
             productCard.className = 'product-card';
             productCard.innerHTML = `
-                <img src="${product.image}" alt="${product.title}" class="product-image">
+                <img ${imageAttributes(product.image, '(max-width: 480px) 100vw, 300px')} alt="${product.title}" class="product-image" loading="lazy">
                 <div class="product-info">
                     <h3 class="product-title">${product.title}</h3>
                     <p class="product-category">${product.category}</p>
@@ -329,8 +381,8 @@ document.addEventListener('DOMContentLoaded', async function() {
                     buttonElement.textContent = 'Add to Cart';
                 }, 1000);
                 
-                // Update cart count
-                updateCartDisplay();
+                // Update cart count from the response instead of re-fetching
+                setCart(data.cart, data.version, data.epoch);
             } else {
                 console.error('Error adding to cart:', data.error);
                 buttonElement.textContent = 'Failed';
@@ -366,11 +418,8 @@ document.addEventListener('DOMContentLoaded', async function() {
                 // Show success message
                 showCartMessage('Product removed from cart!');
                 
-                // Update cart display
-                updateCartDisplay();
-                
-                // Reload cart page
-                await loadCartPage();
+                // Update cart display (and the cart page) from the response
+                setCart(data.cart, data.version, data.epoch);
             } else {
                 console.error('Error removing from cart:', data.error);
             }
@@ -381,19 +430,73 @@ document.addEventListener('DOMContentLoaded', async function() {
     
     async function updateCartDisplay() {
         try {
-            const cartItems = await fetchCartItems();
-            
-            const totalItems = cartItems.reduce((total, item) => total + item.quantity, 0);
-            cartCount.textContent = totalItems;
+            const response = await fetch(`/api/cart?user_id=${USER_ID}`);
+            const cartItems = await response.json();
+            cartEventsEnabled = response.headers.get('X-Cart-Events') === '1';
+            // The full cart is authoritative, whatever version we had
+            setCart(cartItems, parseInt(response.headers.get('X-Cart-Version') || '0', 10),
+                    response.headers.get('X-Cart-Epoch'), true);
         } catch (error) {
             console.error('Error updating cart:', error);
-            cartCount.textContent = '?';
+            if (cartCount) cartCount.textContent = '?';
+            throw error;
         }
     }
     
-    async function fetchCartItems() {
-        const response = await fetch(`/api/cart?user_id=${USER_ID}`);
-        return await response.json();
+    function setCart(cartItems, version, epoch, authoritative = false) {
+        // Ignore responses that arrive after a newer change has already been applied. A
+        // different epoch means a restarted or different server, whose versions start over.
+        if (!authoritative && epoch === cartEpoch && version < cartVersion) return;
+        currentCart = cartItems;
+        cartVersion = version;
+        cartEpoch = epoch;
+        
+        if (cartCount) {
+            cartCount.textContent = cartItems.reduce((total, item) => total + item.quantity, 0);
+        }
+        if (currentPage === '/cart') {
+            renderCartPage();
+        }
+    }
+    
+    function applyCartDelta(delta) {
+        if (delta.epoch !== cartEpoch) {
+            updateCartDisplay().catch(() => {});
+            return;
+        }
+        if (delta.version !== cartVersion + 1) {
+            // Already applied (e.g. from our own response), or we missed one and must resync
+            if (delta.version > cartVersion) updateCartDisplay().catch(() => {});
+            return;
+        }
+        
+        let cartItems = currentCart;
+        if (delta.op === 'set') {
+            const exists = cartItems.some(item => item.product_id === delta.item.product_id);
+            cartItems = exists
+                ? cartItems.map(item => item.product_id === delta.item.product_id ? delta.item : item)
+                : [...cartItems, delta.item];
+        } else if (delta.op === 'remove') {
+            cartItems = cartItems.filter(item => item.product_id !== delta.product_id);
+        } else if (delta.op === 'clear') {
+            cartItems = [];
+        } else if (delta.op === 'replace') {
+            cartItems = delta.cart;
+        }
+        setCart(cartItems, delta.version, delta.epoch);
+    }
+    
+    function subscribeToCartEvents() {
+        // Changes made in other tabs are pushed here; EventSource reconnects on its own.
+        // Servers that can't hold streams open (serverless) turn this off via X-Cart-Events.
+        if (!window.EventSource || !cartEventsEnabled) return;
+        const since = encodeURIComponent(`${cartEpoch}:${cartVersion}`);
+        const source = cartEvents = new EventSource(`/api/cart/events?user_id=${encodeURIComponent(USER_ID)}&since=${since}`);
+        source.addEventListener('cart', event => {
+            const data = JSON.parse(event.data);
+            setCart(data.cart, data.version, data.epoch, true);
+        });
+        source.addEventListener('delta', event => applyCartDelta(JSON.parse(event.data)));
     }
     
     function showCartMessage(message) {
@@ -415,6 +518,21 @@ document.addEventListener('DOMContentLoaded', async function() {
         return text.length > maxLength ? text.substring(0, maxLength) + '...' : text;
     }
     
+    function imageAttributes(image, sizes) {
+        // Remote images are used as-is; local ones get a srcset of thumbnail widths
+        if (!image || !image.startsWith(LOCAL_IMAGE_PREFIX)) {
+            return `src="${image}"`;
+        }
+        
+        // ?v= names the image's content, so every variant URL carries it and can be cached for good
+        const [name, query] = image.slice(LOCAL_IMAGE_PREFIX.length).split('?');
+        const version = new URLSearchParams(query || '').get('v');
+        const thumbnail = `/api/images/${name}`;
+        const suffix = version ? `&v=${encodeURIComponent(version)}` : '';
+        const srcset = THUMBNAIL_WIDTHS.map(width => `${thumbnail}?w=${width}${suffix} ${width}w`).join(', ');
+        return `src="${thumbnail}?w=${THUMBNAIL_WIDTHS[1]}${suffix}" srcset="${srcset}" sizes="${sizes}"`;
+    }
+    
     function getStarRating(rating) {
         const fullStars = Math.floor(rating);
         const halfStar = rating % 1 >= 0.5;